@@ -2,16 +2,27 @@
 Auto-generate random clips from remix files using ffmpeg.
 Runs locally (not inside Docker).
 
+Each remix is decoded once to PCM in memory and all its clips are cut from that buffer, then
+encoded to MP3. Remixes are handled on a pool of worker processes across all songs. The clips
+of a remix are drawn from a random generator seeded with SEED and the remix name, so they are
+the same whatever the order, the number of workers or the songs processed.
+
+With --wav the clips are written as WAV files straight from the buffer, without going through
+MP3: dejavu reads them without ffmpeg, for quick in-process evaluation.
+
 Usage:
   python dataset/generate_clips.py              # process all songs
   python dataset/generate_clips.py Jai_Ho       # process one song
+  python dataset/generate_clips.py --wav -w 4   # PCM clips, on 4 workers
 """
 
 import os
 import sys
 import random
 import subprocess
-import json
+import argparse
+import multiprocessing
+import wave
 
 DATASET_DIR = os.path.dirname(os.path.abspath(__file__))
 NUM_CLIPS = 12          # clips per remix
@@ -19,64 +30,108 @@ MIN_DURATION = 5        # minimum clip length in seconds
 MAX_DURATION = 10       # maximum clip length in seconds
 SEED = 42               # for reproducibility
 
-random.seed(SEED)
+# Format remixes are decoded to: 16 bits stereo PCM at 44.1kHz.
+SAMPLE_RATE = 44100
+CHANNELS = 2
+SAMPLE_WIDTH = 2
+FRAME_BYTES = CHANNELS * SAMPLE_WIDTH
 
 
-def get_audio_duration(filepath):
-    """Get duration of audio file in seconds using ffprobe."""
+def decode_pcm(filepath):
+    """Decode a whole audio file to raw PCM, in a single ffmpeg run."""
     cmd = [
-        "ffprobe", "-v", "quiet",
-        "-print_format", "json",
-        "-show_format", filepath
+        "ffmpeg", "-v", "quiet",
+        "-i", filepath,
+        "-f", "s16le", "-acodec", "pcm_s16le",
+        "-ac", str(CHANNELS), "-ar", str(SAMPLE_RATE),
+        "-"
     ]
-    result = subprocess.run(cmd, capture_output=True, text=True)
-    info = json.loads(result.stdout)
-    return float(info["format"]["duration"])
+    result = subprocess.run(cmd, capture_output=True)
+    if result.returncode != 0:
+        return None
+    return result.stdout
 
 
-def generate_clips(remix_path, clips_dir, num_clips=NUM_CLIPS):
-    """Generate random clips from a remix file."""
-    duration = get_audio_duration(remix_path)
+def clip_rng(song_name, remix_file):
+    """Random generator of the clips of a remix, only depends on SEED and the remix."""
+    return random.Random(f"{SEED}:{song_name}:{remix_file}")
 
-    # Need at least MAX_DURATION seconds to make clips
-    if duration < MAX_DURATION:
-        print(f"    [WARN] File too short ({duration:.1f}s), skipping")
-        return 0
 
-    os.makedirs(clips_dir, exist_ok=True)
-    generated = 0
+def cut_clips(pcm, rng, num_clips=NUM_CLIPS):
+    """
+    Draw random clips from a decoded remix.
 
+    Returns a list of (clip number, start time, duration, PCM of the clip) tuples.
+    """
+    duration = len(pcm) / (SAMPLE_RATE * FRAME_BYTES)
+    clips = []
     for i in range(1, num_clips + 1):
-        clip_duration = random.randint(MIN_DURATION, MAX_DURATION)
+        clip_duration = rng.randint(MIN_DURATION, MAX_DURATION)
         max_start = duration - clip_duration - 1
         if max_start <= 0:
             continue
-        start_time = random.uniform(1, max_start)  # avoid very start
-
-        clip_path = os.path.join(clips_dir, f"clip_{i}.mp3")
-        cmd = [
-            "ffmpeg", "-y", "-v", "quiet",
-            "-ss", str(start_time),
-            "-i", remix_path,
-            "-t", str(clip_duration),
-            "-acodec", "libmp3lame",
-            "-q:a", "2",
-            clip_path
-        ]
-        subprocess.run(cmd, capture_output=True)
-        generated += 1
-
-    return generated
-
-
-def process_song(song_dir):
-    """Process all remixes in a song directory."""
+        start_time = rng.uniform(1, max_start)  # avoid very start
+
+        start = int(start_time * SAMPLE_RATE) * FRAME_BYTES
+        end = start + clip_duration * SAMPLE_RATE * FRAME_BYTES
+        clips.append((i, start_time, clip_duration, pcm[start:end]))
+
+    return clips
+
+
+def write_mp3(pcm, clip_path):
+    """Encode a PCM clip to MP3, fed to ffmpeg through its standard input."""
+    cmd = [
+        "ffmpeg", "-y", "-v", "quiet",
+        "-f", "s16le", "-ac", str(CHANNELS), "-ar", str(SAMPLE_RATE),
+        "-i", "-",
+        "-acodec", "libmp3lame",
+        "-q:a", "2",
+        clip_path
+    ]
+    subprocess.run(cmd, input=pcm, capture_output=True)
+
+
+def write_wav(pcm, clip_path):
+    """Write a PCM clip as it is to a WAV file."""
+    with wave.open(clip_path, "wb") as f:
+        f.setnchannels(CHANNELS)
+        f.setsampwidth(SAMPLE_WIDTH)
+        f.setframerate(SAMPLE_RATE)
+        f.writeframes(pcm)
+
+
+def generate_clips(job):
+    """Generate random clips from a remix file, on a pool process."""
+    song_name, remix_path, clips_dir, extension = job
+    remix_file = os.path.basename(remix_path)
+
+    pcm = decode_pcm(remix_path)
+    if pcm is None:
+        return song_name, remix_file, clips_dir, "could not be decoded, skipping"
+
+    # Need at least MAX_DURATION seconds to make clips
+    duration = len(pcm) / (SAMPLE_RATE * FRAME_BYTES)
+    if duration < MAX_DURATION:
+        return song_name, remix_file, clips_dir, f"File too short ({duration:.1f}s), skipping"
+
+    os.makedirs(clips_dir, exist_ok=True)
+    write = write_wav if extension == ".wav" else write_mp3
+    clips = cut_clips(pcm, clip_rng(song_name, remix_file))
+    for i, _, _, clip_pcm in clips:
+        write(clip_pcm, os.path.join(clips_dir, f"clip_{i}{extension}"))
+
+    return song_name, remix_file, clips_dir, len(clips)
+
+
+def song_jobs(song_dir, extension):
+    """Find the remixes of a song directory whose clips are still to generate."""
     song_name = os.path.basename(song_dir)
     remix_dir = os.path.join(song_dir, "remix")
 
     if not os.path.isdir(remix_dir):
         print(f"  [{song_name}] No remix/ folder, skipping")
-        return
+        return []
 
     # Find all remix files
     remix_files = sorted([
@@ -86,31 +141,53 @@ def process_song(song_dir):
 
     if not remix_files:
         print(f"  [{song_name}] No remix files found, skipping")
-        return
+        return []
 
+    jobs = []
     for remix_file in remix_files:
         remix_num = remix_file.replace("remix_", "").replace(".mp3", "")
         clips_dir = os.path.join(remix_dir, f"clips_{remix_num}")
         remix_path = os.path.join(remix_dir, remix_file)
 
         # Skip if clips already generated for this remix
-        if os.path.isdir(clips_dir) and any(f.endswith(".mp3") for f in os.listdir(clips_dir)):
-            existing = len([f for f in os.listdir(clips_dir) if f.endswith(".mp3")])
+        if os.path.isdir(clips_dir) and any(f.endswith(extension) for f in os.listdir(clips_dir)):
+            existing = len([f for f in os.listdir(clips_dir) if f.endswith(extension)])
             print(f"  [{song_name}] {remix_file} -> clips_{remix_num}/ (already has {existing} clips, skipping)")
             continue
 
-        print(f"  [{song_name}] {remix_file} -> clips_{remix_num}/")
-        count = generate_clips(remix_path, clips_dir)
-        print(f"    Generated {count} clips")
+        jobs.append((song_name, remix_path, clips_dir, extension))
+
+    return jobs
+
+
+def process_songs(song_dirs, extension=".mp3", workers=None):
+    """Generate the clips of all remixes of the songs, on a pool of workers."""
+    jobs = [job for song_dir in song_dirs for job in song_jobs(song_dir, extension)]
+    if not jobs:
+        return
+
+    with multiprocessing.Pool(min(workers or multiprocessing.cpu_count(), len(jobs))) as pool:
+        for song_name, remix_file, clips_dir, count in pool.imap_unordered(generate_clips, jobs):
+            print(f"  [{song_name}] {remix_file} -> {os.path.basename(clips_dir)}/")
+            if isinstance(count, str):
+                print(f"    [WARN] {count}")
+            else:
+                print(f"    Generated {count} clips")
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generates random clips from the remix files.")
+    parser.add_argument("song", nargs="?", default=None, help="Only process this song.")
+    parser.add_argument("-w", "--workers", type=int, default=None, help="Worker processes, one per CPU by default.")
+    parser.add_argument("--wav", action="store_true", help="Write the clips as WAV instead of MP3.")
+    args = parser.parse_args()
+    extension = ".wav" if args.wav else ".mp3"
+
     # Optional: process specific song
-    if len(sys.argv) > 1:
-        song_name = sys.argv[1]
-        song_dir = os.path.join(DATASET_DIR, song_name)
+    if args.song:
+        song_dir = os.path.join(DATASET_DIR, args.song)
         if os.path.isdir(song_dir):
-            process_song(song_dir)
+            process_songs([song_dir], extension, args.workers)
         else:
             print(f"Song folder not found: {song_dir}")
         sys.exit(0)
@@ -122,7 +199,6 @@ if __name__ == "__main__":
         if os.path.isdir(os.path.join(DATASET_DIR, d))
     ])
 
-    for song in songs:
-        process_song(os.path.join(DATASET_DIR, song))
+    process_songs([os.path.join(DATASET_DIR, song) for song in songs], extension, args.workers)
 
     print("\nDone!")
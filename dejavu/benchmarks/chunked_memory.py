@@ -0,0 +1,130 @@
+"""
+Checks that fingerprinting files in chunks takes the same memory whatever their length.
+
+Recordings of growing lengths are generated and each one is fingerprinted with
+fingerprint_directory and fingerprint_chunk_frames set, in a fresh Python process so that peaks
+don't carry over. For each length it reports the peak resident memory of that process and of
+the pool processes. The run fails if the peak of the longest recording is more than --threshold
+above the peak of the shortest one. Only databases shared across processes are checked, their
+pool processes store the chunks themselves: the in-memory database gets the fingerprints of
+every file sent back and keeps them in the main process, so memory grows with them by design.
+
+The database is the one in the config file, as for dejavu.py, the in-memory one by default.
+Every song stored is deleted once measured.
+
+Usage:
+  python benchmarks/chunked_memory.py -m 2 4 8 16
+  python benchmarks/chunked_memory.py -c dejavu.cnf -m 10 40 --threshold 0.1
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import wave
+
+import numpy as np
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+CHILD = """import json, resource, sys
+sys.path.insert(0, {root!r})
+from dejavu import Dejavu
+djv = Dejavu({config!r})
+djv.fingerprint_directory({directory!r}, ["wav"], {processes})
+shared = djv.db.shared_across_processes
+djv.delete_songs_by_id([song["song_id"] for song in djv.get_fingerprinted_songs()
+                        if song["song_name"] == "recording"])
+print(json.dumps({{"peak": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                  "workers_peak": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+                  "shared": shared}}))
+"""
+
+
+def write_recording(path: str, minutes: float, fs: int = 44100) -> None:
+    """
+    Writes a stereo recording of random tones over noise, ten seconds at a time. This process
+    has to stay small: on Linux the measured processes start with its peak, kept across exec.
+    """
+    rng = np.random.default_rng(int(minutes * 1000))
+    with wave.open(path, "wb") as f:
+        f.setnchannels(2)
+        f.setsampwidth(2)
+        f.setframerate(fs)
+        for _ in range(int(np.ceil(minutes * 6))):
+            t = np.arange(fs * 10) / fs
+            tones = sum(np.sin(2 * np.pi * rng.uniform(200, 4000) * t + rng.uniform(0, 6)) for _ in range(8))
+            signal = tones * 2000 + rng.normal(0, 500, len(t))
+            f.writeframes(np.repeat(signal.astype(np.int16), 2).tobytes())
+
+
+def measure(config: dict, minutes: float, processes: int, workdir: str) -> dict:
+    directory = os.path.join(workdir, f"{minutes}mn")
+    os.makedirs(directory)
+    write_recording(os.path.join(directory, "recording.wav"), minutes)
+
+    code = CHILD.format(root=ROOT, config=config, directory=directory, processes=processes)
+    output = subprocess.run([sys.executable, "-c", code], cwd=ROOT, check=True,
+                            stdout=subprocess.PIPE).stdout
+    result = json.loads(output.decode().strip().splitlines()[-1])
+    os.remove(os.path.join(directory, "recording.wav"))
+    # ru_maxrss is in kilobytes on Linux.
+    return {"minutes": minutes, "peak_mb": result["peak"] / 1024, "workers_peak_mb": result["workers_peak"] / 1024,
+            "shared": result["shared"]}
+
+
+def check(results: list, threshold: float) -> bool:
+    """
+    Compares the peaks of the longest recording with the ones of the shortest.
+
+    :param results: measures, from the shortest recording to the longest.
+    :param threshold: growth past which the memory is not flat, 0.1 is 10% more.
+    :return: True if the memory stayed flat.
+    """
+    shortest, longest = results[0], results[-1]
+    passed = True
+    for key in ("workers_peak_mb", "peak_mb"):
+        growth = longest[key] / shortest[key] - 1
+        flat = growth <= threshold
+        passed &= flat
+        print(f"{key}: {shortest[key]:.0f}MB -> {longest[key]:.0f}MB ({growth:+.1%}){'' if flat else '  NOT FLAT'}")
+    return passed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Checks that chunked fingerprinting takes the same memory "
+                                                 "whatever the length of the files.")
+    parser.add_argument("-c", "--config", default=None,
+                        help="Config file with the database to use, as for dejavu.py. The in-memory one by default.")
+    parser.add_argument("-m", "--minutes", nargs="+", type=float, default=[2, 4, 8],
+                        help="Lengths of the recordings, in minutes.")
+    parser.add_argument("-f", "--chunk-frames", type=int, default=2048, help="fingerprint_chunk_frames to use.")
+    parser.add_argument("-w", "--processes", type=int, default=2, help="Processes of fingerprint_directory.")
+    parser.add_argument("-t", "--threshold", type=float, default=0.1,
+                        help="Growth of the peak from the shortest to the longest recording taken as not flat.")
+    args = parser.parse_args()
+
+    config = {"database_type": "memory"}
+    if args.config:
+        with open(args.config) as f:
+            config = json.load(f)
+    config["fingerprint_chunk_frames"] = args.chunk_frames
+
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for minutes in sorted(args.minutes):
+            print(f"Fingerprinting {minutes} minutes")
+            results.append(measure(config, minutes, args.processes, workdir))
+
+    print(f"\n{'minutes':>8}{'main':>10}{'workers':>10}")
+    for result in results:
+        print(f"{result['minutes']:>8}{result['peak_mb']:>8.0f}MB{result['workers_peak_mb']:>8.0f}MB")
+    print()
+
+    if not results[-1]["shared"]:
+        print("The database is not shared across processes, it keeps every fingerprint in memory: "
+              "there is nothing to check.")
+    elif not check(results, args.threshold):
+        sys.exit(1)
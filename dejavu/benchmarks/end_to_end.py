@@ -0,0 +1,296 @@
+"""
+Measures ingest and query speed as the database grows, as Panako's benchmark.rb does.
+
+The audio files of the corpus folders are fingerprinted through fingerprint_directory in
+growing subsets, the files of each step linked into a folder of their own. After each step a
+fixed set of queries is recognized with the FileRecognizer. Every step records the seconds of
+audio fingerprinted per second of ingest, the size of the database and the query latencies.
+
+The queries are the files of the --queries folders, or by default the clips of the dataset/
+folder, checked against the song they come from. Only the originals of the dataset/ folder are
+stored, named after their song folder: its remixes and clips never go in the corpus.
+Results are written as CSV, one line per step, to be plotted like Panako's benchmark_plot.py
+does, or directly with --plot. The database is the one in the config file, as for dejavu.py,
+the in-memory one by default. It has to be empty, or emptied with --empty.
+
+Usage:
+  python benchmarks/end_to_end.py -s 10 20 40 80 -o dejavu_benchmark.csv    # ../music and ../dataset
+  python benchmarks/end_to_end.py -c dejavu.cnf --empty -i ../music -q queries -p dejavu_benchmark.png
+"""
+
+import argparse
+import csv
+import json
+import os
+import shutil
+import sys
+import tempfile
+import wave
+from time import perf_counter
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+# the music/ and dataset/ folders sit next to the dejavu/ one.
+PROJECT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+
+from profiles import discover_songs  # noqa: E402
+
+from dejavu import Dejavu  # noqa: E402
+from dejavu.config.settings import (QUERY_TIME, RESULTS,  # noqa: E402
+                                    SONG_NAME)
+from dejavu.logic import decoder  # noqa: E402
+from dejavu.logic.recognizer.file_recognizer import FileRecognizer  # noqa: E402
+
+COLUMNS = ["step", "files", "songs", "step_audio_seconds", "audio_seconds", "ingest_seconds",
+           "audio_seconds_per_second", "fingerprints", "data_bytes", "index_bytes", "queries",
+           "query_p50", "query_p95", "query_mean", "lookup_mean", "accuracy"]
+
+
+def audio_seconds(path: str) -> float:
+    """
+    Length of an audio file, from its header when possible.
+    """
+    if path.lower().endswith(".wav"):
+        with wave.open(path) as f:
+            return f.getnframes() / f.getframerate()
+
+    from pydub import AudioSegment
+    from pydub.utils import mediainfo
+    try:
+        return float(mediainfo(path)["duration"])
+    except (OSError, KeyError, ValueError):
+        # without ffprobe the file is decoded.
+        return len(AudioSegment.from_file(path)) / 1000
+
+
+def find_queries(query_dirs: list, extensions: list, dataset_dir: str, max_queries: int) -> list:
+    """
+    Finds the fixed set of queries.
+
+    :return: a list of (path, name of the song it comes from or None if unknown) tuples.
+    """
+    if query_dirs:
+        queries = sorted((path, None) for query_dir in query_dirs
+                         for path, _ in decoder.find_files(query_dir, extensions))
+    elif os.path.isdir(dataset_dir):
+        queries = [(clip, song_name) for song_name, _, clips in discover_songs(dataset_dir) for clip in clips]
+    else:
+        queries = []
+    return queries[:max_queries] if max_queries else queries
+
+
+def dataset_song(path: str, dataset_dir: str) -> str:
+    """
+    Name of the dataset/ song folder a file is in.
+
+    :return: the name of the song folder, None if the file is not in the dataset folder.
+    """
+    relative = os.path.relpath(os.path.abspath(path), os.path.abspath(dataset_dir))
+    parts = relative.split(os.sep)
+    return parts[0] if len(parts) > 1 and parts[0] != os.pardir else None
+
+
+def is_corpus_file(path: str, dataset_dir: str) -> bool:
+    """
+    Whether a file goes in the corpus: anything but the remixes and clips of the dataset/
+    folder, which are what the queries are made of.
+    """
+    song_name = dataset_song(path, dataset_dir)
+    return song_name is None or os.path.dirname(os.path.abspath(path)) == \
+        os.path.join(os.path.abspath(dataset_dir), song_name)
+
+
+def link_step(files: list, step_dir: str, dataset_dir: str) -> None:
+    """
+    Puts the files of a step in a folder of their own, named after their folder and file
+    so that songs from the dataset/ folder, all called original.mp3, keep apart. Files of the
+    dataset/ folder are named after their song folder, which the queries are checked against.
+    """
+    os.makedirs(step_dir)
+    for path in files:
+        parent = dataset_song(path, dataset_dir) or os.path.basename(os.path.dirname(os.path.abspath(path)))
+        name, extension = os.path.splitext(os.path.basename(path))
+        link = os.path.join(step_dir, f"{parent} - {name}{extension}")
+        copy = 1
+        while os.path.lexists(link):
+            copy += 1
+            link = os.path.join(step_dir, f"{parent} - {name} ({copy}){extension}")
+        try:
+            os.symlink(os.path.abspath(path), link)
+        except OSError:
+            shutil.copy(path, link)
+
+
+def run_queries(djv: Dejavu, queries: list) -> dict:
+    latencies = []
+    lookups = []
+    recognized = known = 0
+    for path, song_name in queries:
+        t = perf_counter()
+        results = djv.recognize(FileRecognizer, path)
+        latencies.append(perf_counter() - t)
+        lookups.append(results[QUERY_TIME])
+
+        if song_name is not None:
+            known += 1
+            matches = results[RESULTS]
+            if matches and matches[0][SONG_NAME].decode("utf8").startswith(f"{song_name} - "):
+                recognized += 1
+
+    if not latencies:
+        return {"queries": 0, "query_p50": None, "query_p95": None, "query_mean": None,
+                "lookup_mean": None, "accuracy": None}
+
+    p50, p95 = np.percentile(latencies, [50, 95])
+    return {
+        "queries": len(latencies),
+        "query_p50": round(p50, 4),
+        "query_p95": round(p95, 4),
+        "query_mean": round(float(np.mean(latencies)), 4),
+        "lookup_mean": round(float(np.mean(lookups)), 4),
+        "accuracy": round(recognized / known, 4) if known else None
+    }
+
+
+def run_benchmark(djv: Dejavu, files: list, steps: list, queries: list, extensions: list, nprocesses: int,
+                  workdir: str, dataset_dir: str) -> list:
+    results = []
+    done = 0
+    total_audio = 0
+    for step, step_files in enumerate(steps, start=1):
+        new_files = files[done: step_files]
+        step_audio = sum(audio_seconds(path) for path in new_files)
+        step_dir = os.path.join(workdir, f"step_{step}")
+        link_step(new_files, step_dir, dataset_dir)
+
+        t = perf_counter()
+        djv.fingerprint_directory(step_dir, extensions, nprocesses)
+        ingest_time = perf_counter() - t
+
+        done = step_files
+        total_audio += step_audio
+        data_size, index_size = djv.db.get_fingerprints_size()
+        result = {
+            "step": step,
+            "files": done,
+            "songs": djv.db.get_num_songs(),
+            "step_audio_seconds": round(step_audio, 2),
+            "audio_seconds": round(total_audio, 2),
+            "ingest_seconds": round(ingest_time, 3),
+            "audio_seconds_per_second": round(step_audio / ingest_time, 2) if ingest_time else None,
+            "fingerprints": djv.db.get_num_fingerprints(),
+            "data_bytes": data_size,
+            "index_bytes": index_size
+        }
+        result.update(run_queries(djv, queries))
+        results.append(result)
+        print(f"Step {step}: {done} files, {result['audio_seconds_per_second']} seconds of audio per second, "
+              f"{result['fingerprints']} fingerprints, queries in {result['query_p50']}s (p50)")
+
+    return results
+
+
+def print_report(results: list) -> None:
+    print(f"\n{'files':>7}{'audio':>10}{'audio/s':>9}{'fingerprints':>14}{'size':>10}"
+          f"{'p50':>9}{'p95':>9}{'lookup':>9}{'accuracy':>10}")
+    for result in results:
+        size = (result["data_bytes"] + result["index_bytes"]) / 1024 ** 2
+        accuracy = f"{result['accuracy']:.1%}" if result["accuracy"] is not None else "-"
+        speed = result["audio_seconds_per_second"] if result["audio_seconds_per_second"] is not None else "-"
+        p50, p95, lookup = (f"{result[key]:.3f}s" if result[key] is not None else "-"
+                            for key in ("query_p50", "query_p95", "lookup_mean"))
+        print(f"{result['files']:>7}{result['audio_seconds'] / 60:>8.1f}mn{speed:>9}"
+              f"{result['fingerprints']:>14}{size:>8.1f}MB{p50:>9}{p95:>9}{lookup:>9}{accuracy:>10}")
+
+
+def plot(results: list, path: str) -> None:
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    audio_hours = [result["audio_seconds"] / 3600 for result in results]
+    fig, (ingest, size, query) = plt.subplots(1, 3, figsize=(15, 4.5))
+
+    ingest.plot(audio_hours, [result["audio_seconds_per_second"] or 0 for result in results], marker="o")
+    ingest.set_ylabel("seconds of audio stored per second")
+
+    size.plot(audio_hours, [(result["data_bytes"] + result["index_bytes"]) / 1024 ** 2 for result in results],
+              marker="o")
+    size.set_ylabel("database size (MB)")
+
+    for key, label in (("query_p50", "p50"), ("query_p95", "p95"), ("lookup_mean", "database lookup")):
+        query.plot(audio_hours, [result[key] or 0 for result in results], marker="o", label=label)
+    query.set_ylabel("query time (s)")
+    query.legend()
+
+    for axis in (ingest, size, query):
+        axis.set_xlabel("hours of audio in the database")
+        axis.grid(True, alpha=0.3)
+
+    fig.tight_layout()
+    fig.savefig(path)
+    print(f"Curves saved to {path}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Measures ingest and query speed as the database grows.")
+    parser.add_argument("-c", "--config", default=None,
+                        help="Config file with the database to use, as for dejavu.py. The in-memory one by default.")
+    parser.add_argument("--empty", action="store_true", help="Empties the database first, ALL ITS DATA IS LOST.")
+    parser.add_argument("-i", "--ingest", nargs="+",
+                        default=[os.path.join(PROJECT_DIR, "music"), os.path.join(PROJECT_DIR, "dataset")],
+                        help="Folders of the corpus, the music and dataset folders next to dejavu/ by default.")
+    parser.add_argument("-e", "--extensions", nargs="+", default=["mp3", "wav"], help="Audio file extensions.")
+    parser.add_argument("-s", "--steps", nargs="+", type=int, default=None,
+                        help="Number of files in the database after each step, doubling from 10 by default.")
+    parser.add_argument("-q", "--queries", nargs="+", default=None,
+                        help="Folders of the queries, the clips of the dataset folder by default.")
+    parser.add_argument("-d", "--dataset", default=os.path.join(PROJECT_DIR, "dataset"),
+                        help="Path to the dataset folder, the one next to dejavu/ by default.")
+    parser.add_argument("-n", "--num-queries", type=int, default=50, help="Maximum number of queries.")
+    parser.add_argument("-w", "--processes", type=int, default=None, help="Processes fingerprinting the corpus.")
+    parser.add_argument("-o", "--output", default="dejavu_benchmark.csv", help="CSV file of the results.")
+    parser.add_argument("-p", "--plot", default=None, help="Saves the curves to this image.")
+    args = parser.parse_args()
+
+    queries = find_queries(args.queries, args.extensions, args.dataset, args.num_queries)
+    query_files = {os.path.abspath(path) for path, _ in queries}
+    # the queries are never stored, nor any remix or clip of the dataset/ folder, used or not.
+    files = sorted(path for ingest_dir in args.ingest if os.path.isdir(ingest_dir)
+                   for path, _ in decoder.find_files(ingest_dir, args.extensions)
+                   if os.path.abspath(path) not in query_files and is_corpus_file(path, args.dataset))
+    if not files:
+        print(f"No audio files found in {', '.join(args.ingest)}")
+        sys.exit(1)
+
+    steps = sorted(min(step, len(files)) for step in args.steps) if args.steps else \
+        [min(10 * 2 ** step, len(files)) for step in range(int(np.ceil(np.log2(max(len(files) / 10, 1)))) + 1)]
+    steps = sorted(set(steps))
+
+    config = {"database_type": "memory"}
+    if args.config:
+        with open(args.config) as f:
+            config = json.load(f)
+
+    djv = Dejavu(config)
+    if args.empty:
+        djv.db.empty()
+        djv = Dejavu(config)
+    elif djv.db.get_num_songs():
+        print("The database already has songs, use a dedicated one or empty it with --empty.")
+        sys.exit(1)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        results = run_benchmark(djv, files, steps, queries, args.extensions, args.processes, workdir, args.dataset)
+    print_report(results)
+
+    with open(args.output, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=COLUMNS)
+        writer.writeheader()
+        writer.writerows(results)
+    print(f"Results saved to {args.output}")
+
+    if args.plot:
+        plot(results, args.plot)
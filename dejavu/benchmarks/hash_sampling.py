@@ -0,0 +1,105 @@
+"""
+Measures what keeping one hash out of k costs in recall on the dataset/ songs.
+
+The originals and clips are fingerprinted once. Then, for every ratio, a new in-memory
+database keeping one hash out of that ratio is filled with the originals and every clip is
+recognized against it. For each ratio it reports the fingerprints stored (what the database
+size grows with), the query time and how many clips were recognized as the right song.
+
+Usage:
+  python benchmarks/hash_sampling.py                   # ratios of 1, 2, 4 and 8
+  python benchmarks/hash_sampling.py -k 1 4 -n 20 -o hash_sampling.json
+"""
+
+import argparse
+import json
+import os
+import sys
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from profiles import discover_songs  # noqa: E402
+
+from dejavu import Dejavu  # noqa: E402
+from dejavu.config.settings import SONG_NAME  # noqa: E402
+from dejavu.logic.hash_sampling import sample_hashes  # noqa: E402
+
+
+def benchmark_ratio(ratio: int, songs, fingerprints, clip_fingerprints) -> dict:
+    """
+    Fills a database sampling one hash out of ratio with the originals and recognizes the clips.
+
+    :param ratio: one hash out of ratio is stored and looked up.
+    :param songs: songs as returned by discover_songs.
+    :param fingerprints: hashes and file hash of each original, by song name.
+    :param clip_fingerprints: (song name, hashes) of each clip.
+    :return: a dictionary with the measures taken.
+    """
+    djv = Dejavu({"database_type": "memory", "hash_sample_ratio": ratio})
+    for song_name, _, _ in songs:
+        hashes, file_hash = fingerprints[song_name]
+        djv.db.insert_song_hashes(song_name, file_hash, sample_hashes(hashes, ratio))
+
+    query_time = 0
+    recognized = 0
+    for song_name, hashes in clip_fingerprints:
+        t = perf_counter()
+        hashes = djv.sample_query_hashes(hashes)
+        matches, dedup_hashes, _ = djv.find_matches(hashes)
+        results = djv.align_matches(matches, dedup_hashes, len(hashes))
+        query_time += perf_counter() - t
+
+        if results and results[0][SONG_NAME].decode("utf8") == song_name:
+            recognized += 1
+
+    clips = len(clip_fingerprints)
+    return {
+        "ratio": ratio,
+        "fingerprints": djv.db.get_num_fingerprints(),
+        "clips": clips,
+        "recognized": recognized,
+        "accuracy": round(recognized / clips, 4) if clips else 0,
+        "query_time": round(query_time, 3)
+    }
+
+
+def print_report(results) -> None:
+    baseline = results[0]
+    print(f"\n{'ratio':<8}{'fingerprints':>14}{'size':>8}{'query time':>12}{'accuracy':>10}{'recall cost':>13}")
+    for result in results:
+        size = result["fingerprints"] / baseline["fingerprints"] if baseline["fingerprints"] else 0
+        print(f"{result['ratio']:<8}{result['fingerprints']:>14}{size:>8.0%}{result['query_time']:>11.2f}s"
+              f"{result['accuracy']:>10.1%}{baseline['accuracy'] - result['accuracy']:>13.1%}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compares the database size, query time and accuracy "
+                                                 "of several hash sample ratios.")
+    parser.add_argument("-d", "--dataset", default="dataset", help="Path to the dataset folder.")
+    parser.add_argument("-k", "--ratios", nargs="+", type=int, default=[1, 2, 4, 8],
+                        help="Sample ratios to compare, the first one is the baseline.")
+    parser.add_argument("-n", "--songs", type=int, default=None, help="Maximum number of songs to use.")
+    parser.add_argument("-o", "--output", default=None, help="Saves the results as JSON.")
+    args = parser.parse_args()
+
+    songs = discover_songs(args.dataset, args.songs)
+    if not songs:
+        print(f"No songs with clips found in {args.dataset}")
+        sys.exit(1)
+
+    fingerprints = {
+        song_name: Dejavu.get_file_fingerprints(original, None, print_output=True)
+        for song_name, original, _ in songs
+    }
+    clip_fingerprints = [
+        (song_name, Dejavu.get_file_fingerprints(clip, None)[0])
+        for song_name, _, clips in songs for clip in clips
+    ]
+
+    results = [benchmark_ratio(ratio, songs, fingerprints, clip_fingerprints) for ratio in args.ratios]
+    print_report(results)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,308 @@
+"""
+Measures how a database backend copes as the fingerprints table grows, without any audio.
+
+Songs are made up straight into the database: each one gets a length of 2 to 6 minutes,
+fingerprints at offsets spread over it and hashes drawn from a Zipf distribution, so a few
+hashes are found everywhere and most of them almost nowhere, as with real songs. The table is
+filled up to every size asked for in turn, and at each of them it reports the ingest
+throughput, the size of the fingerprints and their indexes and the latency percentiles of
+return_matches for clips cut from random songs, with part of their hashes replaced by noise.
+
+Songs and queries only depend on the seed, so runs against different backends or commits
+store and look up exactly the same fingerprints. The database is the one in the config file,
+as for dejavu.py, the in-memory one by default. It has to be empty, or emptied with --empty.
+
+Usage:
+  python benchmarks/index_scale.py -r 1e5 1e6                 # in-memory database
+  python benchmarks/index_scale.py -c dejavu.cnf --empty -r 1e6 1e7 1e8 1e9 -o scale.json -p scale.png
+"""
+
+import argparse
+import json
+import os
+import sys
+from collections import Counter
+from time import perf_counter
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from dejavu.base_classes.base_database import get_database  # noqa: E402
+from dejavu.config.settings import (DEFAULT_FS,  # noqa: E402
+                                    DEFAULT_OVERLAP_RATIO, DEFAULT_WINDOW_SIZE,
+                                    FINGERPRINT_REDUCTION)
+from dejavu.logic.hash_arrays import HASH_BYTES, unpack_hashes  # noqa: E402
+
+# Offsets are spectrogram frames, as many per second as with the default profile.
+FRAMES_PER_SECOND = DEFAULT_FS / (DEFAULT_WINDOW_SIZE * (1 - DEFAULT_OVERLAP_RATIO))
+# Room for the offsets when deduplicating (hash, offset) pairs, songs are shorter than this.
+OFFSET_BITS = 20
+
+
+class FingerprintSynthesizer:
+    """
+    Makes up the fingerprints of songs and clips, the same ones for the same seed.
+    """
+    def __init__(self, hashes_per_song: int, vocabulary: int, zipf: float, seed: int = 0):
+        """
+        :param hashes_per_song: average number of fingerprints of a song.
+        :param vocabulary: number of different hashes.
+        :param zipf: exponent of the Zipf distribution of the hashes, the higher the more
+        fingerprints share the most common hashes.
+        :param seed: seed of everything made up.
+        """
+        self.hashes_per_song = hashes_per_song
+        self.vocabulary = vocabulary
+        self.zipf = zipf
+        self.seed = seed
+
+    def draw_hashes(self, random: np.random.RandomState, count: int) -> np.ndarray:
+        """
+        Draws the rank of count hashes, 1 being the most common, through the inverse of the
+        cumulative distribution of a continuous Zipf law.
+        """
+        u = random.random_sample(count)
+        if self.zipf == 1:
+            ranks = self.vocabulary ** u
+        else:
+            ranks = (1 + u * (self.vocabulary ** (1 - self.zipf) - 1)) ** (1 / (1 - self.zipf))
+        return np.minimum(ranks.astype(np.int64), self.vocabulary)
+
+    @staticmethod
+    def pack(ranks: np.ndarray) -> np.ndarray:
+        """
+        Turns ranks into random looking hashes, packed as with pack_hashes. Multiplying by an
+        odd number is a bijection of the 64 bit integers, so different ranks give different hashes.
+        """
+        ranks = ranks.astype(np.uint64)
+        high = (ranks * np.uint64(0x9E3779B97F4A7C15)).astype(">u8")
+        low = (ranks * np.uint64(0xC2B2AE3D27D4EB4F)).astype(">u8")
+        hash_array = np.hstack([high.view(np.uint8).reshape(-1, 8), low.view(np.uint8).reshape(-1, 8)])
+        hash_array = np.ascontiguousarray(hash_array[:, :HASH_BYTES])
+        if FINGERPRINT_REDUCTION % 2:
+            hash_array[:, 0] &= 0x0F
+        return hash_array
+
+    def song(self, index: int):
+        """
+        Makes up the fingerprints of a song.
+
+        :param index: number of the song, the same number always gives the same song.
+        :return: the packed hashes, their uint32 offsets and the length of the song in frames.
+        """
+        random = np.random.RandomState([self.seed, index])
+        count = random.randint(self.hashes_per_song // 2, self.hashes_per_song * 3 // 2 + 1)
+        frames = random.randint(int(120 * FRAMES_PER_SECOND), int(360 * FRAMES_PER_SECOND))
+
+        # songs are sets of (hash, offset), repeated pairs are dropped.
+        keys = np.unique((self.draw_hashes(random, count) << OFFSET_BITS) | random.randint(0, frames, count))
+        offsets = (keys & ((1 << OFFSET_BITS) - 1)).astype(np.uint32)
+        return self.pack(keys >> OFFSET_BITS), offsets, frames
+
+    def clip(self, index: int, song_index: int, seconds: float, noise: float):
+        """
+        Makes up a query: a clip of a song, with part of its hashes replaced by others.
+
+        :param index: number of the query, the same number always gives the same clip.
+        :param song_index: number of the song the clip is cut from.
+        :param seconds: length of the clip.
+        :param noise: fraction of the hashes of the clip replaced by random ones.
+        :return: a list of (hash, offset) tuples, offsets counted from the start of the clip.
+        """
+        hash_array, offsets, frames = self.song(song_index)
+        random = np.random.RandomState([self.seed, 1 << 31, index])
+
+        clip_frames = int(seconds * FRAMES_PER_SECOND)
+        start = random.randint(0, max(frames - clip_frames, 1))
+        kept = (offsets >= start) & (offsets < start + clip_frames)
+        hash_array, offsets = hash_array[kept], offsets[kept] - start
+
+        replaced = random.random_sample(len(offsets)) < noise
+        hash_array[replaced] = self.pack(self.draw_hashes(random, int(replaced.sum())))
+        return unpack_hashes(hash_array, offsets)
+
+
+def fill(db, synthesizer: FingerprintSynthesizer, song_ids: list, rows: int, target_rows: int, bulk: bool) -> tuple:
+    """
+    Adds songs until the table holds target_rows fingerprints.
+
+    :return: the number of fingerprints stored and the seconds spent inserting them.
+    """
+    insert_time = 0
+    while rows < target_rows:
+        index = len(song_ids)
+        hash_array, offsets, _ = synthesizer.song(index)
+        hashes = None if bulk else unpack_hashes(hash_array, offsets)
+
+        # only storing the song is measured, making it up is not.
+        t = perf_counter()
+        if bulk:
+            song_id = db.insert_song_hash_arrays(f"synthetic {index}", f"{index:040x}", hash_array, offsets)
+        else:
+            song_id = db.insert_song_hashes(f"synthetic {index}", f"{index:040x}", hashes)
+        insert_time += perf_counter() - t
+
+        song_ids.append(song_id)
+        rows += len(offsets)
+        if len(song_ids) % 100 == 0:
+            print(f"{len(song_ids)} songs, {rows} fingerprints")
+
+    return rows, insert_time
+
+
+def measure_queries(db, synthesizer: FingerprintSynthesizer, song_ids: list, queries: int, seconds: float,
+                    noise: float, seed: int) -> dict:
+    """
+    Looks up clips of random songs and times return_matches.
+
+    :return: the latency percentiles, the rows matched and how many clips were lined up with their song.
+    """
+    random = np.random.RandomState([seed, 1 << 30])
+    latencies = []
+    matched_rows = found = 0
+    for query in range(queries):
+        song_index = random.randint(len(song_ids))
+        hashes = synthesizer.clip(query, song_index, seconds, noise)
+
+        t = perf_counter()
+        matches, _ = db.return_matches(hashes)
+        latencies.append(perf_counter() - t)
+
+        matched_rows += len(matches)
+        # the most common (song, offset difference) is what align_matches would return.
+        if matches and Counter(matches).most_common(1)[0][0][0] == song_ids[song_index]:
+            found += 1
+
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1000
+    return {
+        "p50_ms": round(p50, 3),
+        "p95_ms": round(p95, 3),
+        "p99_ms": round(p99, 3),
+        "matched_rows": matched_rows // queries,
+        "found": round(found / queries, 4)
+    }
+
+
+def run_benchmark(db, synthesizer: FingerprintSynthesizer, steps: list, queries: int, query_seconds: float,
+                  noise: float, bulk: bool) -> list:
+    results = []
+    song_ids = []
+    rows = 0
+    for target_rows in steps:
+        previous_rows = rows
+        rows, insert_time = fill(db, synthesizer, song_ids, rows, target_rows, bulk)
+        data_size, index_size = db.get_fingerprints_size()
+        result = {
+            "rows": rows,
+            "songs": len(song_ids),
+            "insert_time": round(insert_time, 3),
+            "rows_per_second": round((rows - previous_rows) / insert_time) if insert_time else None,
+            "data_bytes": data_size,
+            "index_bytes": index_size,
+            "bytes_per_row": round((data_size + index_size) / rows, 1) if rows else 0
+        }
+        result.update(measure_queries(db, synthesizer, song_ids, queries, query_seconds, noise, synthesizer.seed))
+        results.append(result)
+        print_step(result)
+
+    return results
+
+
+def print_step(result: dict) -> None:
+    rate = f"{result['rows_per_second']}/s" if result["rows_per_second"] is not None else "-"
+    print(f"{result['rows']} fingerprints ({result['songs']} songs): {rate} inserted, "
+          f"{(result['data_bytes'] + result['index_bytes']) / 1024 ** 2:.1f}MB "
+          f"({result['index_bytes'] / 1024 ** 2:.1f}MB of indexes), return_matches "
+          f"p50 {result['p50_ms']}ms p95 {result['p95_ms']}ms p99 {result['p99_ms']}ms")
+
+
+def print_report(results: list) -> None:
+    print(f"\n{'fingerprints':>14}{'inserts/s':>12}{'data':>10}{'indexes':>10}{'bytes/row':>11}"
+          f"{'p50':>10}{'p95':>10}{'p99':>10}{'rows':>8}{'found':>8}")
+    for result in results:
+        rate = result["rows_per_second"] if result["rows_per_second"] is not None else "-"
+        print(f"{result['rows']:>14}{rate:>12}{result['data_bytes'] / 1024 ** 2:>8.1f}MB"
+              f"{result['index_bytes'] / 1024 ** 2:>8.1f}MB{result['bytes_per_row']:>11}"
+              f"{result['p50_ms']:>8.1f}ms{result['p95_ms']:>8.1f}ms{result['p99_ms']:>8.1f}ms"
+              f"{result['matched_rows']:>8}{result['found']:>8.0%}")
+
+
+def plot(results: list, path: str, title: str) -> None:
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    rows = [result["rows"] for result in results]
+    fig, (ingest, size, latency) = plt.subplots(1, 3, figsize=(15, 4.5))
+    fig.suptitle(title)
+
+    ingest.plot(rows, [result["rows_per_second"] or 0 for result in results], marker="o")
+    ingest.set_ylabel("fingerprints inserted per second")
+
+    size.plot(rows, [result["data_bytes"] / 1024 ** 2 for result in results], marker="o", label="data")
+    size.plot(rows, [result["index_bytes"] / 1024 ** 2 for result in results], marker="o", label="indexes")
+    size.set_ylabel("MB")
+    size.set_yscale("log")
+    size.legend()
+
+    for percentile in ("p50", "p95", "p99"):
+        latency.plot(rows, [result[f"{percentile}_ms"] for result in results], marker="o", label=percentile)
+    latency.set_ylabel("return_matches latency (ms)")
+    latency.set_yscale("log")
+    latency.legend()
+
+    for axis in (ingest, size, latency):
+        axis.set_xscale("log")
+        axis.set_xlabel("fingerprints stored")
+        axis.grid(True, which="both", alpha=0.3)
+
+    fig.tight_layout()
+    fig.savefig(path)
+    print(f"Curves saved to {path}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Measures ingest throughput, size and query latency "
+                                                 "of a backend as the fingerprints table grows.")
+    parser.add_argument("-c", "--config", default=None,
+                        help="Config file with the database to use, as for dejavu.py. The in-memory one by default.")
+    parser.add_argument("-r", "--rows", nargs="+", type=float, default=[1e5, 1e6],
+                        help="Table sizes at which measures are taken, e.g. 1e6 1e7 1e8 1e9.")
+    parser.add_argument("--empty", action="store_true", help="Empties the database first, ALL ITS DATA IS LOST.")
+    parser.add_argument("--bulk", action="store_true",
+                        help="Stores songs through insert_song_hash_arrays, the bulk loading path of shards.")
+    parser.add_argument("-s", "--hashes-per-song", type=int, default=50000, help="Average fingerprints per song.")
+    parser.add_argument("-v", "--vocabulary", type=int, default=2 ** 30, help="Number of different hashes.")
+    parser.add_argument("-z", "--zipf", type=float, default=0.8, help="Exponent of the Zipf distribution of hashes.")
+    parser.add_argument("-q", "--queries", type=int, default=100, help="Queries at every size.")
+    parser.add_argument("--query-seconds", type=float, default=5, help="Length of the clips looked up.")
+    parser.add_argument("--noise", type=float, default=0.5, help="Fraction of the hashes of a clip made up.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the songs and queries.")
+    parser.add_argument("-o", "--output", default=None, help="Saves the results as JSON.")
+    parser.add_argument("-p", "--plot", default=None, help="Saves the curves to this image.")
+    args = parser.parse_args()
+
+    config = {"database_type": "memory"}
+    if args.config:
+        with open(args.config) as f:
+            config = json.load(f)
+
+    db = get_database(config.get("database_type", "mysql").lower())(**config.get("database", {}))
+    db.setup()
+    if args.empty:
+        db.empty()
+    elif db.get_num_songs():
+        print("The database already has songs, use a dedicated one or empty it with --empty.")
+        sys.exit(1)
+
+    synthesizer = FingerprintSynthesizer(args.hashes_per_song, args.vocabulary, args.zipf, args.seed)
+    steps = sorted(int(rows) for rows in args.rows)
+    results = run_benchmark(db, synthesizer, steps, args.queries, args.query_seconds, args.noise, args.bulk)
+    print_report(results)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"database_type": db.type, "parameters": vars(args), "steps": results}, f, indent=2)
+    if args.plot:
+        plot(results, args.plot, f"{db.type} backend")
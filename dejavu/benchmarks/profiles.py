@@ -0,0 +1,134 @@
+"""
+Compares the fingerprinting profiles on the dataset/ songs.
+
+Every profile gets its own in-memory database: the original songs are fingerprinted into it
+and then every clip is recognized against it. For each profile it reports the CPU time spent
+fingerprinting, the number of fingerprints stored (what the database size grows with) and
+how many clips were recognized as the right song.
+
+Usage:
+  python benchmarks/profiles.py                        # all the profiles on dataset/
+  python benchmarks/profiles.py -p default mono_11k -n 5 -o profiles.json
+"""
+
+import argparse
+import glob
+import json
+import os
+import sys
+from time import process_time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from dejavu import Dejavu  # noqa: E402
+from dejavu.config.settings import (FINGERPRINT_PROFILES, RESULTS,  # noqa: E402
+                                    SONG_NAME)
+from dejavu.logic import decoder  # noqa: E402
+from dejavu.logic.recognizer.file_recognizer import FileRecognizer  # noqa: E402
+
+
+def discover_songs(dataset_dir: str, max_songs: int = None):
+    """
+    Finds the songs with an original and at least one clip, in the dataset/ folder structure.
+
+    :param dataset_dir: path to the dataset folder.
+    :param max_songs: maximum number of songs to use, None means all of them.
+    :return: a list of (song name, original path, clip paths) tuples.
+    """
+    songs = []
+    for song_name in sorted(os.listdir(dataset_dir)):
+        original = os.path.join(dataset_dir, song_name, "original.mp3")
+        # clips are MP3, or WAV when generated with generate_clips.py --wav.
+        clips_pattern = os.path.join(dataset_dir, song_name, "remix", "clips_*", "clip_*")
+        clips = sorted(path for extension in ("mp3", "wav") for path in glob.glob(f"{clips_pattern}.{extension}"))
+        if os.path.isfile(original) and clips:
+            songs.append((song_name, original, clips))
+
+    return songs[:max_songs] if max_songs else songs
+
+
+def benchmark_profile(profile_name: str, songs) -> dict:
+    """
+    Fingerprints the originals and recognizes the clips with a single profile.
+
+    :param profile_name: name of the profile, as in FINGERPRINT_PROFILES.
+    :param songs: songs as returned by discover_songs.
+    :return: a dictionary with the measures taken.
+    """
+    djv = Dejavu({"database_type": "memory", "fingerprint_profile": profile_name})
+
+    ingest_cpu = 0
+    for song_name, original, _ in songs:
+        # decoding runs on ffmpeg, only preparing the audio and fingerprinting are measured.
+        channels, fs, file_hash = decoder.read(original)
+
+        t = process_time()
+        channels, fs = decoder.prepare_channels(channels, fs, djv.profile)
+        hashes = set()
+        for channel in channels:
+            fingerprints, _ = djv.generate_fingerprints(channel, Fs=fs)
+            hashes |= set(fingerprints)
+        ingest_cpu += process_time() - t
+
+        sid = djv.db.insert_song(song_name, file_hash, len(hashes))
+        djv.db.insert_hashes(sid, hashes)
+        djv.db.set_song_fingerprinted(sid)
+        print(f"[{profile_name}] {song_name}: {len(hashes)} fingerprints")
+
+    query_cpu = 0
+    clips = recognized = 0
+    for song_name, _, song_clips in songs:
+        for clip in song_clips:
+            t = process_time()
+            matches = djv.recognize(FileRecognizer, clip)[RESULTS]
+            query_cpu += process_time() - t
+
+            clips += 1
+            if matches and matches[0][SONG_NAME].decode("utf8") == song_name:
+                recognized += 1
+
+    return {
+        "profile": profile_name,
+        "songs": len(songs),
+        "fingerprints": djv.db.get_num_fingerprints(),
+        "ingest_cpu": round(ingest_cpu, 3),
+        "clips": clips,
+        "recognized": recognized,
+        "accuracy": round(recognized / clips, 4) if clips else 0,
+        "query_cpu": round(query_cpu, 3)
+    }
+
+
+def print_report(results) -> None:
+    baseline = results[0]
+    print(f"\n{'profile':<12}{'fingerprints':>14}{'size':>8}{'ingest cpu':>12}{'cpu':>8}"
+          f"{'query cpu':>11}{'accuracy':>10}")
+    for result in results:
+        size = result["fingerprints"] / baseline["fingerprints"] if baseline["fingerprints"] else 0
+        cpu = result["ingest_cpu"] / baseline["ingest_cpu"] if baseline["ingest_cpu"] else 0
+        print(f"{result['profile']:<12}{result['fingerprints']:>14}{size:>8.0%}{result['ingest_cpu']:>11.1f}s"
+              f"{cpu:>8.0%}{result['query_cpu']:>10.1f}s{result['accuracy']:>10.1%}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compares the CPU time, database size and accuracy "
+                                                 "of the fingerprinting profiles.")
+    parser.add_argument("-d", "--dataset", default="dataset", help="Path to the dataset folder.")
+    parser.add_argument("-p", "--profiles", nargs="+", default=list(FINGERPRINT_PROFILES),
+                        choices=list(FINGERPRINT_PROFILES),
+                        help="Profiles to compare, the first one is the baseline.")
+    parser.add_argument("-n", "--songs", type=int, default=None, help="Maximum number of songs to use.")
+    parser.add_argument("-o", "--output", default=None, help="Saves the results as JSON.")
+    args = parser.parse_args()
+
+    songs = discover_songs(args.dataset, args.songs)
+    if not songs:
+        print(f"No songs with clips found in {args.dataset}")
+        sys.exit(1)
+
+    results = [benchmark_profile(profile_name, songs) for profile_name in args.profiles]
+    print_report(results)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,275 @@
+"""
+Times every stage of fingerprinting and matching on its own, on synthetic audio.
+
+The audio is generated from a fixed seed, a sequence of notes with a few partials each over
+some noise, so every run works on exactly the same samples without any dataset. The stages are
+the ones a recognition goes through: decoder.read of a wav file, the spectrogram (mlab.specgram
+and its log), get_2D_peaks, generate_hashes, return_matches against an in-memory database
+holding the song among random decoys, and align_matches.
+
+For each stage it reports the median and best wall time over the runs, the peak of the memory
+traced by tracemalloc and the number of memory blocks the stage left allocated, and the peak
+RSS of a process running the stage once (Linux and macOS only). Results are saved as JSON and
+can be compared against a previous run, any stage slower than the threshold fails the run.
+
+Usage:
+  python benchmarks/stages.py -o before.json
+  python benchmarks/stages.py -o after.json --compare before.json --threshold 0.1
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+import wave
+from time import perf_counter
+from typing import Optional
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from dejavu import Dejavu  # noqa: E402
+from dejavu.config.settings import (DEFAULT_FINGERPRINT_PROFILE,  # noqa: E402
+                                    FINGERPRINT_PROFILES)
+from dejavu.logic import decoder  # noqa: E402
+from dejavu.logic.fingerprint import (generate_hashes, get_2D_peaks,  # noqa: E402
+                                      get_spectrogram)
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Bumped whenever the stages or the way they are measured change, results of different
+# versions are not compared.
+RESULTS_FORMAT = 1
+
+
+def synthesize(seconds: float, fs: int = 44100, channels: int = 2, seed: int = 0) -> np.ndarray:
+    """
+    Generates music-like audio: a quarter of a second notes with a few partials each, over noise.
+
+    :param seconds: length of the audio.
+    :param fs: sampling rate.
+    :param channels: number of channels, each gets its own noise.
+    :param seed: seed of the notes and the noise, the same seed gives the same samples.
+    :return: a (channels, samples) int16 array.
+    """
+    random = np.random.RandomState(seed)
+    note_samples = fs // 4
+    notes = int(np.ceil(seconds * 4))
+    t = np.arange(note_samples) / fs
+    envelope = np.exp(-4 * t)
+
+    signal = np.zeros(notes * note_samples)
+    for note in range(notes):
+        # MIDI notes from 40 to 90, with their first partials.
+        frequency = 440 * 2 ** ((random.randint(40, 90) - 69) / 12)
+        tone = sum(np.sin(2 * np.pi * frequency * partial * t) / partial for partial in range(1, 5))
+        signal[note * note_samples: (note + 1) * note_samples] = tone * envelope
+
+    signal = signal[:int(seconds * fs)]
+    audio = [signal + 0.05 * random.standard_normal(len(signal)) for _ in range(channels)]
+    audio = np.array(audio) / np.abs(audio).max()
+    return (audio * 0.8 * 32767).astype(np.int16)
+
+
+def write_wav(path: str, audio: np.ndarray, fs: int) -> None:
+    with wave.open(path, "wb") as f:
+        f.setnchannels(audio.shape[0])
+        f.setsampwidth(2)
+        f.setframerate(fs)
+        f.writeframes(audio.T.tobytes())
+
+
+def prepare(seconds: float, query_seconds: float, decoys: int, workdir: str):
+    """
+    Builds the input of every stage, from the output of the previous one.
+
+    :param seconds: length of the synthetic song.
+    :param query_seconds: length of the query, taken from the middle of the song.
+    :param decoys: number of random songs stored next to the synthetic one.
+    :param workdir: directory where the wav file is written.
+    :return: a dictionary of stage name => function running the stage once.
+    """
+    profile = FINGERPRINT_PROFILES[DEFAULT_FINGERPRINT_PROFILE]
+    wsize, wratio = profile["window_size"], profile["overlap_ratio"]
+    fs = 44100
+
+    audio = synthesize(seconds, fs)
+    wav_path = os.path.join(workdir, "synthetic.wav")
+    write_wav(wav_path, audio, fs)
+
+    channel = audio[0]
+    arr2D = get_spectrogram(channel, Fs=fs, wsize=wsize, wratio=wratio)
+    peaks = get_2D_peaks(arr2D)
+    hashes = generate_hashes(peaks)
+
+    djv = Dejavu({"database_type": "memory"})
+    djv.db.insert_song_hashes("synthetic", "0" * 40, hashes)
+    random = np.random.RandomState(1)
+    for decoy in range(decoys):
+        values = random.randint(0, 2 ** 62, len(hashes), dtype=np.int64)
+        offsets = random.randint(0, 10000, len(hashes))
+        decoy_hashes = [(f"{value:020x}", int(offset)) for value, offset in zip(values, offsets)]
+        djv.db.insert_song_hashes(f"decoy {decoy}", f"{decoy + 1:040x}", decoy_hashes)
+
+    start = int((seconds - query_seconds) / 2 * fs)
+    query = generate_hashes(get_2D_peaks(get_spectrogram(channel[start: start + int(query_seconds * fs)],
+                                                         Fs=fs, wsize=wsize, wratio=wratio)))
+    matches, dedup_hashes = djv.db.return_matches(query)
+
+    return {
+        "decoder.read": lambda: decoder.read(wav_path),
+        "spectrogram": lambda: get_spectrogram(channel, Fs=fs, wsize=wsize, wratio=wratio),
+        "get_2D_peaks": lambda: get_2D_peaks(arr2D),
+        "generate_hashes": lambda: generate_hashes(peaks),
+        "return_matches": lambda: djv.db.return_matches(query),
+        "align_matches": lambda: djv.align_matches(matches, dedup_hashes, len(query))
+    }
+
+
+def time_stage(run, runs: int) -> dict:
+    times = []
+    for _ in range(runs):
+        t = perf_counter()
+        run()
+        times.append(perf_counter() - t)
+    return {"median": statistics.median(times), "best": min(times), "runs": runs}
+
+
+def trace_stage(run) -> dict:
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    if hasattr(tracemalloc, "reset_peak"):  # Python 3.9+, otherwise the peak includes the snapshot.
+        tracemalloc.reset_peak()
+    result = run()  # noqa: F841, kept alive so what the stage returns is counted.
+    _, peak = tracemalloc.get_traced_memory()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    blocks = sum(stat.count_diff for stat in after.compare_to(before, "filename") if stat.count_diff > 0)
+    return {"peak_traced_bytes": peak, "allocated_blocks": blocks}
+
+
+def _rss_child(run, connection) -> None:
+    start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    run()
+    connection.send((start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+    connection.close()
+
+
+def rss_stage(run) -> dict:
+    """
+    Runs a stage once in a forked process, so its peak RSS is not hidden by the stages before.
+    """
+    if resource is None or "fork" not in multiprocessing.get_all_start_methods():
+        return {"peak_rss_kb": None, "rss_growth_kb": None}
+
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+    unit = 1024 if sys.platform == "darwin" else 1
+    context = multiprocessing.get_context("fork")
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=_rss_child, args=(run, sender))
+    process.start()
+    start, peak = receiver.recv()
+    process.join()
+    return {"peak_rss_kb": peak // unit, "rss_growth_kb": (peak - start) // unit}
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(__file__),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(seconds: float, query_seconds: float, decoys: int, runs: int) -> dict:
+    with tempfile.TemporaryDirectory() as workdir:
+        stages = prepare(seconds, query_seconds, decoys, workdir)
+
+        results = {}
+        for name, run in stages.items():
+            print(f"Benchmarking {name}")
+            results[name] = dict(time_stage(run, runs), **trace_stage(run), **rss_stage(run))
+
+    return {
+        "format": RESULTS_FORMAT,
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "parameters": {"seconds": seconds, "query_seconds": query_seconds, "decoys": decoys, "runs": runs},
+        "stages": results
+    }
+
+
+def print_report(results: dict) -> None:
+    print(f"\n{'stage':<18}{'median':>10}{'best':>10}{'traced peak':>13}{'blocks':>9}{'peak rss':>11}")
+    for name, stage in results["stages"].items():
+        rss = f"{stage['peak_rss_kb'] / 1024:.0f}MB" if stage["peak_rss_kb"] is not None else "-"
+        print(f"{name:<18}{stage['median'] * 1000:>8.1f}ms{stage['best'] * 1000:>8.1f}ms"
+              f"{stage['peak_traced_bytes'] / 1024 ** 2:>11.1f}MB{stage['allocated_blocks']:>9}{rss:>11}")
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> bool:
+    """
+    Compares the median time of every stage with a previous run.
+
+    :param results: results of this run.
+    :param baseline: results of the previous run.
+    :param threshold: slowdown past which a stage is a regression, 0.1 is 10% slower.
+    :return: True if no stage regressed.
+    """
+    if baseline.get("format") != results["format"] or baseline.get("parameters") != results["parameters"]:
+        print("The baseline was taken with another version of the benchmark or other parameters, "
+              "it can't be compared.")
+        return False
+
+    print(f"\nCompared with {baseline.get('commit') or 'the baseline'}:")
+    passed = True
+    for name, stage in results["stages"].items():
+        before = baseline["stages"].get(name)
+        if before is None:
+            continue
+        change = stage["median"] / before["median"] - 1
+        regressed = change > threshold
+        passed &= not regressed
+        print(f"{name:<18}{before['median'] * 1000:>8.1f}ms -> {stage['median'] * 1000:>8.1f}ms{change:>+9.1%}"
+              f"{'  REGRESSION' if regressed else ''}")
+    return passed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Times every fingerprinting and matching stage on synthetic audio.")
+    parser.add_argument("-s", "--seconds", type=float, default=30, help="Length of the synthetic song.")
+    parser.add_argument("-q", "--query-seconds", type=float, default=5, help="Length of the query.")
+    parser.add_argument("-d", "--decoys", type=int, default=50,
+                        help="Random songs stored in the database next to the synthetic one.")
+    parser.add_argument("-r", "--runs", type=int, default=5, help="Times every stage is run.")
+    parser.add_argument("-o", "--output", default=None, help="Saves the results as JSON.")
+    parser.add_argument("-c", "--compare", default=None, help="Results of a previous run to compare with.")
+    parser.add_argument("-t", "--threshold", type=float, default=0.1,
+                        help="Slowdown of a stage reported as a regression, 0.1 is 10%% slower.")
+    args = parser.parse_args()
+
+    results = run_benchmark(args.seconds, args.query_seconds, args.decoys, args.runs)
+    print_report(results)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if not compare(results, baseline, args.threshold):
+            sys.exit(1)
@@ -0,0 +1,158 @@
+"""
+Measures how long dejavu takes to start, to keep the CLI and the worker processes quick.
+
+Each scenario runs in fresh Python processes: importing dejavu, creating a Dejavu instance on
+the in-memory database and running dejavu.py --help. For each one it reports the median wall
+time of the whole process, interpreter startup included, the median time spent in the
+statement itself, and the heavy modules it loaded. Those only needed to decode, fingerprint,
+plot, record from the microphone or talk to another database must not be loaded by any of
+these scenarios, the run fails if one of them is. Results are saved as JSON and can be compared
+against a previous run as benchmarks/stages.py does.
+
+Usage:
+  python benchmarks/startup.py -o before.json
+  python benchmarks/startup.py -o after.json --compare before.json --threshold 0.2
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+from time import perf_counter
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+# Bumped whenever the scenarios or the way they are measured change, results of different
+# versions are not compared.
+RESULTS_FORMAT = 1
+
+# Modules only some commands need, none of the scenarios may import them.
+HEAVY_MODULES = ["matplotlib", "matplotlib.pyplot", "scipy.signal", "scipy.ndimage", "pydub", "pyaudio",
+                 "mysql.connector", "psycopg2"]
+
+SCENARIOS = {
+    "import dejavu": "import dejavu",
+    "Dejavu(memory)": "from dejavu import Dejavu; Dejavu({'database_type': 'memory'})",
+    "dejavu.py --help": ("import runpy; sys.argv = ['dejavu.py', '--help']\n"
+                         "try:\n"
+                         "    runpy.run_path(os.path.join(root, 'dejavu.py'), run_name='__main__')\n"
+                         "except SystemExit:\n"
+                         "    pass")
+}
+
+CHILD = """import json, os, sys
+from time import perf_counter
+root = {root!r}
+sys.path.insert(0, root)
+os.chdir(root)
+sys.stdout = open(os.devnull, "w")
+t = perf_counter()
+{statement}
+t = perf_counter() - t
+sys.stdout = sys.__stdout__
+print(json.dumps({{"seconds": t, "modules": [module for module in {heavy!r} if module in sys.modules]}}))
+"""
+
+
+def run_scenario(statement: str) -> dict:
+    code = CHILD.format(root=ROOT, statement=statement, heavy=HEAVY_MODULES)
+    t = perf_counter()
+    output = subprocess.check_output([sys.executable, "-c", code], cwd=ROOT)
+    wall_time = perf_counter() - t
+    result = json.loads(output.decode().strip().splitlines()[-1])
+    return dict(result, wall_seconds=wall_time)
+
+
+def run_benchmark(runs: int) -> dict:
+    results = {}
+    for name, statement in SCENARIOS.items():
+        print(f"Benchmarking {name}")
+        # the first run warms the file system cache and writes the bytecode, it is not counted.
+        run_scenario(statement)
+        samples = [run_scenario(statement) for _ in range(runs)]
+        results[name] = {
+            "wall_median": statistics.median(sample["wall_seconds"] for sample in samples),
+            "statement_median": statistics.median(sample["seconds"] for sample in samples),
+            "heavy_modules": sorted({module for sample in samples for module in sample["modules"]}),
+            "runs": runs
+        }
+
+    # the bare interpreter, to tell its startup apart from dejavu's.
+    baseline = [run_scenario("pass")["wall_seconds"] for _ in range(runs)]
+    return {
+        "format": RESULTS_FORMAT,
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "interpreter_median": statistics.median(baseline),
+        "scenarios": results
+    }
+
+
+def print_report(results: dict) -> None:
+    print(f"\nPython alone starts in {results['interpreter_median'] * 1000:.0f}ms")
+    print(f"{'scenario':<20}{'process':>10}{'statement':>11}  heavy modules loaded")
+    for name, scenario in results["scenarios"].items():
+        print(f"{name:<20}{scenario['wall_median'] * 1000:>8.0f}ms{scenario['statement_median'] * 1000:>9.0f}ms"
+              f"  {', '.join(scenario['heavy_modules']) or '-'}")
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> bool:
+    """
+    Compares the median process time of every scenario with a previous run.
+
+    :param results: results of this run.
+    :param baseline: results of the previous run.
+    :param threshold: slowdown past which a scenario is a regression, 0.2 is 20% slower.
+    :return: True if no scenario regressed.
+    """
+    if baseline.get("format") != results["format"]:
+        print("The baseline was taken with another version of the benchmark, it can't be compared.")
+        return False
+
+    print("\nCompared with the baseline:")
+    passed = True
+    for name, scenario in results["scenarios"].items():
+        before = baseline["scenarios"].get(name)
+        if before is None:
+            continue
+        change = scenario["wall_median"] / before["wall_median"] - 1
+        regressed = change > threshold
+        passed &= not regressed
+        print(f"{name:<20}{before['wall_median'] * 1000:>8.0f}ms -> {scenario['wall_median'] * 1000:>6.0f}ms"
+              f"{change:>+9.1%}{'  REGRESSION' if regressed else ''}")
+    return passed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Measures how long dejavu takes to start.")
+    parser.add_argument("-r", "--runs", type=int, default=10, help="Processes started for every scenario.")
+    parser.add_argument("-o", "--output", default=None, help="Saves the results as JSON.")
+    parser.add_argument("-c", "--compare", default=None, help="Results of a previous run to compare with.")
+    parser.add_argument("-t", "--threshold", type=float, default=0.2,
+                        help="Slowdown of a scenario reported as a regression, 0.2 is 20%% slower.")
+    args = parser.parse_args()
+
+    results = run_benchmark(args.runs)
+    print_report(results)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    passed = True
+    loaded = {name: scenario["heavy_modules"] for name, scenario in results["scenarios"].items()
+              if scenario["heavy_modules"]}
+    for name, modules in loaded.items():
+        print(f"{name} loaded {', '.join(modules)}, they should only be imported where they are used.")
+        passed = False
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        passed &= compare(results, baseline, args.threshold)
+
+    if not passed:
+        sys.exit(1)
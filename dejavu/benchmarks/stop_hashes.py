@@ -0,0 +1,113 @@
+"""
+Reports what pruning the hashes found in many songs does to the dataset/ songs.
+
+The originals and clips are fingerprinted once. Then, for every threshold, a new in-memory
+database is filled with the originals, the hashes found in more songs than the threshold are
+pruned and every clip is recognized against it. For each threshold it reports the hashes
+pruned, the fingerprints left (what the database size grows with), the rows brought back by
+the lookups, the query time and how many clips were recognized as the right song.
+
+Usage:
+  python benchmarks/stop_hashes.py                     # thresholds of 2, 5, 10 and 25 songs
+  python benchmarks/stop_hashes.py -t 3 10 -n 20 -o stop_hashes.json
+"""
+
+import argparse
+import json
+import os
+import sys
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from profiles import discover_songs  # noqa: E402
+
+from dejavu import Dejavu  # noqa: E402
+from dejavu.config.settings import SONG_NAME  # noqa: E402
+
+
+def benchmark_threshold(max_songs: int, songs, fingerprints, clip_fingerprints) -> dict:
+    """
+    Fills a database with the originals, prunes it and recognizes the clips.
+
+    :param max_songs: hashes found in more songs than this are pruned, None to keep them all.
+    :param songs: songs as returned by discover_songs.
+    :param fingerprints: hashes of each original, by song name.
+    :param clip_fingerprints: (song name, hashes) of each clip.
+    :return: a dictionary with the measures taken.
+    """
+    djv = Dejavu({"database_type": "memory"})
+    for song_name, _, _ in songs:
+        hashes, file_hash = fingerprints[song_name]
+        djv.db.insert_song_hashes(song_name, file_hash, hashes)
+
+    pruned = djv.prune_common_hashes(max_songs) if max_songs is not None else {"hashes": 0, "fingerprints": 0}
+
+    query_time = 0
+    rows = recognized = 0
+    for song_name, hashes in clip_fingerprints:
+        t = perf_counter()
+        matches, dedup_hashes, _ = djv.find_matches(hashes)
+        results = djv.align_matches(matches, dedup_hashes, len(hashes))
+        query_time += perf_counter() - t
+
+        rows += len(matches)
+        if results and results[0][SONG_NAME].decode("utf8") == song_name:
+            recognized += 1
+
+    clips = len(clip_fingerprints)
+    return {
+        "max_songs": max_songs,
+        "pruned_hashes": pruned["hashes"],
+        "fingerprints": djv.db.get_num_fingerprints(),
+        "clips": clips,
+        "rows": rows,
+        "recognized": recognized,
+        "accuracy": round(recognized / clips, 4) if clips else 0,
+        "query_time": round(query_time, 3)
+    }
+
+
+def print_report(results) -> None:
+    baseline = results[0]
+    print(f"\n{'max songs':<11}{'pruned':>10}{'fingerprints':>14}{'size':>8}{'rows':>12}"
+          f"{'query time':>12}{'accuracy':>10}")
+    for result in results:
+        size = result["fingerprints"] / baseline["fingerprints"] if baseline["fingerprints"] else 0
+        max_songs = "-" if result["max_songs"] is None else result["max_songs"]
+        print(f"{max_songs:<11}{result['pruned_hashes']:>10}{result['fingerprints']:>14}{size:>8.0%}"
+              f"{result['rows']:>12}{result['query_time']:>11.2f}s{result['accuracy']:>10.1%}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compares the database size, query time and accuracy "
+                                                 "of several stop hash thresholds.")
+    parser.add_argument("-d", "--dataset", default="dataset", help="Path to the dataset folder.")
+    parser.add_argument("-t", "--thresholds", nargs="+", type=int, default=[2, 5, 10, 25],
+                        help="Numbers of songs past which hashes are pruned.")
+    parser.add_argument("-n", "--songs", type=int, default=None, help="Maximum number of songs to use.")
+    parser.add_argument("-o", "--output", default=None, help="Saves the results as JSON.")
+    args = parser.parse_args()
+
+    songs = discover_songs(args.dataset, args.songs)
+    if not songs:
+        print(f"No songs with clips found in {args.dataset}")
+        sys.exit(1)
+
+    fingerprints = {
+        song_name: Dejavu.get_file_fingerprints(original, None, print_output=True)
+        for song_name, original, _ in songs
+    }
+    clip_fingerprints = [
+        (song_name, Dejavu.get_file_fingerprints(clip, None)[0])
+        for song_name, _, clips in songs for clip in clips
+    ]
+
+    # the first run keeps every hash, it is the baseline.
+    results = [benchmark_threshold(max_songs, songs, fingerprints, clip_fingerprints)
+               for max_songs in [None] + args.thresholds]
+    print_report(results)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
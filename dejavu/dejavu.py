@@ -5,25 +5,50 @@ from argparse import RawTextHelpFormatter
 from os.path import isdir
 
 from dejavu import Dejavu
+from dejavu.config.settings import (DEFAULT_FINGERPRINT_PROFILE,
+                                    DEFAULT_SERVER_ADDRESS,
+                                    FINGERPRINT_CACHE_SIZE)
+from dejavu.logic.fingerprint_cache import FingerprintCache
 from dejavu.logic.recognizer.file_recognizer import FileRecognizer
-from dejavu.logic.recognizer.microphone_recognizer import MicrophoneRecognizer
+from dejavu.logic.shards import export_shards
+
+# the microphone recognizer and the server are imported by their commands, the others work without
+# pyaudio and start without asyncio.
 
 DEFAULT_CONFIG_FILE = "dejavu.cnf.SAMPLE"
 
 
-def init(configpath):
+def load_config(configpath):
     """
     Load config from a JSON file
     """
     try:
         with open(configpath) as f:
-            config = json.load(f)
+            return json.load(f)
     except IOError as err:
         print(f"Cannot open configuration: {str(err)}. Exiting")
         sys.exit(1)
 
+
+def init(configpath):
     # create a Dejavu instance
-    return Dejavu(config)
+    return Dejavu(load_config(configpath))
+
+
+def export(configpath, directory, extension, output_dir):
+    """
+    Fingerprint a directory into shards, the database in the config is not used
+    """
+    config = load_config(configpath)
+    limit = config.get("fingerprint_limit", None)
+    cache_path = config.get("fingerprint_cache", None)
+    cache = FingerprintCache(
+        cache_path, config.get("fingerprint_cache_size", FINGERPRINT_CACHE_SIZE)) if cache_path else None
+
+    shard_paths = export_shards(directory, ["." + extension], output_dir,
+                                profile_name=config.get("fingerprint_profile", None) or DEFAULT_FINGERPRINT_PROFILE,
+                                limit=None if limit == -1 else limit, cache=cache)
+    print(f"Wrote {len(shard_paths)} shards to {output_dir}")
 
 
 if __name__ == '__main__':
@@ -45,9 +70,40 @@ if __name__ == '__main__':
                              'Usage: \n'
                              '--recognize mic number_of_seconds \n'
                              '--recognize file path/to/file \n')
+    parser.add_argument('-s', '--serve', nargs='?', const=DEFAULT_SERVER_ADDRESS,
+                        help='Run a recognition server keeping the database warm.\n'
+                             'Usages: \n'
+                             f'--serve (listens on {DEFAULT_SERVER_ADDRESS})\n'
+                             '--serve host:port\n'
+                             '--serve unix:/path/to/socket\n')
+    parser.add_argument('-e', '--export-shards', nargs=3,
+                        help='Fingerprint files in a directory into shard files,\n'
+                             'without connecting to the database.\n'
+                             'Usage: \n'
+                             '--export-shards /path/to/directory extension /path/to/shards\n')
+    parser.add_argument('-l', '--load-shards', nargs='+',
+                        help='Store the songs of shard files in the database.\n'
+                             'Usages: \n'
+                             '--load-shards /path/to/shards\n'
+                             '--load-shards shard1.npz shard2.npz\n')
+    parser.add_argument('--snapshot', nargs=1,
+                        help='Write every song and fingerprint of the database to a file.\n'
+                             'Usage: \n'
+                             '--snapshot /path/to/snapshot.zip\n')
+    parser.add_argument('--restore', nargs=1,
+                        help='Store the songs and fingerprints of a snapshot in the database.\n'
+                             'Usage: \n'
+                             '--restore /path/to/snapshot.zip\n')
+    parser.add_argument('--prune-hashes', nargs=1, type=int, metavar='MAX_SONGS',
+                        help='Delete the fingerprints of the hashes found in more than\n'
+                             'MAX_SONGS songs, and stop storing those hashes.\n'
+                             'Usage: \n'
+                             '--prune-hashes 50\n')
     args = parser.parse_args()
 
-    if not args.fingerprint and not args.recognize:
+    if not args.fingerprint and not args.recognize and not args.serve \
+            and not args.export_shards and not args.load_shards and not args.snapshot and not args.restore \
+            and not args.prune_hashes:
         parser.print_help()
         sys.exit(0)
 
@@ -55,6 +111,10 @@ if __name__ == '__main__':
     if config_file is None:
         config_file = DEFAULT_CONFIG_FILE
 
+    if args.export_shards:
+        export(config_file, *args.export_shards)
+        sys.exit(0)
+
     djv = init(config_file)
     if args.fingerprint:
         # Fingerprint all files in a directory
@@ -78,7 +138,31 @@ if __name__ == '__main__':
         opt_arg = args.recognize[1]
 
         if source in ('mic', 'microphone'):
+            from dejavu.logic.recognizer.microphone_recognizer import \
+                MicrophoneRecognizer
+
             songs = djv.recognize(MicrophoneRecognizer, seconds=opt_arg)
         elif source == 'file':
             songs = djv.recognize(FileRecognizer, opt_arg)
         print(songs)
+
+    elif args.load_shards:
+        djv.load_shards(args.load_shards)
+
+    elif args.snapshot:
+        info = djv.export_snapshot(args.snapshot[0])
+        print(f"Wrote {info['songs']} songs and {info['fingerprints']} fingerprints to {args.snapshot[0]}")
+
+    elif args.restore:
+        info = djv.import_snapshot(args.restore[0])
+        print(f"Restored {info['restored']} of the {info['songs']} songs in {args.restore[0]}")
+
+    elif args.prune_hashes:
+        pruned = djv.prune_common_hashes(args.prune_hashes[0])
+        print(f"Pruned {pruned['hashes']} hashes found in more than {args.prune_hashes[0]} songs, "
+              f"{pruned['fingerprints']} fingerprints deleted")
+
+    elif args.serve:
+        from dejavu.logic.server import RecognitionServer
+
+        RecognitionServer(djv, **djv.config.get("server", {})).serve(args.serve)
@@ -1,51 +1,254 @@
+import json
 import multiprocessing
 import os
 import sys
 import traceback
-from itertools import groupby
+from concurrent.futures import Executor, ProcessPoolExecutor
+from itertools import chain, groupby, islice
 from time import time
-from typing import Dict, List, Tuple
+from typing import Dict, Iterable, Iterator, List, Set, Tuple
+
+import numpy as np
 
 import dejavu.logic.decoder as decoder
-from dejavu.base_classes.base_database import get_database
-from dejavu.config.settings import (DEFAULT_FS, DEFAULT_OVERLAP_RATIO,
-                                    DEFAULT_WINDOW_SIZE, FIELD_FILE_SHA1,
-                                    FIELD_TOTAL_HASHES,
+from dejavu.base_classes.base_database import BaseDatabase, get_database
+from dejavu.config.settings import (DEFAULT_FINGERPRINT_PROFILE, DEFAULT_FS,
+                                    FIELD_FILE_SHA1, FIELD_TOTAL_HASHES,
+                                    FINGERPRINT_CACHE_SIZE,
+                                    FINGERPRINT_PROFILES,
                                     FINGERPRINTED_CONFIDENCE,
                                     FINGERPRINTED_HASHES, HASHES_MATCHED,
-                                    INPUT_CONFIDENCE, INPUT_HASHES, OFFSET,
-                                    OFFSET_SECS, SONG_ID, SONG_NAME, TOPN)
-from dejavu.logic.fingerprint import fingerprint
+                                    INPUT_CONFIDENCE, INPUT_HASHES,
+                                    METADATA_HASH_SAMPLE_RATIO,
+                                    METADATA_PROFILE, OFFSET, OFFSET_SECS,
+                                    RESULTS, SONG_ID, SONG_NAME,
+                                    TOPN, TRACE_SAMPLE_RATE,
+                                    TRACE_THRESHOLD)
+from dejavu.logic.fingerprint import (fingerprint, fingerprint_channels,
+                                      fingerprint_stream)
+from dejavu.logic.fingerprint_cache import FingerprintCache, settings_digest
+from dejavu.logic.hash_arrays import (iter_unpacked_hashes, pack_hashes,
+                                      receive_hash_arrays, share_hash_arrays,
+                                      share_hashes, skip_hash_arrays,
+                                      unpack_hashes)
+from dejavu.logic.hash_sampling import sample_hash_arrays, sample_hashes
+from dejavu.logic.manifest import IngestManifest
+from dejavu.logic.metrics import ALIGN, metrics
+from dejavu.logic.shards import find_shards, read_shard
+from dejavu.logic.snapshot import (export_snapshot, import_snapshot,
+                                   read_snapshot_info)
+from dejavu.logic.tracing import tracer
 
 
 class Dejavu:
+    # database, stop hashes and sample ratio of a fingerprinting pool process, see _init_db_worker.
+    _worker_db = None
+    _worker_stop_hashes = frozenset()
+    _worker_sample_ratio = 1
+
     def __init__(self, config):
         self.config = config
 
+        # if True the database is only queried: its tables are not created, songs left half
+        # fingerprinted are not cleaned up and nothing is written to it, so query processes start
+        # at once whatever the size of the catalogue and take no write locks. Storing or deleting
+        # songs then fails.
+        self.read_only = self.config.get("read_only", False)
+
         # initialize db
         db_cls = get_database(config.get("database_type", "mysql").lower())
 
         self.db = db_cls(**config.get("database", {}))
-        self.db.setup()
+        if not self.read_only:
+            self.db.setup()
 
         # if we should limit seconds fingerprinted,
         # None|-1 means use entire track
         self.limit = self.config.get("fingerprint_limit", None)
         if self.limit == -1:  # for JSON compatibility
             self.limit = None
-        self.__load_fingerprinted_audio_hashes()
 
-    def __load_fingerprinted_audio_hashes(self) -> None:
+        # number of processes fingerprinting segments of a single file in parallel,
+        # None|0 means channels are fingerprinted one after another.
+        self.fingerprint_workers = self.config.get("fingerprint_workers", None)
+        self._fingerprint_executor = None
+
+        # number of spectrogram frames fingerprinted at a time when adding songs, the files are
+        # read and stored in chunks so memory doesn't grow with their length. None|0 means whole files.
+        self.chunk_frames = self.config.get("fingerprint_chunk_frames", None)
+
+        # if True fingerprint_directory workers store their songs on their own database connection,
+        # the main process only keeps track of the progress.
+        self.worker_writes = self.config.get("fingerprint_worker_writes", False)
+
+        # file keeping the hashes of the files already seen, so unchanged files aren't read again
+        # when fingerprinting a directory. None means every file is hashed.
+        manifest_path = self.config.get("ingest_manifest", None)
+        self.manifest = IngestManifest(manifest_path) if manifest_path else None
+
+        # directory keeping the fingerprints of the files already fingerprinted or recognized,
+        # so they aren't computed again. None means nothing is cached.
+        cache_path = self.config.get("fingerprint_cache", None)
+        self.fingerprint_cache = FingerprintCache(
+            cache_path, self.config.get("fingerprint_cache_size", FINGERPRINT_CACHE_SIZE)) if cache_path else None
+
+        # hashes found in more songs than this are pruned as soon as a new song is stored,
+        # see prune_common_hashes. None means hashes are only pruned when asked to.
+        self.stop_hash_songs = self.config.get("stop_hash_songs", None)
+        # fingerprints come in lower case hexadecimal, they are only needed to store songs.
+        self.stop_hashes = set() if self.read_only else {hsh.lower() for hsh in self.db.get_stop_hashes()}
+
+        # query hashes estimated to have more fingerprints than this are skipped, the estimates are
+        # kept in a sketch filled from the whole database at the first lookup. None means every hash
+        # is looked up.
+        skip_hash_rows = self.config.get("skip_hash_rows", None)
+        if skip_hash_rows:
+            self.db.skip_common_hashes(skip_hash_rows)
+
+        # timings and counters of every stage, see dejavu.logic.metrics. They are written to
+        # metrics_file after every song stored and every recognition, and served over HTTP on
+        # metrics_address. With neither of them nothing is recorded.
+        self.metrics_file = self.config.get("metrics_file", None)
+        metrics_address = self.config.get("metrics_address", None)
+        if self.metrics_file or metrics_address:
+            metrics.enable()
+        if metrics_address:
+            metrics.serve(metrics_address)
+
+        # recognitions and fingerprinted files taking more than trace_threshold seconds are written
+        # to trace_file with the time spent in every step, see dejavu.logic.tracing. Only a
+        # trace_sample_rate fraction of them is traced. None means nothing is traced.
+        trace_file = self.config.get("trace_file", None)
+        if trace_file:
+            tracer.enable(trace_file, self.config.get("trace_threshold", TRACE_THRESHOLD),
+                          self.config.get("trace_sample_rate", TRACE_SAMPLE_RATE))
+
+        # song info by id, filled as songs show up in the results.
+        self.song_cache = {}
+        self.__reset_fingerprinted_audio_hashes()
+
+        # how the audio is prepared before fingerprinting, fixed for the life of the database.
+        self.profile = self.__load_profile(self.config.get("fingerprint_profile", None))
+
+        # one hash out of this many is stored and looked up, fixed for the life of the database too.
+        self.hash_sample_ratio = self.__load_hash_sample_ratio(self.config.get("hash_sample_ratio", None))
+
+    def __load_profile(self, profile_name: str = None) -> Dict[str, any]:
+        """
+        Brings the fingerprinting profile the database was built with, the first time a database
+        is used the requested profile is stored in it.
+
+        :param profile_name: name of the profile requested by the configuration, if any.
+        :return: the profile settings.
+        """
+        stored = self.db.get_metadata(METADATA_PROFILE)
+        if stored is not None:
+            profile = json.loads(stored)
+            if profile_name is not None and profile_name != profile["name"]:
+                raise ValueError(f"The database was fingerprinted with the '{profile['name']}' profile, "
+                                 f"it can't be used with the '{profile_name}' profile.")
+            return profile
+
+        profile_name = profile_name or DEFAULT_FINGERPRINT_PROFILE
+        if profile_name not in FINGERPRINT_PROFILES:
+            raise ValueError(f"Unknown fingerprint profile '{profile_name}', "
+                             f"choose one of: {', '.join(FINGERPRINT_PROFILES)}.")
+
+        # songs stored before profiles existed were fingerprinted with the default one.
+        if profile_name != DEFAULT_FINGERPRINT_PROFILE and self.db.get_num_songs():
+            raise ValueError(f"The database already holds songs fingerprinted with the "
+                             f"'{DEFAULT_FINGERPRINT_PROFILE}' profile.")
+
+        # The settings are stored and not only the name, so the database keeps working
+        # even if the profile definitions change later on.
+        profile = dict(FINGERPRINT_PROFILES[profile_name], name=profile_name)
+        if not self.read_only:
+            self.db.set_metadata(METADATA_PROFILE, json.dumps(profile))
+        return profile
+
+    def __load_hash_sample_ratio(self, ratio: int = None) -> int:
+        """
+        Brings the ratio of the hashes sampled in the database, the first time a database is used
+        the requested ratio is stored in it.
+
+        :param ratio: ratio requested by the configuration, if any.
+        :return: the sample ratio, 1 when every hash is kept.
+        """
+        stored = self.db.get_metadata(METADATA_HASH_SAMPLE_RATIO)
+        if stored is not None:
+            if ratio is not None and ratio != int(stored):
+                raise ValueError(f"The database keeps one hash out of {stored}, "
+                                 f"it can't be used keeping one hash out of {ratio}.")
+            return int(stored)
+
+        ratio = ratio or 1
+        if ratio < 1:
+            raise ValueError(f"The hash sample ratio has to be 1 or more, got {ratio}.")
+
+        # songs stored before sampling existed kept every hash.
+        if ratio != 1 and self.db.get_num_songs():
+            raise ValueError("The database already holds songs with every hash.")
+
+        if not self.read_only:
+            self.db.set_metadata(METADATA_HASH_SAMPLE_RATIO, str(ratio))
+        return ratio
+
+    def __reset_fingerprinted_audio_hashes(self) -> None:
         """
-        Keeps a dictionary with the hashes of the fingerprinted songs, in that way is possible to check
-        whether or not an audio file was already processed.
+        Forgets the fingerprinted songs, they are brought again from the database the next time
+        songs or songhashes_set are used. Processes only recognizing audio never bring them.
         """
+        self._songs = None
+        self._songhashes_set = None
+
+    def __load_fingerprinted_audio_hashes(self) -> None:
         # get songs previously indexed
-        self.songs = self.db.get_songs()
-        self.songhashes_set = set()  # to know which ones we've computed before
-        for song in self.songs:
-            song_hash = song[FIELD_FILE_SHA1]
-            self.songhashes_set.add(song_hash)
+        self._songs = self.db.get_songs()
+        self._songhashes_set = {song[FIELD_FILE_SHA1] for song in self._songs}
+
+    def __mark_fingerprinted(self, file_hash: str) -> None:
+        """
+        Adds a song just stored to the hashes of the fingerprinted songs, if they were brought
+        already. The list of songs is brought again the next time it is used.
+
+        :param file_hash: hash of the audio file.
+        """
+        if self._songhashes_set is not None:
+            self._songhashes_set.add(file_hash)
+        self._songs = None
+
+    @property
+    def songs(self) -> List[Dict[str, any]]:
+        """
+        The fingerprinted songs, brought from the database on first use.
+        """
+        if self._songs is None:
+            self.__load_fingerprinted_audio_hashes()
+        return self._songs
+
+    @property
+    def songhashes_set(self) -> Set[str]:
+        """
+        Hashes of the fingerprinted songs, in that way is possible to check whether or not an
+        audio file was already processed. Brought from the database on first use.
+        """
+        if self._songhashes_set is None:
+            self.__load_fingerprinted_audio_hashes()
+        return self._songhashes_set
+
+    def __check_writable(self) -> None:
+        if self.read_only:
+            raise ValueError("This Dejavu instance is read only, set read_only to False to store or delete songs.")
+
+    def get_fingerprint_executor(self) -> Executor:
+        """
+        Pool fingerprinting the segments of a single file, created on first use.
+
+        :return: the pool, or None if fingerprint_workers is not configured.
+        """
+        if self.fingerprint_workers and self._fingerprint_executor is None:
+            self._fingerprint_executor = ProcessPoolExecutor(self.fingerprint_workers)
+        return self._fingerprint_executor
 
     def get_fingerprinted_songs(self) -> List[Dict[str, any]]:
         """
@@ -61,7 +264,25 @@ class Dejavu:
 
         :param song_ids: song ids to delete from the database.
         """
+        self.__check_writable()
         self.db.delete_songs_by_id(song_ids)
+        for song_id in song_ids:
+            self.song_cache.pop(song_id, None)
+
+    def get_song_by_id(self, song_id: int) -> Dict[str, str]:
+        """
+        Brings the song info from the database, fingerprinted songs don't change so
+        they are kept in memory after the first lookup.
+
+        :param song_id: song identifier.
+        :return: a song by its identifier.
+        """
+        song = self.song_cache.get(song_id)
+        if song is None:
+            song = self.db.get_song_by_id(song_id)
+            if song is not None:
+                self.song_cache[song_id] = song
+        return song
 
     def fingerprint_directory(self, path: str, extensions: str, nprocesses: int = None) -> None:
         """
@@ -71,6 +292,7 @@ class Dejavu:
         :param extensions: list of file extensions to consider.
         :param nprocesses: amount of processes to fingerprint the files within the directory.
         """
+        self.__check_writable()
         # Try to use the maximum amount of processes if not given.
         try:
             nprocesses = nprocesses or multiprocessing.cpu_count()
@@ -79,27 +301,118 @@ class Dejavu:
         else:
             nprocesses = 1 if nprocesses <= 0 else nprocesses
 
+        # Files are found while the first ones are already being fingerprinted, on the thread of the
+        # pool feeding its processes. It checks them against its own copy of the fingerprinted songs.
+        files_to_fingerprint = self.__find_files_to_fingerprint(path, extensions, set(self.songhashes_set))
+        first_files = list(islice(files_to_fingerprint, nprocesses))
+
+        # With fewer files than processes most of the pool would sit idle, so instead
+        # each file is split in segments fingerprinted in parallel. Segments need the
+        # whole file in memory, chunked fingerprinting keeps one file per process.
+        if 0 < len(first_files) < nprocesses and not self.chunk_frames:
+            with ProcessPoolExecutor(nprocesses) as executor:
+                for filename, file_hash in first_files:
+                    song_name = decoder.get_audio_name_from_path(filename)
+                    try:
+                        hashes, file_hash = Dejavu.get_file_fingerprints(
+                            filename, self.limit, print_output=True, executor=executor, profile=self.profile,
+                            file_hash=file_hash, cache=self.fingerprint_cache)
+                    except Exception:
+                        print("Failed fingerprinting")
+                        # Print traceback because we can't reraise it here
+                        traceback.print_exc(file=sys.stdout)
+                    else:
+                        self.__store_fingerprints(song_name, file_hash, hashes)
+            return
+
+        # Prepare _fingerprint_worker input, the pool consumes it as files are found.
+        worker_input = ((filename, self.limit, self.profile, self.chunk_frames, file_hash, self.fingerprint_cache)
+                        for filename, file_hash in chain(first_files, files_to_fingerprint))
+
+        # Chunked files are always stored by the processes fingerprinting them, chunk by chunk.
+        # Sending them back to this process would gather each one whole.
+        if (self.worker_writes or self.chunk_frames) and self.db.shared_across_processes:
+            self.__fingerprint_with_worker_writes(worker_input, nprocesses)
+            return
+
         pool = multiprocessing.Pool(nprocesses)
 
-        filenames_to_fingerprint = []
+        # Send off our tasks
+        iterator = pool.imap_unordered(metrics.collected(Dejavu._fingerprint_worker), worker_input)
+
+        # Loop till we have all of them
+        while True:
+            try:
+                song_name, shared_hashes, file_hash = metrics.merge_result(next(iterator))
+                # the hashes stay packed until they are inserted, a batch at a time.
+                hashes = chain.from_iterable(iter_unpacked_hashes(*receive_hash_arrays(shared_hashes)))
+            except multiprocessing.TimeoutError:
+                continue
+            except StopIteration:
+                break
+            except Exception:
+                print("Failed fingerprinting")
+                # Print traceback because we can't reraise it here
+                traceback.print_exc(file=sys.stdout)
+            else:
+                self.__store_fingerprints(song_name, file_hash, hashes)
+
+        pool.close()
+        pool.join()
+
+    def __find_files_to_fingerprint(self, path: str, extensions: str,
+                                    known_hashes: Set[str]) -> Iterator[Tuple[str, str]]:
+        """
+        Looks for the files in a directory that are not fingerprinted yet. Files that can't be
+        read are reported and left out, the search goes on with the others.
+
+        :param path: path to the directory.
+        :param extensions: list of file extensions to consider.
+        :param known_hashes: hashes of the files already fingerprinted, the ones of the files
+         found are added to it so copies of a file are only fingerprinted once.
+        :return: an iterator of tuples with the file name and the hash of the file.
+        """
         for filename, _ in decoder.find_files(path, extensions):
+            try:
+                file_hash = self.__file_hash(filename)
+            except Exception:
+                print(f"Failed reading {filename}")
+                # Print traceback because we can't reraise it here
+                traceback.print_exc(file=sys.stdout)
+                continue
+
             # don't refingerprint already fingerprinted files
-            if decoder.unique_hash(filename) in self.songhashes_set:
+            if file_hash in known_hashes:
                 print(f"{filename} already fingerprinted, continuing...")
                 continue
 
-            filenames_to_fingerprint.append(filename)
+            known_hashes.add(file_hash)
+            yield filename, file_hash
 
-        # Prepare _fingerprint_worker input
-        worker_input = list(zip(filenames_to_fingerprint, [self.limit] * len(filenames_to_fingerprint)))
+        if self.manifest is not None:
+            self.manifest.commit()
 
-        # Send off our tasks
-        iterator = pool.imap_unordered(Dejavu._fingerprint_worker, worker_input)
+    def __fingerprint_with_worker_writes(self, worker_input: Iterable[Tuple], nprocesses: int) -> None:
+        """
+        Fingerprints the files on a pool whose processes store each song and its fingerprints
+        straight into the database, in a transaction per song.
 
-        # Loop till we have all of them
+        :param worker_input: _fingerprint_worker input for each file.
+        :param nprocesses: amount of processes to fingerprint the files.
+        """
+        # the pool processes count their fingerprints in their own copy of the hash sketch, this
+        # one is built again with them at the next lookup.
+        self.db.drop_hash_sketch()
+        self.db.before_fork()
+        pool = multiprocessing.Pool(nprocesses, initializer=Dejavu._init_db_worker,
+                                    initargs=(self.db, frozenset(self.stop_hashes), self.hash_sample_ratio))
+
+        iterator = pool.imap_unordered(metrics.collected(Dejavu._fingerprint_db_worker), worker_input)
+
+        stored = 0
         while True:
             try:
-                song_name, hashes, file_hash = next(iterator)
+                song_name, file_hash, song_id, total_hashes = metrics.merge_result(next(iterator))
             except multiprocessing.TimeoutError:
                 continue
             except StopIteration:
@@ -109,11 +422,14 @@ class Dejavu:
                 # Print traceback because we can't reraise it here
                 traceback.print_exc(file=sys.stdout)
             else:
-                sid = self.db.insert_song(song_name, file_hash, len(hashes))
-
-                self.db.insert_hashes(sid, hashes)
-                self.db.set_song_fingerprinted(sid)
-                self.__load_fingerprinted_audio_hashes()
+                stored += 1
+                self.__mark_fingerprinted(file_hash)
+                if self.manifest is not None:
+                    self.manifest.set_song_id(file_hash, song_id)
+                    self.manifest.commit()
+                print(f"Stored {song_name} with {total_hashes} fingerprints ({stored} songs so far)")
+                self.__prune_song_hashes(song_id)
+                self.__export_metrics()
 
         pool.close()
         pool.join()
@@ -126,50 +442,276 @@ class Dejavu:
         :param file_path: path to the file.
         :param song_name: song name associated to the audio file.
         """
-        song_name_from_path = decoder.get_audio_name_from_path(file_path)
-        song_hash = decoder.unique_hash(file_path)
-        song_name = song_name or song_name_from_path
-        # don't refingerprint already fingerprinted files
-        if song_hash in self.songhashes_set:
-            print(f"{song_name} already fingerprinted, continuing...")
-        else:
-            _, hashes, file_hash = Dejavu._fingerprint_worker(
-                (file_path, self.limit)
-            )
-            sid = self.db.insert_song(song_name, file_hash, len(hashes))
+        self.__check_writable()
+        with tracer.trace("fingerprint_file", file=file_path) as span:
+            song_name_from_path = decoder.get_audio_name_from_path(file_path)
+            with tracer.span("file_hash"):
+                song_hash = self.__file_hash(file_path)
+            song_name = song_name or song_name_from_path
+            span.set(song_name=song_name)
+            # don't refingerprint already fingerprinted files
+            if song_hash in self.songhashes_set:
+                print(f"{song_name} already fingerprinted, continuing...")
+                span.set(skipped=True)
+            elif self.chunk_frames:
+                chunks = Dejavu.iter_file_fingerprints(file_path, self.limit, self.chunk_frames, profile=self.profile,
+                                                       file_hash=song_hash, cache=self.fingerprint_cache)
+                self.__store_fingerprints(song_name, song_hash, chunks, chunked=True)
+            else:
+                hashes, file_hash = Dejavu.get_file_fingerprints(
+                    file_path, self.limit, print_output=True, executor=self.get_fingerprint_executor(),
+                    profile=self.profile, file_hash=song_hash, cache=self.fingerprint_cache)
+                self.__store_fingerprints(song_name, file_hash, hashes)
 
-            self.db.insert_hashes(sid, hashes)
-            self.db.set_song_fingerprinted(sid)
-            self.__load_fingerprinted_audio_hashes()
+            if self.manifest is not None:
+                self.manifest.commit()
+
+    def load_shards(self, paths: List[str]) -> None:
+        """
+        Stores the songs of fingerprint shards written by export_shards, using the fastest
+        way the database has to load them. Songs already in the database are skipped, and
+        fingerprints of stop hashes are left out as when fingerprinting.
+
+        :param paths: shard files, or directories of shard files.
+        """
+        self.__check_writable()
+        for shard_path in find_shards(paths):
+            info, songs = read_shard(shard_path)
+
+            self.__check_profile(info["profile"], shard_path)
+            if info["settings"] != settings_digest():
+                raise ValueError(f"{shard_path} was fingerprinted with different fingerprint settings.")
+
+            for song_name, file_hash, hash_array, offsets in songs:
+                if file_hash in self.songhashes_set:
+                    print(f"{song_name} already fingerprinted, continuing...")
+                    continue
+
+                hash_array, offsets = sample_hash_arrays(hash_array, offsets, self.hash_sample_ratio)
+                hash_array, offsets = skip_hash_arrays(hash_array, offsets, self.stop_hashes)
+                song_id = self.db.insert_song_hash_arrays(song_name, file_hash, hash_array, offsets)
+                self.__mark_fingerprinted(file_hash)
+                print(f"Loaded {song_name} with {len(offsets)} fingerprints from {shard_path}")
+                self.__prune_song_hashes(song_id)
+
+    def __check_profile(self, profile: Dict[str, any], source: str) -> None:
+        """
+        Makes sure fingerprints made elsewhere can be stored, fingerprints made with another
+        profile would never match the queries.
+
+        :param profile: profile the fingerprints were made with.
+        :param source: where the fingerprints come from, for the error message.
+        """
+        # the name of the profile doesn't change the fingerprints, its settings do.
+        if {name: value for name, value in profile.items() if name != "name"} != \
+                {name: value for name, value in self.profile.items() if name != "name"}:
+            raise ValueError(f"{source} was fingerprinted with the '{profile['name']}' profile, "
+                             f"the database uses the '{self.profile['name']}' profile.")
+
+    def export_snapshot(self, path: str) -> Dict[str, any]:
+        """
+        Writes every fingerprinted song and its fingerprints to a snapshot file, to fill other
+        databases with import_snapshot.
+
+        :param path: snapshot file to write.
+        :return: the info stored in the snapshot, with the number of songs and fingerprints.
+        """
+        return export_snapshot(self.db, path, {"profile": self.profile, "hash_sample_ratio": self.hash_sample_ratio})
+
+    def import_snapshot(self, path: str) -> Dict[str, any]:
+        """
+        Stores the songs, stop hashes and fingerprints of a snapshot file written by export_snapshot.
+        Songs already in the database are skipped, and fingerprints of stop hashes are left out.
+
+        :param path: snapshot file to read.
+        :return: the info stored in the snapshot, with the number of songs restored.
+        """
+        self.__check_writable()
+        info = read_snapshot_info(path)
+        self.__check_profile(info["profile"], path)
+
+        # a sample can be taken again from a larger one, not the other way around.
+        if self.hash_sample_ratio % info.get("hash_sample_ratio", 1):
+            raise ValueError(f"{path} keeps one hash out of {info['hash_sample_ratio']}, "
+                             f"the database keeps one hash out of {self.hash_sample_ratio}.")
+
+        info = import_snapshot(self.db, path, self.songhashes_set, self.hash_sample_ratio, self.stop_hashes)
+        self.stop_hashes = {hsh.lower() for hsh in self.db.get_stop_hashes()}
+        self.__reset_fingerprinted_audio_hashes()
+        for song_id in info["song_ids"]:
+            self.__prune_song_hashes(song_id)
+        return info
+
+    def __file_hash(self, file_path: str) -> str:
+        """
+        Hash of the content of a file, taken from the ingest manifest when the file
+        didn't change since the last time it was hashed.
+
+        :param file_path: path to the file.
+        :return: the hash of the file.
+        """
+        if self.manifest is None:
+            return decoder.unique_hash(file_path)
+
+        stat = os.stat(file_path)
+        file_hash = self.manifest.lookup(file_path, stat)
+        if file_hash is None:
+            file_hash = decoder.unique_hash(file_path)
+            self.manifest.record(file_path, stat, file_hash)
+        return file_hash
+
+    def __store_fingerprints(self, song_name: str, file_hash: str, hashes: Iterable, chunked: bool = False) -> None:
+        """
+        Inserts a song and its fingerprints, marking it as fingerprinted once all of them are in.
+
+        :param song_name: song name associated to the audio file.
+        :param file_hash: hash of the audio file.
+        :param hashes: tuples for hashes and their corresponding offsets, or with chunked the hashes of
+         each chunk. They may be generated on the fly.
+        :param chunked: whether the hashes come a chunk at a time, each one stored in its own transaction.
+        """
+        with tracer.span("store") as span:
+            song_id = Dejavu.__insert_song(self.db, song_name, file_hash, hashes, chunked, self.stop_hashes,
+                                           self.hash_sample_ratio)
+            span.set(song_id=song_id)
+        if self.manifest is not None:
+            self.manifest.set_song_id(file_hash, song_id)
+            self.manifest.commit()
+        self.__prune_song_hashes(song_id)
+        self.__mark_fingerprinted(file_hash)
+        self.__export_metrics()
+
+    def __export_metrics(self) -> None:
+        """
+        Rewrites the metrics file, if any.
+        """
+        if self.metrics_file:
+            metrics.write(self.metrics_file)
+
+    def prune_common_hashes(self, max_songs: int) -> Dict[str, int]:
+        """
+        Index maintenance: hashes found in more than max_songs songs, such as the ones of silence
+        or hum, match nearly every query without telling the songs apart. Their fingerprints are
+        deleted and the hashes kept as stop hashes, so they are not stored again.
+
+        :param max_songs: hashes found in more songs than this are pruned.
+        :return: the number of hashes pruned and fingerprints deleted.
+        """
+        self.__check_writable()
+        common = self.db.find_common_hashes(max_songs)
+        deleted = self.db.prune_hashes(common) if common else 0
+        self.stop_hashes.update(hsh.lower() for hsh in common)
+        return {"hashes": len(common), "fingerprints": deleted}
+
+    def __prune_song_hashes(self, song_id: int) -> None:
+        """
+        Prunes the hashes of a song just stored that are now in more than stop_hash_songs songs.
+
+        :param song_id: song identifier.
+        """
+        if not self.stop_hash_songs:
+            return
+
+        common = self.db.find_common_hashes(self.stop_hash_songs, song_id)
+        if common:
+            deleted = self.db.prune_hashes(common)
+            self.stop_hashes.update(hsh.lower() for hsh in common)
+            print(f"Pruned {len(common)} hashes found in more than {self.stop_hash_songs} songs "
+                  f"({deleted} fingerprints)")
+
+    @staticmethod
+    def __insert_song(db: BaseDatabase, song_name: str, file_hash: str, hashes: Iterable, chunked: bool,
+                      stop_hashes: Set[str], sample_ratio: int) -> int:
+        """
+        Inserts a song and its fingerprints but the stop hashes and the ones out of the sample.
+
+        :param db: database to insert the song into.
+        :param song_name: song name associated to the audio file.
+        :param file_hash: hash of the audio file.
+        :param hashes: tuples for hashes and their corresponding offsets, or with chunked the hashes of each chunk.
+        :param chunked: whether the hashes come a chunk at a time.
+        :param stop_hashes: stop hashes in lower case hexadecimal.
+        :param sample_ratio: one hash out of sample_ratio is stored.
+        :return: the inserted song id.
+        """
+        if chunked:
+            chunks = (list(sample_hashes(Dejavu.__skip_stop_hashes(chunk, stop_hashes), sample_ratio))
+                      for chunk in hashes)
+            return db.insert_song_hash_chunks(song_name, file_hash, chunks)
+        return db.insert_song_hashes(song_name, file_hash,
+                                     sample_hashes(Dejavu.__skip_stop_hashes(hashes, stop_hashes), sample_ratio))
+
+    @staticmethod
+    def __skip_stop_hashes(hashes: Iterable[Tuple[str, int]], stop_hashes: Set[str]) -> Iterable[Tuple[str, int]]:
+        """
+        Leaves out the fingerprints of stop hashes, keeping the hashes generated on the fly if they are.
+
+        :param hashes: tuples for hashes and their corresponding offsets.
+        :param stop_hashes: stop hashes in lower case hexadecimal.
+        :return: the tuples of the other hashes.
+        """
+        if not stop_hashes:
+            return hashes
+        return ((hsh, offset) for hsh, offset in hashes if hsh not in stop_hashes)
 
     def generate_fingerprints(self, samples: List[int], Fs=DEFAULT_FS) -> Tuple[List[Tuple[str, int]], float]:
         f"""
-        Generate the fingerprints for the given sample data (channel).
+        Generate the fingerprints for the given sample data (channel), which must be already
+        prepared for the fingerprinting profile of the database.
 
         :param samples: list of ints which represents the channel info of the given audio file.
         :param Fs: sampling rate which defaults to {DEFAULT_FS}.
         :return: a list of tuples for hash and its corresponding offset, together with the generation time.
         """
         t = time()
-        hashes = fingerprint(samples, Fs=Fs)
+        hashes = fingerprint(samples, Fs=Fs, wsize=self.profile["window_size"], wratio=self.profile["overlap_ratio"])
         fingerprint_time = time() - t
         return hashes, fingerprint_time
 
-    def find_matches(self, hashes: List[Tuple[str, int]]) -> Tuple[List[Tuple[int, int]], Dict[str, int], float]:
+    def sample_query_hashes(self, hashes: Set[Tuple[str, int]]) -> Set[Tuple[str, int]]:
+        """
+        Keeps the query hashes that can be in the database, the others were never stored.
+
+        :param hashes: set of tuples for hashes and their corresponding offsets.
+        :return: the ones in the sample of the database, all of them if it keeps every hash.
+        """
+        if self.hash_sample_ratio == 1:
+            return hashes
+        return set(sample_hashes(hashes, self.hash_sample_ratio))
+
+    def find_matches(self, hashes: List[Tuple[str, int]], skipped: Set[str] = None) \
+            -> Tuple[List[Tuple[int, int]], Dict[str, int], float]:
         """
         Finds the corresponding matches on the fingerprinted audios for the given hashes.
 
         :param hashes: list of tuples for hashes and their corresponding offsets
+        :param skipped: upper cased hashes not to look up, the database picks them when not given.
         :return: a tuple containing the matches found against the db, a dictionary which counts the different
          hashes matched for each song (with the song id as key), and the time that the query took.
 
         """
         t = time()
-        matches, dedup_hashes = self.db.return_matches(hashes)
+        matches, dedup_hashes = self.db.return_matches(hashes, skipped=skipped)
+        query_time = time() - t
+
+        return matches, dedup_hashes, query_time
+
+    async def find_matches_async(self, hashes: List[Tuple[str, int]]) \
+            -> Tuple[List[Tuple[int, int]], Dict[str, int], float]:
+        """
+        Asynchronous version of find_matches, the database is queried without blocking the event loop.
+
+        :param hashes: list of tuples for hashes and their corresponding offsets
+        :return: a tuple containing the matches found against the db, a dictionary which counts the different
+         hashes matched for each song (with the song id as key), and the time that the query took.
+        """
+        t = time()
+        matches, dedup_hashes = await self.db.return_matches_async(hashes)
         query_time = time() - t
 
         return matches, dedup_hashes, query_time
 
+    @metrics.timed(ALIGN)
     def align_matches(self, matches: List[Tuple[int, int]], dedup_hashes: Dict[str, int], queried_hashes: int,
                       topn: int = TOPN) -> List[Dict[str, any]]:
         """
@@ -191,13 +733,14 @@ class Dejavu:
             key=lambda count: count[2], reverse=True
         )
 
+        fs = self.profile["sample_rate"] or DEFAULT_FS
         songs_result = []
         for song_id, offset, _ in songs_matches[0:topn]:  # consider topn elements in the result
-            song = self.db.get_song_by_id(song_id)
+            song = self.get_song_by_id(song_id)
 
             song_name = song.get(SONG_NAME, None)
             song_hashes = song.get(FIELD_TOTAL_HASHES, None)
-            nseconds = round(float(offset) / DEFAULT_FS * DEFAULT_WINDOW_SIZE * DEFAULT_OVERLAP_RATIO, 5)
+            nseconds = round(float(offset) / fs * self.profile["window_size"] * self.profile["overlap_ratio"], 5)
             hashes_matched = dedup_hashes[song_id]
 
             song = {
@@ -220,38 +763,167 @@ class Dejavu:
         return songs_result
 
     def recognize(self, recognizer, *options, **kwoptions) -> Dict[str, any]:
-        r = recognizer(self)
-        return r.recognize(*options, **kwoptions)
+        with tracer.trace("recognize", recognizer=recognizer.__name__, options=options) as span:
+            r = recognizer(self)
+            results = r.recognize(*options, **kwoptions)
+            span.set(results=len(results[RESULTS]))
+        self.__export_metrics()
+        return results
+
+    async def recognize_async(self, recognizer, *options, **kwoptions) -> Dict[str, any]:
+        with tracer.trace("recognize", recognizer=recognizer.__name__, options=options) as span:
+            r = recognizer(self)
+            results = await r.recognize_async(*options, **kwoptions)
+            span.set(results=len(results[RESULTS]))
+        self.__export_metrics()
+        return results
 
     @staticmethod
     def _fingerprint_worker(arguments):
         # Pool.imap sends arguments as tuples so we have to unpack
-        # them ourself.
+        # them ourself. Hashes are sent back packed in shared memory,
+        # pickling them one by one costs about as much as computing them.
         try:
-            file_name, limit = arguments
+            file_name, limit, profile, chunk_frames, file_hash, cache = arguments
         except ValueError:
             pass
 
         song_name, extension = os.path.splitext(os.path.basename(file_name))
 
-        fingerprints, file_hash = Dejavu.get_file_fingerprints(file_name, limit, print_output=True)
+        if chunk_frames:
+            print(f"Fingerprinting {file_name} in chunks")
+            # only for databases not shared across processes, they hold every fingerprint in memory anyway.
+            # Chunks don't share hashes, so they are kept packed instead of merged into a set.
+            chunks = [pack_hashes(hashes)
+                      for hashes in Dejavu.iter_file_fingerprints(file_name, limit, chunk_frames, profile=profile,
+                                                                  file_hash=file_hash, cache=cache)]
+            print(f"Finished {file_name}")
+            hash_array = np.concatenate([hash_array for hash_array, _ in chunks])
+            offsets = np.concatenate([offsets for _, offsets in chunks])
+            return song_name, share_hash_arrays(hash_array, offsets), file_hash
 
-        return song_name, fingerprints, file_hash
+        fingerprints, file_hash = Dejavu.get_file_fingerprints(file_name, limit, print_output=True, profile=profile,
+                                                               file_hash=file_hash, cache=cache)
+
+        return song_name, share_hashes(fingerprints), file_hash
 
     @staticmethod
-    def get_file_fingerprints(file_name: str, limit: int, print_output: bool = False):
-        channels, fs, file_hash = decoder.read(file_name, limit)
-        fingerprints = set()
+    def _init_db_worker(db, stop_hashes: Set[str] = frozenset(), sample_ratio: int = 1) -> None:
+        # Runs once in every pool process, each one gets its own connections.
+        db.after_fork()
+        Dejavu._worker_db = db
+        Dejavu._worker_stop_hashes = stop_hashes
+        Dejavu._worker_sample_ratio = sample_ratio
+
+    @staticmethod
+    def _fingerprint_db_worker(arguments) -> Tuple[str, str, int, int]:
+        file_name, limit, profile, chunk_frames, file_hash, cache = arguments
+        song_name = decoder.get_audio_name_from_path(file_name)
+
+        if chunk_frames:
+            print(f"Fingerprinting {file_name} in chunks")
+            hashes = Dejavu.iter_file_fingerprints(file_name, limit, chunk_frames, profile=profile,
+                                                   file_hash=file_hash, cache=cache)
+        else:
+            hashes, file_hash = Dejavu.get_file_fingerprints(file_name, limit, print_output=True, profile=profile,
+                                                             file_hash=file_hash, cache=cache)
+
+        song_id = Dejavu.__insert_song(Dejavu._worker_db, song_name, file_hash, hashes, bool(chunk_frames),
+                                       Dejavu._worker_stop_hashes, Dejavu._worker_sample_ratio)
+        return song_name, file_hash, song_id, Dejavu._worker_db.get_song_by_id(song_id)[FIELD_TOTAL_HASHES]
+
+    @staticmethod
+    def get_file_fingerprints(file_name: str, limit: int, print_output: bool = False, executor: Executor = None,
+                              profile: Dict[str, any] = None, file_hash: str = None, cache: FingerprintCache = None):
+        profile = profile or FINGERPRINT_PROFILES[DEFAULT_FINGERPRINT_PROFILE]
+
+        if cache is not None:
+            file_hash = file_hash or decoder.unique_hash(file_name)
+            cached = cache.get(file_hash, profile, limit)
+            if cached is not None:
+                if print_output:
+                    print(f"Using cached fingerprints for {file_name}")
+                return set(unpack_hashes(*cached)), file_hash
+
+        fingerprints, file_hash = Dejavu.__compute_file_fingerprints(file_name, limit, print_output, executor,
+                                                                     profile, file_hash)
+        if cache is not None:
+            cache.put(file_hash, profile, limit, *pack_hashes(fingerprints))
+
+        return fingerprints, file_hash
+
+    @staticmethod
+    def __compute_file_fingerprints(file_name: str, limit: int, print_output: bool, executor: Executor,
+                                    profile: Dict[str, any], file_hash: str) -> Tuple[Set[Tuple[str, int]], str]:
+        wsize, wratio = profile["window_size"], profile["overlap_ratio"]
+
+        channels, fs, file_hash = decoder.read(file_name, limit, file_hash=file_hash)
+        with tracer.span("prepare"):
+            channels, fs = decoder.prepare_channels(channels, fs, profile)
         channel_amount = len(channels)
-        for channeln, channel in enumerate(channels, start=1):
-            if print_output:
-                print(f"Fingerprinting channel {channeln}/{channel_amount} for {file_name}")
 
-            hashes = fingerprint(channel, Fs=fs)
+        with tracer.span("fingerprint", channels=channel_amount) as span:
+            if executor is not None:
+                if print_output:
+                    print(f"Fingerprinting {channel_amount} channels in parallel segments for {file_name}")
 
-            if print_output:
-                print(f"Finished channel {channeln}/{channel_amount} for {file_name}")
+                fingerprints = fingerprint_channels(channels, Fs=fs, executor=executor, wsize=wsize, wratio=wratio)
 
-            fingerprints |= set(hashes)
+                if print_output:
+                    print(f"Finished {channel_amount} channels for {file_name}")
+            else:
+                fingerprints = set()
+                for channeln, channel in enumerate(channels, start=1):
+                    if print_output:
+                        print(f"Fingerprinting channel {channeln}/{channel_amount} for {file_name}")
+
+                    hashes = fingerprint(channel, Fs=fs, wsize=wsize, wratio=wratio)
+
+                    if print_output:
+                        print(f"Finished channel {channeln}/{channel_amount} for {file_name}")
+
+                    fingerprints |= set(hashes)
+
+            span.set(hashes=len(fingerprints))
 
         return fingerprints, file_hash
+
+    @staticmethod
+    def iter_file_fingerprints(file_name: str, limit: int, chunk_frames: int, profile: Dict[str, any] = None,
+                               file_hash: str = None, cache: FingerprintCache = None) -> Iterator[Set[Tuple[str, int]]]:
+        """
+        Reads and fingerprints a file in chunks, keeping in memory just the current one. Together the
+        chunks hold the same hashes get_file_fingerprints gives.
+
+        :param file_name: file to fingerprint.
+        :param limit: number of seconds to limit.
+        :param chunk_frames: number of spectrogram frames fingerprinted at a time.
+        :param profile: fingerprinting profile, the default one if not given.
+        :param file_hash: hash of the file, computed if needed and not given.
+        :param cache: fingerprint cache to look into first, and to store the fingerprints in.
+        :return: an iterator of sets of tuples for hashes and their corresponding offsets.
+        """
+        profile = profile or FINGERPRINT_PROFILES[DEFAULT_FINGERPRINT_PROFILE]
+
+        if cache is not None:
+            file_hash = file_hash or decoder.unique_hash(file_name)
+            cached = cache.get(file_hash, profile, limit)
+            if cached is not None:
+                # the packed arrays are small, the hashes are unpacked a hundred thousand at a time.
+                for hashes in iter_unpacked_hashes(*cached):
+                    yield set(hashes)
+                return
+
+        chunks = []
+        _, fs, blocks = decoder.read_blocks(file_name, limit)
+        blocks, fs = decoder.prepare_blocks(blocks, fs, profile)
+        for hashes in fingerprint_stream(blocks, Fs=fs, chunk_frames=chunk_frames,
+                                         wsize=profile["window_size"], wratio=profile["overlap_ratio"]):
+            hashes = set(hashes)
+            if cache is not None:
+                chunks.append(pack_hashes(hashes))
+            yield hashes
+
+        if cache is not None and chunks:
+            cache.put(file_hash, profile, limit, np.concatenate([hash_array for hash_array, _ in chunks]),
+                      np.concatenate([offsets for _, offsets in chunks]))
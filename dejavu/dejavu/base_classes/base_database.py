@@ -1,8 +1,20 @@
 import abc
+import asyncio
 import importlib
-from typing import Dict, List, Tuple
+from itertools import groupby, islice
+from time import perf_counter
+from typing import Dict, Iterable, Iterator, List, Tuple
 
-from dejavu.config.settings import DATABASES
+import numpy as np
+
+from dejavu.config.settings import (DATABASES, HASH_SKETCH_DEPTH,
+                                    HASH_SKETCH_WIDTH)
+from dejavu.logic.hash_arrays import unpack_hashes
+from dejavu.logic.hash_sketch import HashSketch
+from dejavu.logic.matcher import build_hash_mapper, match_postings
+from dejavu.logic.metrics import (LOOKUP, ROWS_DELETED, ROWS_FETCHED,
+                                  ROWS_INSERTED, metrics)
+from dejavu.logic.tracing import tracer
 
 
 class BaseDatabase(object, metaclass=abc.ABCMeta):
@@ -10,6 +22,15 @@ class BaseDatabase(object, metaclass=abc.ABCMeta):
     # to refer to your class
     type = None
 
+    # Whether what a process stores is seen by the others, needed for
+    # fingerprinting workers to write songs on their own.
+    shared_across_processes = True
+
+    # Estimated number of fingerprints of each hash and how many a query hash can have
+    # before it is skipped, see skip_common_hashes.
+    hash_sketch = None
+    max_hash_rows = None
+
     def __init__(self):
         super().__init__()
 
@@ -66,6 +87,16 @@ class BaseDatabase(object, metaclass=abc.ABCMeta):
         """
         pass
 
+    @abc.abstractmethod
+    def get_fingerprints_size(self) -> Tuple[int, int]:
+        """
+        Returns the space taken by the fingerprints, as reported by the database, which may
+        lag behind the latest inserts.
+
+        :return: the bytes taken by the fingerprint rows and by the indexes on them.
+        """
+        pass
+
     @abc.abstractmethod
     def set_song_fingerprinted(self, song_id: int):
         """
@@ -75,6 +106,16 @@ class BaseDatabase(object, metaclass=abc.ABCMeta):
         """
         pass
 
+    @abc.abstractmethod
+    def set_song_total_hashes(self, song_id: int, total_hashes: int) -> None:
+        """
+        Sets the amount of fingerprints of a song, for songs inserted before all of them were known.
+
+        :param song_id: song identifier.
+        :param total_hashes: amount of hashes inserted on fingerprint table.
+        """
+        pass
+
     @abc.abstractmethod
     def get_songs(self) -> List[Dict[str, str]]:
         """
@@ -118,6 +159,177 @@ class BaseDatabase(object, metaclass=abc.ABCMeta):
         """
         pass
 
+    def insert_song_hashes(self, song_name: str, file_hash: str, hashes: Iterable[Tuple[str, int]],
+                           batch_size: int = 1000) -> int:
+        """
+        Inserts a song together with all its fingerprints and sets it as fingerprinted. Hashes
+        are consumed as they are inserted, so they can be generated on the fly.
+
+        :param song_name: The name of the song.
+        :param file_hash: Hash from the fingerprinted file.
+        :param hashes: A sequence of tuples in the format (hash, offset)
+            - hash: Part of a sha1 hash, in hexadecimal format
+            - offset: Offset this hash was created from/at.
+        :param batch_size: insert batches.
+        :return: the inserted song id.
+        """
+        song_id = self.insert_song(song_name, file_hash, 0)
+
+        total_hashes = 0
+        hashes = iter(hashes)
+        while True:
+            batch = list(islice(hashes, batch_size))
+            if not batch:
+                break
+            self.insert_hashes(song_id, batch, batch_size)
+            total_hashes += len(batch)
+
+        self.set_song_total_hashes(song_id, total_hashes)
+        self.set_song_fingerprinted(song_id)
+        return song_id
+
+    def insert_song_hash_chunks(self, song_name: str, file_hash: str,
+                                chunks: Iterable[List[Tuple[str, int]]], batch_size: int = 1000) -> int:
+        """
+        Same as insert_song_hashes, for a song fingerprinted a chunk at a time: every chunk is
+        inserted in a transaction of its own, so none is left open while the next chunk is read
+        and fingerprinted. The song is set as fingerprinted once all the chunks are in, and
+        deleted if any of them fails.
+
+        :param song_name: The name of the song.
+        :param file_hash: Hash from the fingerprinted file.
+        :param chunks: lists of tuples for hashes and their offsets, they may be generated on the fly.
+        :param batch_size: insert batches.
+        :return: the inserted song id.
+        """
+        song_id = self.insert_song(song_name, file_hash, 0)
+
+        total_hashes = 0
+        try:
+            for hashes in chunks:
+                if hashes:
+                    self.insert_hashes(song_id, hashes, batch_size)
+                    total_hashes += len(hashes)
+        except BaseException:
+            self.delete_songs_by_id([song_id])
+            raise
+
+        self.set_song_total_hashes(song_id, total_hashes)
+        self.set_song_fingerprinted(song_id)
+        return song_id
+
+    def insert_song_hash_arrays(self, song_name: str, file_hash: str, hash_array: np.ndarray,
+                                offsets: np.ndarray) -> int:
+        """
+        Same as insert_song_hashes, for fingerprints already packed as in fingerprint shards.
+        Backends with a bulk loading path override it.
+
+        :param song_name: The name of the song.
+        :param file_hash: Hash from the fingerprinted file.
+        :param hash_array: (n, HASH_BYTES) uint8 array of hashes, as given by pack_hashes.
+        :param offsets: offsets of the hashes.
+        :return: the inserted song id.
+        """
+        return self.insert_song_hashes(song_name, file_hash, unpack_hashes(hash_array, offsets))
+
+    def insert_fingerprint_rows(self, rows: Iterable[Tuple[int, str, int]], batch_size: int = 1000) -> None:
+        """
+        Inserts fingerprints of any number of songs at once, as when restoring a snapshot.
+        Backends with a bulk loading path override it.
+
+        :param rows: A sequence of tuples in the format (song_id, hash, offset)
+            - song_id: Song identifier the fingerprint belongs to
+            - hash: Part of a sha1 hash, in hexadecimal format
+            - offset: Offset this hash was created from/at.
+        :param batch_size: insert batches.
+        """
+        for song_id, song_rows in groupby(rows, key=lambda row: row[0]):
+            self.insert_hashes(song_id, [(hsh, offset) for _, hsh, offset in song_rows], batch_size)
+
+    @abc.abstractmethod
+    def iter_fingerprints(self, batch_size: int = 100000) -> Iterator[List[Tuple[str, int, int]]]:
+        """
+        Goes through every fingerprint in the database without loading them all at once.
+
+        :param batch_size: number of fingerprints in each batch.
+        :return: an iterator of lists of (hash, song_id, offset) rows, hashes in upper case hexadecimal.
+        """
+        pass
+
+    def skip_common_hashes(self, max_rows: int) -> None:
+        """
+        From then on query hashes estimated to have more than max_rows fingerprints are skipped,
+        their long lists of rows would match nearly every song. The estimates come from a hash
+        sketch built at the first lookup, see build_hash_sketch.
+
+        :param max_rows: estimated number of fingerprints past which query hashes are skipped.
+        """
+        self.max_hash_rows = max_rows
+
+    def build_hash_sketch(self, width: int = HASH_SKETCH_WIDTH, depth: int = HASH_SKETCH_DEPTH) -> None:
+        """
+        Counts the fingerprints of every hash in a sketch, going through the whole database. It is
+        kept current as fingerprints are inserted and deleted by this instance.
+
+        :param width: number of cells in each row of the sketch, a power of two.
+        :param depth: number of rows of the sketch.
+        """
+        sketch = HashSketch(width, depth)
+        for rows in self.iter_fingerprints():
+            sketch.add([hsh for hsh, _, _ in rows])
+
+        self.hash_sketch = sketch
+
+    def drop_hash_sketch(self) -> None:
+        """
+        Forgets the hash sketch, for when fingerprints were inserted or deleted by other processes.
+        It is built again at the next lookup.
+        """
+        self.hash_sketch = None
+
+    def hashes_to_skip(self, hashes: Iterable[str]) -> Dict[str, int]:
+        """
+        Picks the query hashes estimated to have more than max_hash_rows fingerprints.
+
+        :param hashes: upper cased hashes, in hexadecimal format.
+        :return: the estimated number of fingerprints of each hash to skip, none without a hash sketch.
+        """
+        if self.max_hash_rows is None:
+            return {}
+        if self.hash_sketch is None:
+            self.build_hash_sketch()
+
+        hashes = list(hashes)
+        estimates = self.hash_sketch.estimate(hashes)
+        return {hashes[index]: int(estimates[index]) for index in np.flatnonzero(estimates > self.max_hash_rows)}
+
+    async def hashes_to_skip_async(self, hashes: Iterable[str]) -> Dict[str, int]:
+        """
+        Asynchronous version of hashes_to_skip. The hash sketch, when it has to be built, is built
+        on the default executor so the event loop is never blocked by the scan of the database.
+
+        :param hashes: upper cased hashes, in hexadecimal format.
+        :return: the estimated number of fingerprints of each hash to skip, none without a hash sketch.
+        """
+        if self.max_hash_rows is not None and self.hash_sketch is None:
+            loop = asyncio.get_event_loop()
+            await loop.run_in_executor(None, self.build_hash_sketch)
+        return self.hashes_to_skip(hashes)
+
+    def _count_hashes(self, hashes: List[str], removed: bool = False) -> None:
+        """
+        Keeps the hash sketch current, if any, and counts the rows inserted and deleted.
+
+        :param hashes: hashes of the fingerprints inserted or deleted, once per fingerprint.
+        :param removed: whether the fingerprints were deleted.
+        """
+        metrics.inc(ROWS_DELETED if removed else ROWS_INSERTED, len(hashes))
+        if self.hash_sketch is not None:
+            if removed:
+                self.hash_sketch.remove(hashes)
+            else:
+                self.hash_sketch.add(hashes)
+
     @abc.abstractmethod
     def query(self, fingerprint: str = None) -> List[Tuple]:
         """
@@ -151,7 +363,7 @@ class BaseDatabase(object, metaclass=abc.ABCMeta):
         """
 
     @abc.abstractmethod
-    def return_matches(self, hashes: List[Tuple[str, int]], batch_size: int = 1000) \
+    def return_matches(self, hashes: List[Tuple[str, int]], batch_size: int = 1000, skipped: Iterable[str] = None) \
             -> Tuple[List[Tuple[int, int]], Dict[int, int]]:
         """
         Searches the database for pairs of (hash, offset) values.
@@ -160,14 +372,85 @@ class BaseDatabase(object, metaclass=abc.ABCMeta):
             - hash: Part of a sha1 hash, in hexadecimal format
             - offset: Offset this hash was created from/at.
         :param batch_size: number of query's batches.
+        :param skipped: upper cased hashes not to look up, picked with hashes_to_skip when not given.
         :return: a list of (sid, offset_difference) tuples and a
         dictionary with the amount of hashes matched (not considering
-        duplicated hashes) in each song.
+        duplicated hashes) in each song, hashes picked by hashes_to_skip are not searched.
             - song id: Song identifier
             - offset_difference: (database_offset - sampled_offset)
         """
         pass
 
+    @abc.abstractmethod
+    def lookup_hashes(self, hashes: List[str], batch_size: int = 1000) -> Iterable[Tuple[str, int, int]]:
+        """
+        Searches the database for all the fingerprints of the given hashes, without
+        relating them to any sampled offset. This allows several queries to share the
+        same lookup.
+
+        :param hashes: upper cased hashes, in hexadecimal format, to look for.
+        :param batch_size: number of query's batches.
+        :return: an iterable of (hash, song_id, offset) rows.
+        """
+        pass
+
+    def _lookup_rows(self, hashes: List[str], batch_size: int = 1000) -> Iterable[Tuple[str, int, int]]:
+        """
+        Same as lookup_hashes, timed as the lookup stage when metrics are enabled or the request
+        is traced. The rows are then all fetched before being matched, so the database time
+        doesn't include matching.
+
+        :param hashes: upper cased hashes, in hexadecimal format, to look for.
+        :param batch_size: number of query's batches.
+        :return: an iterable of (hash, song_id, offset) rows.
+        """
+        if not metrics.enabled and not tracer.current():
+            return self.lookup_hashes(hashes, batch_size)
+
+        t = perf_counter()
+        with tracer.span("lookup", hashes=len(hashes)) as span:
+            rows = list(self.lookup_hashes(hashes, batch_size))
+            span.set(rows=len(rows))
+        metrics.observe(LOOKUP, perf_counter() - t)
+        metrics.inc(ROWS_FETCHED, len(rows))
+        return rows
+
+    async def lookup_hashes_async(self, hashes: List[str], batch_size: int = 1000) -> List[Tuple[str, int, int]]:
+        """
+        Asynchronous version of lookup_hashes. Databases without an asynchronous driver
+        run the lookup on the default executor so the event loop is never blocked.
+
+        :param hashes: upper cased hashes, in hexadecimal format, to look for.
+        :param batch_size: number of query's batches.
+        :return: a list of (hash, song_id, offset) rows.
+        """
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, lambda: list(self.lookup_hashes(hashes, batch_size)))
+
+    async def return_matches_async(self, hashes: List[Tuple[str, int]], batch_size: int = 1000) \
+            -> Tuple[List[Tuple[int, int]], Dict[int, int]]:
+        """
+        Asynchronous version of return_matches.
+
+        :param hashes: A sequence of tuples in the format (hash, offset)
+            - hash: Part of a sha1 hash, in hexadecimal format
+            - offset: Offset this hash was created from/at.
+        :param batch_size: number of query's batches.
+        :return: a list of (sid, offset_difference) tuples and a
+        dictionary with the amount of hashes matched (not considering
+        duplicated hashes) in each song.
+        """
+        mapper = build_hash_mapper(hashes)
+        for hsh in await self.hashes_to_skip_async(mapper):
+            del mapper[hsh]
+
+        t = perf_counter()
+        rows = await self.lookup_hashes_async(list(mapper.keys()), batch_size)
+        metrics.observe(LOOKUP, perf_counter() - t)
+        metrics.inc(ROWS_FETCHED, len(rows))
+
+        return match_postings(mapper, rows)
+
     @abc.abstractmethod
     def delete_songs_by_id(self, song_ids: List[int], batch_size: int = 1000) -> None:
         """
@@ -178,6 +461,58 @@ class BaseDatabase(object, metaclass=abc.ABCMeta):
         """
         pass
 
+    @abc.abstractmethod
+    def find_common_hashes(self, max_songs: int, song_id: int = None) -> Dict[str, int]:
+        """
+        Counts in how many songs each hash shows up, its document frequency, and brings
+        the ones found in too many songs to tell any of them apart.
+
+        :param max_songs: hashes found in more songs than this are brought.
+        :param song_id: if given only the hashes of this song are counted, as when it was just stored.
+        :return: a dictionary with the number of songs of each hash, hashes in upper case hexadecimal.
+        """
+        pass
+
+    @abc.abstractmethod
+    def prune_hashes(self, hashes: Dict[str, int], batch_size: int = 1000) -> int:
+        """
+        Records hashes as stop hashes and deletes all their fingerprints.
+
+        :param hashes: number of songs of each hash, as given by find_common_hashes.
+        :param batch_size: number of query's batches.
+        :return: the number of fingerprints deleted.
+        """
+        pass
+
+    @abc.abstractmethod
+    def get_stop_hashes(self) -> Dict[str, int]:
+        """
+        Brings the hashes pruned so far, fingerprints with them are not stored anymore.
+
+        :return: the number of songs of each stop hash when it was pruned, hashes in upper case hexadecimal.
+        """
+        pass
+
+    @abc.abstractmethod
+    def get_metadata(self, name: str) -> str:
+        """
+        Brings a value describing the whole database, such as the fingerprinting profile it was built with.
+
+        :param name: name of the entry.
+        :return: the stored value, or None if it was never set.
+        """
+        pass
+
+    @abc.abstractmethod
+    def set_metadata(self, name: str, value: str) -> None:
+        """
+        Stores a value describing the whole database, replacing the previous one.
+
+        :param name: name of the entry.
+        :param value: value to store.
+        """
+        pass
+
 
 def get_database(database_type: str = "mysql") -> BaseDatabase:
     """
@@ -1,33 +1,209 @@
 import abc
+import asyncio
 from time import time
-from typing import Dict, List, Tuple
+from typing import Dict, Iterable, List, Set, Tuple
 
 import numpy as np
 
+import dejavu.logic.decoder as decoder
 from dejavu.config.settings import DEFAULT_FS
+from dejavu.logic.fingerprint import fingerprint_channels
+from dejavu.logic.hash_arrays import pack_hashes, unpack_hashes
+from dejavu.logic.matcher import build_hash_mapper, match_postings
+from dejavu.logic.metrics import LOOKUP, ROWS_FETCHED, metrics
+from dejavu.logic.tracing import tracer
 
 
 class BaseRecognizer(object, metaclass=abc.ABCMeta):
+    # Executor running the cpu bound stages of the asynchronous recognition,
+    # None means the default executor of the event loop.
+    executor = None
+
     def __init__(self, dejavu):
         self.dejavu = dejavu
         self.Fs = DEFAULT_FS
+        # query hashes left out for having too many fingerprints, and the fingerprints not brought.
+        self.hashes_skipped = 0
+        self.rows_skipped = 0
+
+    def _recognize(self, *data, file_hash: str = None) -> Tuple[List[Dict[str, any]], int, int, int]:
+        with tracer.span("fingerprint", channels=len(data), samples=len(data[0]) if data else 0) as span:
+            hashes, fingerprint_time = self._fingerprint(*data)
+            span.set(hashes=len(hashes))
+        if file_hash is not None:
+            self._cache_fingerprints(file_hash, hashes)
+
+        final_results, query_time, align_time = self._match(hashes)
+        return final_results, fingerprint_time, query_time, align_time
 
-    def _recognize(self, *data) -> Tuple[List[Dict[str, any]], int, int, int]:
+    def _fingerprint(self, *data) -> Tuple[Set[Tuple[str, int]], float]:
         fingerprint_times = []
         hashes = set()  # to remove possible duplicated fingerprints we built a set.
-        for channel in data:
-            fingerprints, fingerprint_time = self.dejavu.generate_fingerprints(channel, Fs=self.Fs)
+
+        t = time()
+        profile = self.dejavu.profile
+        with tracer.span("prepare"):
+            data, Fs = decoder.prepare_channels(data, self.Fs, profile)
+        fingerprint_times.append(time() - t)
+
+        executor = self.dejavu.get_fingerprint_executor()
+        if executor is not None:
+            t = time()
+            hashes = fingerprint_channels(data, Fs=Fs, executor=executor,
+                                          wsize=profile["window_size"], wratio=profile["overlap_ratio"])
+            fingerprint_times.append(time() - t)
+        else:
+            for channel in data:
+                fingerprints, fingerprint_time = self.dejavu.generate_fingerprints(channel, Fs=Fs)
+                fingerprint_times.append(fingerprint_time)
+                hashes |= set(fingerprints)
+
+        return hashes, np.sum(fingerprint_times)
+
+    def _match(self, hashes: Set[Tuple[str, int]]) -> Tuple[List[Dict[str, any]], float, float]:
+        hashes = self.dejavu.sample_query_hashes(hashes)
+        skipped = self._skip_common_hashes(hsh.upper() for hsh, _ in hashes)
+        with tracer.span("match", hashes=len(hashes), hashes_skipped=len(skipped)):
+            # the database doesn't probe the hash sketch again.
+            matches, dedup_hashes, query_time = self.dejavu.find_matches(hashes, skipped)
+
+        t = time()
+        with tracer.span("align") as span:
+            final_results = self.dejavu.align_matches(matches, dedup_hashes, len(hashes))
+            span.set(results=len(final_results))
+        align_time = time() - t
+
+        return final_results, query_time, align_time
+
+    async def _recognize_async(self, *data, file_hash: str = None) -> Tuple[List[Dict[str, any]], int, int, int]:
+        """
+        Same results as _recognize, but the channels are fingerprinted on the executor and
+        each channel's hashes are looked up as soon as they are ready, so the database
+        works while the remaining channels are still being fingerprinted.
+        """
+        loop = asyncio.get_event_loop()
+
+        t = time()
+        data, Fs = await loop.run_in_executor(
+            self.executor, decoder.prepare_channels, data, self.Fs, self.dejavu.profile)
+        fingerprint_times = [time() - t]
+
+        pending = [
+            loop.run_in_executor(self.executor, self.dejavu.generate_fingerprints, channel, Fs)
+            for channel in data
+        ]
+
+        hashes = set()  # to remove possible duplicated fingerprints we built a set.
+        looked_up = set()  # a hash found in several channels is looked up only once.
+        lookups = []
+        for done in asyncio.as_completed(pending):
+            fingerprints, fingerprint_time = await done
             fingerprint_times.append(fingerprint_time)
             hashes |= set(fingerprints)
 
-        matches, dedup_hashes, query_time = self.dejavu.find_matches(hashes)
+            values = set(build_hash_mapper(self.dejavu.sample_query_hashes(set(fingerprints))).keys()) - looked_up
+            looked_up |= values
+            values -= await self._skip_common_hashes_async(values)
+            lookups.append(asyncio.ensure_future(self._timed_lookup(list(values))))
+
+        if file_hash is not None:
+            await loop.run_in_executor(self.executor, self._cache_fingerprints, file_hash, hashes)
+
+        lookup_results = await asyncio.gather(*lookups)
+        rows = [row for lookup_rows, _ in lookup_results for row in lookup_rows]
+        query_time = sum(lookup_time for _, lookup_time in lookup_results)
 
         t = time()
-        final_results = self.dejavu.align_matches(matches, dedup_hashes, len(hashes))
+        hashes = self.dejavu.sample_query_hashes(hashes)
+        with tracer.span("postings", hashes=len(hashes)) as span:
+            matches, dedup_hashes = match_postings(build_hash_mapper(hashes), rows)
+            span.set(matches=len(matches), candidate_songs=len(dedup_hashes))
+        with tracer.span("align") as span:
+            final_results = await loop.run_in_executor(
+                self.executor, self.dejavu.align_matches, matches, dedup_hashes, len(hashes))
+            span.set(results=len(final_results))
         align_time = time() - t
 
         return final_results, np.sum(fingerprint_times), query_time, align_time
 
+    async def _match_async(self, hashes: Set[Tuple[str, int]]) -> Tuple[List[Dict[str, any]], float, float]:
+        """
+        Asynchronous version of _match, for hashes already computed.
+        """
+        loop = asyncio.get_event_loop()
+        hashes = self.dejavu.sample_query_hashes(hashes)
+        mapper = build_hash_mapper(hashes)
+        rows, query_time = await self._timed_lookup(
+            list(set(mapper.keys()) - await self._skip_common_hashes_async(mapper)))
+
+        t = time()
+        matches, dedup_hashes = match_postings(mapper, rows)
+        final_results = await loop.run_in_executor(
+            self.executor, self.dejavu.align_matches, matches, dedup_hashes, len(hashes))
+        align_time = time() - t
+
+        return final_results, query_time, align_time
+
+    def _skip_common_hashes(self, hashes: Iterable[str]) -> Set[str]:
+        """
+        Picks the query hashes the database estimates to have too many fingerprints, and counts them.
+
+        :param hashes: upper cased hashes, in hexadecimal format.
+        :return: the hashes not to look up.
+        """
+        return self._count_skipped(self.dejavu.db.hashes_to_skip(hashes))
+
+    async def _skip_common_hashes_async(self, hashes: Iterable[str]) -> Set[str]:
+        """
+        Asynchronous version of _skip_common_hashes, a hash sketch still to build doesn't block the event loop.
+
+        :param hashes: upper cased hashes, in hexadecimal format.
+        :return: the hashes not to look up.
+        """
+        return self._count_skipped(await self.dejavu.db.hashes_to_skip_async(hashes))
+
+    def _count_skipped(self, skipped: Dict[str, int]) -> Set[str]:
+        self.hashes_skipped += len(skipped)
+        self.rows_skipped += sum(skipped.values())
+        return set(skipped)
+
+    def _cached_fingerprints(self, file_name: str) -> Tuple[str, Set[Tuple[str, int]]]:
+        """
+        Looks for the fingerprints of a file in the fingerprint cache of dejavu.
+
+        :param file_name: file to be recognized.
+        :return: the hash of the file and its cached fingerprints, if any. Both are None without a cache.
+        """
+        cache = self.dejavu.fingerprint_cache
+        if cache is None:
+            return None, None
+
+        file_hash = decoder.unique_hash(file_name)
+        cached = cache.get(file_hash, self.dejavu.profile, self.dejavu.limit)
+        return file_hash, set(unpack_hashes(*cached)) if cached is not None else None
+
+    def _cache_fingerprints(self, file_hash: str, hashes: Set[Tuple[str, int]]) -> None:
+        cache = self.dejavu.fingerprint_cache
+        if cache is not None:
+            cache.put(file_hash, self.dejavu.profile, self.dejavu.limit, *pack_hashes(hashes))
+
+    async def _timed_lookup(self, hashes: List[str]) -> Tuple[List[Tuple[str, int, int]], float]:
+        t = time()
+        with tracer.span("lookup", hashes=len(hashes)) as span:
+            rows = await self.dejavu.db.lookup_hashes_async(hashes)
+            span.set(rows=len(rows))
+        lookup_time = time() - t
+        metrics.observe(LOOKUP, lookup_time)
+        metrics.inc(ROWS_FETCHED, len(rows))
+        return rows, lookup_time
+
     @abc.abstractmethod
     def recognize(self) -> Dict[str, any]:
         pass  # base class does nothing
+
+    async def recognize_async(self, *options, **kwoptions) -> Dict[str, any]:
+        """
+        Recognizers without an asynchronous implementation run the synchronous one on the executor.
+        """
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, lambda: self.recognize(*options, **kwoptions))
@@ -1,7 +1,12 @@
 import abc
-from typing import Dict, List, Tuple
+from itertools import islice
+from time import perf_counter
+from typing import Dict, Iterable, Iterator, List, Tuple
 
 from dejavu.base_classes.base_database import BaseDatabase
+from dejavu.logic.matcher import build_hash_mapper, match_postings
+from dejavu.logic.metrics import INSERT, metrics
+from dejavu.logic.tracing import tracer
 
 
 class CommonDatabase(BaseDatabase, metaclass=abc.ABCMeta):
@@ -33,6 +38,8 @@ class CommonDatabase(BaseDatabase, metaclass=abc.ABCMeta):
         with self.cursor() as cur:
             cur.execute(self.CREATE_SONGS_TABLE)
             cur.execute(self.CREATE_FINGERPRINTS_TABLE)
+            cur.execute(self.CREATE_METADATA_TABLE)
+            cur.execute(self.CREATE_STOP_HASHES_TABLE)
             cur.execute(self.DELETE_UNFINGERPRINTED)
 
     def empty(self) -> None:
@@ -42,6 +49,8 @@ class CommonDatabase(BaseDatabase, metaclass=abc.ABCMeta):
         with self.cursor() as cur:
             cur.execute(self.DROP_FINGERPRINTS)
             cur.execute(self.DROP_SONGS)
+            cur.execute(self.DROP_METADATA)
+            cur.execute(self.DROP_STOP_HASHES)
 
         self.setup()
 
@@ -77,6 +86,19 @@ class CommonDatabase(BaseDatabase, metaclass=abc.ABCMeta):
 
         return count
 
+    def get_fingerprints_size(self) -> Tuple[int, int]:
+        """
+        Returns the space taken by the fingerprints, as reported by the database, which may
+        lag behind the latest inserts.
+
+        :return: the bytes taken by the fingerprint rows and by the indexes on them.
+        """
+        with self.cursor() as cur:
+            cur.execute(self.SELECT_FINGERPRINTS_SIZE)
+            data_size, index_size = cur.fetchone()
+
+        return int(data_size), int(index_size)
+
     def set_song_fingerprinted(self, song_id):
         """
         Sets a specific song as having all fingerprints in the database.
@@ -86,6 +108,16 @@ class CommonDatabase(BaseDatabase, metaclass=abc.ABCMeta):
         with self.cursor() as cur:
             cur.execute(self.UPDATE_SONG_FINGERPRINTED, (song_id,))
 
+    def set_song_total_hashes(self, song_id: int, total_hashes: int) -> None:
+        """
+        Sets the amount of fingerprints of a song, for songs inserted before all of them were known.
+
+        :param song_id: song identifier.
+        :param total_hashes: amount of hashes inserted on fingerprint table.
+        """
+        with self.cursor() as cur:
+            cur.execute(self.UPDATE_SONG_TOTAL_HASHES, (total_hashes, song_id))
+
     def get_songs(self) -> List[Dict[str, str]]:
         """
         Returns all fully fingerprinted songs in the database
@@ -118,12 +150,25 @@ class CommonDatabase(BaseDatabase, metaclass=abc.ABCMeta):
         with self.cursor() as cur:
             cur.execute(self.INSERT_FINGERPRINT, (fingerprint, song_id, offset))
 
-    @abc.abstractmethod
     def insert_song(self, song_name: str, file_hash: str, total_hashes: int) -> int:
         """
         Inserts a song name into the database, returns the new
         identifier of the song.
 
+        :param song_name: The name of the song.
+        :param file_hash: Hash from the fingerprinted file.
+        :param total_hashes: amount of hashes to be inserted on fingerprint table.
+        :return: the inserted id.
+        """
+        with self.cursor() as cur:
+            return self.execute_insert_song(cur, song_name, file_hash, total_hashes)
+
+    @abc.abstractmethod
+    def execute_insert_song(self, cur, song_name: str, file_hash: str, total_hashes: int) -> int:
+        """
+        Runs the song insert on the given cursor, so it can be part of a larger transaction.
+
+        :param cur: open cursor.
         :param song_name: The name of the song.
         :param file_hash: Hash from the fingerprinted file.
         :param total_hashes: amount of hashes to be inserted on fingerprint table.
@@ -131,6 +176,46 @@ class CommonDatabase(BaseDatabase, metaclass=abc.ABCMeta):
         """
         pass
 
+    def insert_song_hashes(self, song_name: str, file_hash: str, hashes: Iterable[Tuple[str, int]],
+                           batch_size: int = 1000) -> int:
+        """
+        Inserts a song together with all its fingerprints and sets it as fingerprinted, in a
+        single transaction: if anything fails nothing of the song is stored. Hashes are consumed
+        as they are inserted, so they can be generated on the fly.
+
+        :param song_name: The name of the song.
+        :param file_hash: Hash from the fingerprinted file.
+        :param hashes: A sequence of tuples in the format (hash, offset)
+            - hash: Part of a sha1 hash, in hexadecimal format
+            - offset: Offset this hash was created from/at.
+        :param batch_size: insert batches.
+        :return: the inserted song id.
+        """
+        # hashes generated on the fly are timed by their own stages, the insert is the time left.
+        t = perf_counter()
+        generating = 0
+        # counted once the transaction is committed, a rolled back song must not be.
+        inserted = []
+        with self.cursor() as cur:
+            song_id = self.execute_insert_song(cur, song_name, file_hash, 0)
+
+            hashes = iter(hashes)
+            while True:
+                generated = perf_counter()
+                values = [(song_id, hsh, int(offset)) for hsh, offset in islice(hashes, batch_size)]
+                generating += perf_counter() - generated
+                if not values:
+                    break
+                cur.executemany(self.INSERT_FINGERPRINT, values)
+                inserted.extend(hsh for _, hsh, _ in values)
+
+            cur.execute(self.UPDATE_SONG_TOTAL_HASHES, (len(inserted), song_id))
+            cur.execute(self.UPDATE_SONG_FINGERPRINTED, (song_id,))
+
+        metrics.observe(INSERT, perf_counter() - t - generating)
+        self._count_hashes(inserted)
+        return song_id
+
     def query(self, fingerprint: str = None) -> List[Tuple]:
         """
         Returns all matching fingerprint entries associated with
@@ -146,6 +231,50 @@ class CommonDatabase(BaseDatabase, metaclass=abc.ABCMeta):
                 cur.execute(self.SELECT_ALL)
             return list(cur)
 
+    def iter_fingerprints(self, batch_size: int = 100000) -> Iterator[List[Tuple[str, int, int]]]:
+        """
+        Goes through every fingerprint in the database without loading them all at once,
+        the rows are streamed from the server as they are consumed.
+
+        :param batch_size: number of fingerprints in each batch.
+        :return: an iterator of lists of (hash, song_id, offset) rows, hashes in upper case hexadecimal.
+        """
+        with self.cursor(server_side=True) as cur:
+            cur.execute(self.SELECT_ALL_FINGERPRINTS)
+            while True:
+                rows = cur.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield [tuple(row) for row in rows]
+
+    def insert_fingerprint_rows(self, rows: Iterable[Tuple[int, str, int]], batch_size: int = 1000) -> None:
+        """
+        Inserts fingerprints of any number of songs at once, in a single transaction.
+
+        :param rows: A sequence of tuples in the format (song_id, hash, offset)
+            - song_id: Song identifier the fingerprint belongs to
+            - hash: Part of a sha1 hash, in hexadecimal format
+            - offset: Offset this hash was created from/at.
+        :param batch_size: insert batches.
+        """
+        # as in insert_song_hashes, the time spent generating the rows is not part of the insert.
+        t = perf_counter()
+        generating = 0
+        inserted = []
+        rows = iter(rows)
+        with self.cursor() as cur:
+            while True:
+                generated = perf_counter()
+                values = [(song_id, hsh, int(offset)) for song_id, hsh, offset in islice(rows, batch_size)]
+                generating += perf_counter() - generated
+                if not values:
+                    break
+                cur.executemany(self.INSERT_FINGERPRINT, values)
+                inserted.extend(hsh for _, hsh, _ in values)
+
+        metrics.observe(INSERT, perf_counter() - t - generating)
+        self._count_hashes(inserted)
+
     def get_iterable_kv_pairs(self) -> List[Tuple]:
         """
         Returns all fingerprints in the database.
@@ -166,12 +295,14 @@ class CommonDatabase(BaseDatabase, metaclass=abc.ABCMeta):
         """
         values = [(song_id, hsh, int(offset)) for hsh, offset in hashes]
 
-        with self.cursor() as cur:
+        with metrics.timing(INSERT), self.cursor() as cur:
             for index in range(0, len(hashes), batch_size):
                 cur.executemany(self.INSERT_FINGERPRINT, values[index: index + batch_size])
 
-    def return_matches(self, hashes: List[Tuple[str, int]],
-                       batch_size: int = 1000) -> Tuple[List[Tuple[int, int]], Dict[int, int]]:
+        self._count_hashes([hsh for hsh, _ in hashes])
+
+    def return_matches(self, hashes: List[Tuple[str, int]], batch_size: int = 1000,
+                       skipped: Iterable[str] = None) -> Tuple[List[Tuple[int, int]], Dict[int, int]]:
         """
         Searches the database for pairs of (hash, offset) values.
 
@@ -179,43 +310,40 @@ class CommonDatabase(BaseDatabase, metaclass=abc.ABCMeta):
             - hash: Part of a sha1 hash, in hexadecimal format
             - offset: Offset this hash was created from/at.
         :param batch_size: number of query's batches.
+        :param skipped: upper cased hashes not to look up, picked with hashes_to_skip when not given.
         :return: a list of (sid, offset_difference) tuples and a
         dictionary with the amount of hashes matched (not considering
         duplicated hashes) in each song.
             - song id: Song identifier
             - offset_difference: (database_offset - sampled_offset)
         """
-        # Create a dictionary of hash => offset pairs for later lookups
-        mapper = {}
-        for hsh, offset in hashes:
-            if hsh.upper() in mapper.keys():
-                mapper[hsh.upper()].append(offset)
-            else:
-                mapper[hsh.upper()] = [offset]
+        mapper = build_hash_mapper(hashes)
+        for hsh in self.hashes_to_skip(mapper) if skipped is None else skipped:
+            mapper.pop(hsh, None)
 
-        values = list(mapper.keys())
+        rows = self._lookup_rows(list(mapper.keys()), batch_size)
+        with tracer.span("postings", hashes=len(mapper)) as span:
+            matches, dedup_hashes = match_postings(mapper, rows)
+            span.set(matches=len(matches), candidate_songs=len(dedup_hashes))
+        return matches, dedup_hashes
 
-        # in order to count each hash only once per db offset we use the dic below
-        dedup_hashes = {}
+    def lookup_hashes(self, hashes: List[str], batch_size: int = 1000) -> Iterator[Tuple[str, int, int]]:
+        """
+        Streams every fingerprint stored for the given hashes.
 
-        results = []
+        :param hashes: upper cased hashes, in hexadecimal format, to look for.
+        :param batch_size: number of query's batches.
+        :return: an iterator of (hash, song_id, offset) rows.
+        """
         with self.cursor() as cur:
-            for index in range(0, len(values), batch_size):
+            for index in range(0, len(hashes), batch_size):
                 # Create our IN part of the query
-                query = self.SELECT_MULTIPLE % ', '.join([self.IN_MATCH] * len(values[index: index + batch_size]))
-
-                cur.execute(query, values[index: index + batch_size])
+                query = self.SELECT_MULTIPLE % ', '.join([self.IN_MATCH] * len(hashes[index: index + batch_size]))
 
-                for hsh, sid, offset in cur:
-                    if sid not in dedup_hashes.keys():
-                        dedup_hashes[sid] = 1
-                    else:
-                        dedup_hashes[sid] += 1
-                    #  we now evaluate all offset for each  hash matched
-                    for song_sampled_offset in mapper[hsh]:
-                        results.append((sid, offset - song_sampled_offset))
+                with tracer.span("sql", hashes=len(hashes[index: index + batch_size])):
+                    cur.execute(query, hashes[index: index + batch_size])
 
-            return results, dedup_hashes
+                yield from cur
 
     def delete_songs_by_id(self, song_ids: List[int], batch_size: int = 1000) -> None:
         """
@@ -224,9 +352,109 @@ class CommonDatabase(BaseDatabase, metaclass=abc.ABCMeta):
         :param song_ids: song ids to be deleted from the database.
         :param batch_size: number of query's batches.
         """
+        # counted once the transaction is committed, as for inserts.
+        deleted = []
         with self.cursor() as cur:
             for index in range(0, len(song_ids), batch_size):
                 # Create our IN part of the query
-                query = self.DELETE_SONGS % ', '.join(['%s'] * len(song_ids[index: index + batch_size]))
+                in_values = ', '.join(['%s'] * len(song_ids[index: index + batch_size]))
+
+                if self.hash_sketch is not None:
+                    cur.execute(self.SELECT_SONGS_HASHES % in_values, song_ids[index: index + batch_size])
+                    deleted.extend(row[0] for row in cur)
+
+                cur.execute(self.DELETE_SONGS % in_values, song_ids[index: index + batch_size])
+
+        self._count_hashes(deleted, removed=True)
 
-                cur.execute(query, song_ids[index: index + batch_size])
+    def find_common_hashes(self, max_songs: int, song_id: int = None) -> Dict[str, int]:
+        """
+        Counts in how many songs each hash shows up, its document frequency, and brings
+        the ones found in too many songs to tell any of them apart.
+
+        :param max_songs: hashes found in more songs than this are brought.
+        :param song_id: if given only the hashes of this song are counted, as when it was just stored.
+        :return: a dictionary with the number of songs of each hash, hashes in upper case hexadecimal.
+        """
+        with self.cursor() as cur:
+            if song_id is None:
+                cur.execute(self.SELECT_COMMON_HASHES, (max_songs,))
+            else:
+                cur.execute(self.SELECT_SONG_COMMON_HASHES, (song_id, max_songs))
+            return {hsh: songs for hsh, songs in cur}
+
+    def prune_hashes(self, hashes: Dict[str, int], batch_size: int = 1000) -> int:
+        """
+        Records hashes as stop hashes and deletes all their fingerprints, in a single transaction.
+
+        :param hashes: number of songs of each hash, as given by find_common_hashes.
+        :param batch_size: number of query's batches.
+        :return: the number of fingerprints deleted.
+        """
+        values = list(hashes.items())
+        deleted = 0
+        # counted once the transaction is committed, as for inserts.
+        removed = []
+        with self.cursor() as cur:
+            for index in range(0, len(values), batch_size):
+                batch = values[index: index + batch_size]
+                if self.hash_sketch is not None:
+                    removed.extend(hsh for hsh, _, _ in self.lookup_hashes([hsh for hsh, _ in batch]))
+
+                cur.executemany(self.INSERT_STOP_HASH, batch)
+
+                # Create our IN part of the query
+                query = self.DELETE_HASHES % ', '.join([self.IN_MATCH] * len(batch))
+                cur.execute(query, [hsh for hsh, _ in batch])
+                deleted += cur.rowcount
+
+        self._count_hashes(removed, removed=True)
+        return deleted
+
+    def get_stop_hashes(self) -> Dict[str, int]:
+        """
+        Brings the hashes pruned so far, fingerprints with them are not stored anymore.
+
+        :return: the number of songs of each stop hash when it was pruned, hashes in upper case hexadecimal.
+        """
+        with self.cursor() as cur:
+            cur.execute(self.SELECT_STOP_HASHES)
+            return {hsh: songs for hsh, songs in cur}
+
+    def get_metadata(self, name: str) -> str:
+        """
+        Brings a value describing the whole database, such as the fingerprinting profile it was built with.
+
+        :param name: name of the entry.
+        :return: the stored value, or None if it was never set.
+        """
+        try:
+            with self.cursor() as cur:
+                cur.execute(self.SELECT_METADATA, (name,))
+                row = cur.fetchone()
+        except Exception as e:
+            # databases from before the metadata table, opened read only, don't have it.
+            if not self._is_missing_table(e):
+                raise
+            return None
+
+        return row[0] if row else None
+
+    def set_metadata(self, name: str, value: str) -> None:
+        """
+        Stores a value describing the whole database, replacing the previous one.
+
+        :param name: name of the entry.
+        :param value: value to store.
+        """
+        with self.cursor() as cur:
+            cur.execute(self.INSERT_METADATA, (name, value))
+
+    def _is_missing_table(self, error: Exception) -> bool:
+        """
+        Whether an error raised by the database driver comes from querying a table that doesn't exist.
+
+        :param error: the error raised.
+        :return: True if the table queried doesn't exist.
+        """
+        return False
@@ -21,13 +21,17 @@ TOTAL_TIME = 'total_time'
 FINGERPRINT_TIME = 'fingerprint_time'
 QUERY_TIME = 'query_time'
 ALIGN_TIME = 'align_time'
+# Query hashes left out for having too many fingerprints, and the fingerprints not brought for them.
+HASHES_SKIPPED = 'hashes_skipped'
+ROWS_SKIPPED = 'rows_skipped'
 OFFSET = 'offset'
 OFFSET_SECS = 'offset_seconds'
 
 # DATABASE CLASS INSTANCES:
 DATABASES = {
     'mysql': ("dejavu.database_handler.mysql_database", "MySQLDatabase"),
-    'postgres': ("dejavu.database_handler.postgres_database", "PostgreSQLDatabase")
+    'postgres': ("dejavu.database_handler.postgres_database", "PostgreSQLDatabase"),
+    'memory': ("dejavu.database_handler.memory_database", "MemoryDatabase")
 }
 
 # TABLE SONGS
@@ -47,6 +51,26 @@ FINGERPRINTS_TABLENAME = "fingerprints"
 FIELD_HASH = 'hash'
 FIELD_OFFSET = 'offset'
 
+# TABLE METADATA
+METADATA_TABLENAME = "metadata"
+
+# METADATA FIELDS
+FIELD_METADATA_NAME = 'name'
+FIELD_METADATA_VALUE = 'value'
+
+# TABLE STOP HASHES
+STOP_HASHES_TABLENAME = "stop_hashes"
+
+# STOP HASHES FIELDS
+# number of songs the hash was found in when it was pruned.
+FIELD_SONGS = 'songs'
+
+# METADATA ENTRIES
+# Fingerprinting profile the database was built with, see FINGERPRINT_PROFILES.
+METADATA_PROFILE = 'fingerprint_profile'
+# One hash out of how many is stored and looked up, see the "hash_sample_ratio" option.
+METADATA_HASH_SAMPLE_RATIO = 'hash_sample_ratio'
+
 # FINGERPRINTS CONFIG:
 # This is used as connectivity parameter for scipy.generate_binary_structure function. This parameter
 # changes the morphology mask when looking for maximum peaks on the spectrogram matrix.
@@ -88,6 +112,16 @@ PEAK_NEIGHBORHOOD_SIZE = 10  # 20 was the original value.
 MIN_HASH_TIME_DELTA = 0
 MAX_HASH_TIME_DELTA = 200
 
+# Number of spectrogram frames fingerprinted by each task when a file is fingerprinted in parallel,
+# every task also computes PEAK_NEIGHBORHOOD_SIZE frames on each side and MAX_HASH_TIME_DELTA
+# frames after the segment, so smaller values mean more repeated work.
+FINGERPRINT_SEGMENT_FRAMES = 2048
+
+# Number of spectrogram frames fingerprinted at a time when reading long recordings in chunks,
+# it bounds the memory used no matter the length of the file (the default window and overlap
+# give about 95 seconds of audio per chunk).
+FINGERPRINT_CHUNK_FRAMES = 2048
+
 # If True, will sort peaks temporally for fingerprinting;
 # not sorting will cut down number of fingerprints, but potentially
 # affect performance.
@@ -98,5 +132,88 @@ PEAK_SORT = True
 # with potentially lesser collisions of matches.
 FINGERPRINT_REDUCTION = 20
 
+# FINGERPRINT PROFILES:
+# A profile states how the audio is prepared before being fingerprinted. It is stored in the
+# database the first time it is used, from then on every song and every query is fingerprinted
+# with it, otherwise hashes would never match. Choose one with the "fingerprint_profile" option.
+# - mono: if True the channels are downmixed into one, if False each channel is fingerprinted
+#   on its own and their hashes are merged.
+# - sample_rate: rate the audio is resampled to, None keeps the rate of every file.
+# - window_size and overlap_ratio: FFT window and overlap. When resampling, scaling the window
+#   by the same factor keeps both the frequency resolution and the duration of each frame.
+FINGERPRINT_PROFILES = {
+    "default": {
+        "mono": False,
+        "sample_rate": None,
+        "window_size": DEFAULT_WINDOW_SIZE,
+        "overlap_ratio": DEFAULT_OVERLAP_RATIO
+    },
+    # A quarter of the samples of a 44.1 kHz file, keeps frequencies up to 5.5 kHz.
+    "mono_11k": {
+        "mono": True,
+        "sample_rate": 11025,
+        "window_size": 1024,
+        "overlap_ratio": DEFAULT_OVERLAP_RATIO
+    }
+}
+
+# Profile used by databases created without the "fingerprint_profile" option, and by
+# databases created before profiles existed.
+DEFAULT_FINGERPRINT_PROFILE = "default"
+
+# Number of directories listed at the same time when looking for files to fingerprint. Listing
+# is mostly waiting on the file system, network shares in particular, so it runs on threads.
+DISCOVERY_WORKERS = 8
+
+# Maximum number of bytes taken on disk by the fingerprint cache, when the "fingerprint_cache"
+# option is set. Cached files take about 14 bytes per fingerprint.
+FINGERPRINT_CACHE_SIZE = 2 * 1024 ** 3
+
+# Number of songs written in each fingerprint shard file by export_shards.
+SHARD_SONGS = 100
+
+# Number of fingerprints read from the database and written at a time when taking a snapshot.
+SNAPSHOT_BATCH_SIZE = 100000
+
 # Number of results being returned for file recognition
 TOPN = 2
+
+# RECOGNITION SERVER:
+# Address the recognition server listens on when none is given, use "unix:/path/to/socket"
+# to listen on a Unix socket instead.
+DEFAULT_SERVER_ADDRESS = "127.0.0.1:8000"
+
+# Maximum number of requests being fingerprinted or waiting for the database at the same time.
+# Requests above this limit are rejected straight away instead of piling up.
+SERVER_MAX_QUEUE = 64
+
+# Seconds to wait for other requests to join a database lookup, and maximum number of
+# requests sharing it. Concurrent requests are looked up with a single query per batch.
+SERVER_BATCH_WINDOW = 0.005
+SERVER_MAX_BATCH = 32
+
+# Number of batched lookups allowed to hit the database at the same time.
+SERVER_DB_CONCURRENCY = 4
+
+# Largest request body accepted, in bytes. Bodies are held in memory while the audio is
+# fingerprinted, larger ones are refused before being read.
+SERVER_MAX_BODY = 64 * 1024 * 1024
+
+# Size of the count-min sketch of hash frequencies, when the "skip_hash_rows" option is set. It
+# takes HASH_SKETCH_WIDTH * HASH_SKETCH_DEPTH * 4 bytes (16MB) and overestimates the number of
+# fingerprints of a hash by less than 2.7 * fingerprints / HASH_SKETCH_WIDTH most of the time.
+HASH_SKETCH_WIDTH = 2 ** 20
+HASH_SKETCH_DEPTH = 4
+
+# METRICS:
+# Upper bounds, in seconds, of the buckets of the stage latency histograms, when the
+# "metrics_file" or "metrics_address" options are set.
+METRICS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# TRACING:
+# Recognitions and fingerprinted files taking at least this many seconds are written to the
+# slow log, when the "trace_file" option is set. Overridden by the "trace_threshold" option.
+TRACE_THRESHOLD = 1
+# Fraction of the recognitions and fingerprinted files traced, the others record nothing.
+# Overridden by the "trace_sample_rate" option.
+TRACE_SAMPLE_RATE = 1
@@ -0,0 +1,373 @@
+import asyncio
+import sys
+import threading
+from datetime import datetime
+from time import sleep
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+from dejavu.base_classes.base_database import BaseDatabase
+from dejavu.config.settings import (FIELD_FILE_SHA1, FIELD_FINGERPRINTED,
+                                    FIELD_SONG_ID, FIELD_SONGNAME,
+                                    FIELD_TOTAL_HASHES)
+from dejavu.logic.matcher import build_hash_mapper, match_postings
+from dejavu.logic.metrics import INSERT, metrics
+from dejavu.logic.tracing import tracer
+
+
+class MemoryDatabase(BaseDatabase):
+    """
+    In-process stand-in database, meant for tests and benchmarks. Nothing is persisted.
+
+    Lookups can be slowed down by a fixed latency per batch to mimic the round trip to
+    a database server, the asynchronous lookups wait for it without blocking the event loop.
+    """
+    type = "memory"
+    # every process has its own copy of the data.
+    shared_across_processes = False
+
+    def __init__(self, latency: float = 0.0, **options):
+        """
+        :param latency: seconds each lookup batch takes, simulating a database round trip.
+        """
+        super().__init__()
+        self.latency = latency
+        self._options = options
+        self._lock = threading.Lock()
+        self._init_storage()
+
+    def _init_storage(self) -> None:
+        self.songs = {}
+        # hash => set of (song_id, offset)
+        self.fingerprints = {}
+        # song_id => set of hashes, to delete songs without a full scan.
+        self.song_hashes = {}
+        self.next_song_id = 1
+        self.metadata = {}
+        # hash => number of songs it was found in when pruned.
+        self.stop_hashes = {}
+
+    def empty(self) -> None:
+        """
+        Called when the database should be cleared of all data.
+        """
+        with self._lock:
+            self._init_storage()
+
+    def delete_unfingerprinted_songs(self) -> None:
+        """
+        Called to remove any song entries that do not have any fingerprints
+        associated with them.
+        """
+        song_ids = [sid for sid, song in self.songs.items() if not song[FIELD_FINGERPRINTED]]
+        self.delete_songs_by_id(song_ids)
+
+    def get_num_songs(self) -> int:
+        """
+        Returns the song's count stored.
+
+        :return: the amount of songs in the database.
+        """
+        return len([song for song in self.songs.values() if song[FIELD_FINGERPRINTED]])
+
+    def get_num_fingerprints(self) -> int:
+        """
+        Returns the fingerprints' count stored.
+
+        :return: the number of fingerprints in the database.
+        """
+        return sum(len(postings) for postings in self.fingerprints.values())
+
+    def get_fingerprints_size(self) -> Tuple[int, int]:
+        """
+        Returns the memory taken by the fingerprints, an estimate going through every object
+        holding them.
+
+        :return: the bytes taken by the (song_id, offset) postings and by the dictionaries
+        of hashes leading to them.
+        """
+        with self._lock:
+            data_size = 0
+            index_size = sys.getsizeof(self.fingerprints) + sys.getsizeof(self.song_hashes)
+            for hsh, postings in self.fingerprints.items():
+                index_size += sys.getsizeof(hsh)
+                data_size += sys.getsizeof(postings) + sum(
+                    sys.getsizeof(posting) + sys.getsizeof(posting[1]) for posting in postings)
+            for hashes in self.song_hashes.values():
+                index_size += sys.getsizeof(hashes)
+
+        return data_size, index_size
+
+    def set_song_fingerprinted(self, song_id: int):
+        """
+        Sets a specific song as having all fingerprints in the database.
+
+        :param song_id: song identifier.
+        """
+        self.songs[song_id][FIELD_FINGERPRINTED] = 1
+
+    def set_song_total_hashes(self, song_id: int, total_hashes: int) -> None:
+        """
+        Sets the amount of fingerprints of a song, for songs inserted before all of them were known.
+
+        :param song_id: song identifier.
+        :param total_hashes: amount of hashes inserted on fingerprint table.
+        """
+        self.songs[song_id][FIELD_TOTAL_HASHES] = total_hashes
+
+    def get_songs(self) -> List[Dict[str, str]]:
+        """
+        Returns all fully fingerprinted songs in the database
+
+        :return: a dictionary with the songs info.
+        """
+        return [dict(song) for song in self.songs.values() if song[FIELD_FINGERPRINTED]]
+
+    def get_song_by_id(self, song_id: int) -> Dict[str, str]:
+        """
+        Brings the song info from the database.
+
+        :param song_id: song identifier.
+        :return: a song by its identifier. Result must be a Dictionary.
+        """
+        song = self.songs.get(song_id)
+        return dict(song) if song else None
+
+    def insert(self, fingerprint: str, song_id: int, offset: int):
+        """
+        Inserts a single fingerprint into the database.
+
+        :param fingerprint: Part of a sha1 hash, in hexadecimal format
+        :param song_id: Song identifier this fingerprint is off
+        :param offset: The offset this fingerprint is from.
+        """
+        self.insert_hashes(song_id, [(fingerprint, offset)])
+
+    def insert_song(self, song_name: str, file_hash: str, total_hashes: int) -> int:
+        """
+        Inserts a song name into the database, returns the new
+        identifier of the song.
+
+        :param song_name: The name of the song.
+        :param file_hash: Hash from the fingerprinted file.
+        :param total_hashes: amount of hashes to be inserted on fingerprint table.
+        :return: the inserted id.
+        """
+        with self._lock:
+            song_id = self.next_song_id
+            self.next_song_id += 1
+            self.songs[song_id] = {
+                FIELD_SONG_ID: song_id,
+                FIELD_SONGNAME: song_name,
+                FIELD_FILE_SHA1: file_hash.upper(),
+                FIELD_TOTAL_HASHES: total_hashes,
+                FIELD_FINGERPRINTED: 0,
+                "date_created": datetime.now()
+            }
+            self.song_hashes[song_id] = set()
+        return song_id
+
+    def query(self, fingerprint: str = None) -> List[Tuple]:
+        """
+        Returns all matching fingerprint entries associated with
+        the given hash as parameter, if None is passed it returns all entries.
+
+        :param fingerprint: part of a sha1 hash, in hexadecimal format
+        :return: a list of fingerprint records stored in the db.
+        """
+        if fingerprint:
+            return list(self.fingerprints.get(fingerprint.upper(), ()))
+        return [posting for postings in self.fingerprints.values() for posting in postings]
+
+    def get_iterable_kv_pairs(self) -> List[Tuple]:
+        """
+        Returns all fingerprints in the database.
+
+        :return: a list containing all fingerprints stored in the db.
+        """
+        return self.query(None)
+
+    @metrics.timed(INSERT)
+    def insert_hashes(self, song_id: int, hashes: List[Tuple[str, int]], batch_size: int = 1000) -> None:
+        """
+        Insert a multitude of fingerprints.
+
+        :param song_id: Song identifier the fingerprints belong to
+        :param hashes: A sequence of tuples in the format (hash, offset)
+            - hash: Part of a sha1 hash, in hexadecimal format
+            - offset: Offset this hash was created from/at.
+        :param batch_size: insert batches, unused.
+        """
+        with self._lock:
+            song_hashes = self.song_hashes[song_id]
+            for hsh, offset in hashes:
+                hsh = hsh.upper()
+                self.fingerprints.setdefault(hsh, set()).add((song_id, int(offset)))
+                song_hashes.add(hsh)
+            self._count_hashes([hsh for hsh, _ in hashes])
+
+    @metrics.timed(INSERT)
+    def insert_fingerprint_rows(self, rows: Iterable[Tuple[int, str, int]], batch_size: int = 1000) -> None:
+        """
+        Inserts fingerprints of any number of songs at once.
+
+        :param rows: A sequence of tuples in the format (song_id, hash, offset)
+            - song_id: Song identifier the fingerprint belongs to
+            - hash: Part of a sha1 hash, in hexadecimal format
+            - offset: Offset this hash was created from/at.
+        :param batch_size: insert batches, unused.
+        """
+        with self._lock:
+            counted = []
+            for song_id, hsh, offset in rows:
+                hsh = hsh.upper()
+                self.fingerprints.setdefault(hsh, set()).add((song_id, int(offset)))
+                self.song_hashes[song_id].add(hsh)
+                counted.append(hsh)
+            self._count_hashes(counted)
+
+    def iter_fingerprints(self, batch_size: int = 100000) -> Iterator[List[Tuple[str, int, int]]]:
+        """
+        Goes through every fingerprint in the database in batches.
+
+        :param batch_size: number of fingerprints in each batch.
+        :return: an iterator of lists of (hash, song_id, offset) rows, hashes in upper case hexadecimal.
+        """
+        with self._lock:
+            rows = [(hsh, sid, offset) for hsh, postings in self.fingerprints.items() for sid, offset in postings]
+        for index in range(0, len(rows), batch_size):
+            yield rows[index: index + batch_size]
+
+    def return_matches(self, hashes: List[Tuple[str, int]], batch_size: int = 1000,
+                       skipped: Iterable[str] = None) -> Tuple[List[Tuple[int, int]], Dict[int, int]]:
+        """
+        Searches the database for pairs of (hash, offset) values.
+
+        :param hashes: A sequence of tuples in the format (hash, offset)
+            - hash: Part of a sha1 hash, in hexadecimal format
+            - offset: Offset this hash was created from/at.
+        :param batch_size: number of query's batches.
+        :param skipped: upper cased hashes not to look up, picked with hashes_to_skip when not given.
+        :return: a list of (sid, offset_difference) tuples and a
+        dictionary with the amount of hashes matched (not considering
+        duplicated hashes) in each song.
+        """
+        mapper = build_hash_mapper(hashes)
+        for hsh in self.hashes_to_skip(mapper) if skipped is None else skipped:
+            mapper.pop(hsh, None)
+
+        rows = self._lookup_rows(list(mapper.keys()), batch_size)
+        with tracer.span("postings", hashes=len(mapper)) as span:
+            matches, dedup_hashes = match_postings(mapper, rows)
+            span.set(matches=len(matches), candidate_songs=len(dedup_hashes))
+        return matches, dedup_hashes
+
+    def lookup_hashes(self, hashes: List[str], batch_size: int = 1000) -> List[Tuple[str, int, int]]:
+        """
+        Searches the database for all the fingerprints of the given hashes.
+
+        :param hashes: upper cased hashes, in hexadecimal format, to look for.
+        :param batch_size: number of query's batches.
+        :return: a list of (hash, song_id, offset) rows.
+        """
+        rows = []
+        for index in range(0, len(hashes), batch_size):
+            if self.latency:
+                sleep(self.latency)
+            rows.extend(self._postings(hashes[index: index + batch_size]))
+        return rows
+
+    async def lookup_hashes_async(self, hashes: List[str], batch_size: int = 1000) -> List[Tuple[str, int, int]]:
+        """
+        Same as lookup_hashes, but yields to the event loop while the simulated round trip goes on.
+
+        :param hashes: upper cased hashes, in hexadecimal format, to look for.
+        :param batch_size: number of query's batches.
+        :return: a list of (hash, song_id, offset) rows.
+        """
+        rows = []
+        for index in range(0, len(hashes), batch_size):
+            await asyncio.sleep(self.latency)
+            rows.extend(self._postings(hashes[index: index + batch_size]))
+        return rows
+
+    def _postings(self, hashes: List[str]) -> List[Tuple[str, int, int]]:
+        return [(hsh, sid, offset) for hsh in hashes for sid, offset in self.fingerprints.get(hsh, ())]
+
+    def delete_songs_by_id(self, song_ids: List[int], batch_size: int = 1000) -> None:
+        """
+        Given a list of song ids it deletes all songs specified and their corresponding fingerprints.
+
+        :param song_ids: song ids to be deleted from the database.
+        :param batch_size: number of query's batches, unused.
+        """
+        with self._lock:
+            for song_id in song_ids:
+                self.songs.pop(song_id, None)
+                for hsh in self.song_hashes.pop(song_id, ()):
+                    postings = self.fingerprints[hsh]
+                    removed = [posting for posting in postings if posting[0] == song_id]
+                    postings.difference_update(removed)
+                    self._count_hashes([hsh] * len(removed), removed=True)
+                    if not postings:
+                        del self.fingerprints[hsh]
+
+    def find_common_hashes(self, max_songs: int, song_id: int = None) -> Dict[str, int]:
+        """
+        Counts in how many songs each hash shows up, its document frequency, and brings
+        the ones found in too many songs to tell any of them apart.
+
+        :param max_songs: hashes found in more songs than this are brought.
+        :param song_id: if given only the hashes of this song are counted, as when it was just stored.
+        :return: a dictionary with the number of songs of each hash, hashes in upper case hexadecimal.
+        """
+        with self._lock:
+            hashes = self.fingerprints if song_id is None else self.song_hashes.get(song_id, ())
+            songs = {hsh: len({sid for sid, _ in self.fingerprints[hsh]}) for hsh in hashes}
+        return {hsh: count for hsh, count in songs.items() if count > max_songs}
+
+    def prune_hashes(self, hashes: Dict[str, int], batch_size: int = 1000) -> int:
+        """
+        Records hashes as stop hashes and deletes all their fingerprints.
+
+        :param hashes: number of songs of each hash, as given by find_common_hashes.
+        :param batch_size: number of query's batches, unused.
+        :return: the number of fingerprints deleted.
+        """
+        deleted = 0
+        with self._lock:
+            for hsh, songs in hashes.items():
+                hsh = hsh.upper()
+                self.stop_hashes[hsh] = songs
+                postings = self.fingerprints.pop(hsh, ())
+                for sid, _ in postings:
+                    self.song_hashes[sid].discard(hsh)
+                self._count_hashes([hsh] * len(postings), removed=True)
+                deleted += len(postings)
+        return deleted
+
+    def get_stop_hashes(self) -> Dict[str, int]:
+        """
+        Brings the hashes pruned so far, fingerprints with them are not stored anymore.
+
+        :return: the number of songs of each stop hash when it was pruned, hashes in upper case hexadecimal.
+        """
+        with self._lock:
+            return dict(self.stop_hashes)
+
+    def get_metadata(self, name: str) -> str:
+        """
+        Brings a value describing the whole database, such as the fingerprinting profile it was built with.
+
+        :param name: name of the entry.
+        :return: the stored value, or None if it was never set.
+        """
+        return self.metadata.get(name)
+
+    def set_metadata(self, name: str, value: str) -> None:
+        """
+        Stores a value describing the whole database, replacing the previous one.
+
+        :param name: name of the entry.
+        :param value: value to store.
+        """
+        self.metadata[name] = value
@@ -1,13 +1,20 @@
 import queue
+from typing import Iterable, List, Tuple
 
 import mysql.connector
-from mysql.connector.errors import DatabaseError
+import numpy as np
+from mysql.connector import errorcode
 
 from dejavu.base_classes.common_database import CommonDatabase
 from dejavu.config.settings import (FIELD_FILE_SHA1, FIELD_FINGERPRINTED,
-                                    FIELD_HASH, FIELD_OFFSET, FIELD_SONG_ID,
-                                    FIELD_SONGNAME, FIELD_TOTAL_HASHES,
-                                    FINGERPRINTS_TABLENAME, SONGS_TABLENAME)
+                                    FIELD_HASH, FIELD_METADATA_NAME,
+                                    FIELD_METADATA_VALUE, FIELD_OFFSET,
+                                    FIELD_SONG_ID, FIELD_SONGNAME, FIELD_SONGS,
+                                    FIELD_TOTAL_HASHES, FINGERPRINTS_TABLENAME,
+                                    METADATA_TABLENAME, SONGS_TABLENAME,
+                                    STOP_HASHES_TABLENAME)
+from dejavu.logic.hash_arrays import unpack_hashes
+from dejavu.logic.metrics import INSERT, metrics
 
 
 class MySQLDatabase(CommonDatabase):
@@ -43,6 +50,26 @@ class MySQLDatabase(CommonDatabase):
     ) ENGINE=INNODB;
     """
 
+    CREATE_METADATA_TABLE = f"""
+        CREATE TABLE IF NOT EXISTS `{METADATA_TABLENAME}` (
+            `{FIELD_METADATA_NAME}` VARCHAR(64) NOT NULL
+        ,   `{FIELD_METADATA_VALUE}` VARCHAR(1024) NOT NULL
+        ,   `date_created` DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+        ,   `date_modified` DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+        ,   CONSTRAINT `pk_{METADATA_TABLENAME}_{FIELD_METADATA_NAME}` PRIMARY KEY (`{FIELD_METADATA_NAME}`)
+        ) ENGINE=INNODB;
+    """
+
+    CREATE_STOP_HASHES_TABLE = f"""
+        CREATE TABLE IF NOT EXISTS `{STOP_HASHES_TABLENAME}` (
+            `{FIELD_HASH}` BINARY(10) NOT NULL
+        ,   `{FIELD_SONGS}` INT UNSIGNED NOT NULL
+        ,   `date_created` DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+        ,   `date_modified` DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+        ,   CONSTRAINT `pk_{STOP_HASHES_TABLENAME}_{FIELD_HASH}` PRIMARY KEY (`{FIELD_HASH}`)
+        ) ENGINE=INNODB;
+    """
+
     # INSERTS (IGNORES DUPLICATES)
     INSERT_FINGERPRINT = f"""
         INSERT IGNORE INTO `{FINGERPRINTS_TABLENAME}` (
@@ -52,11 +79,34 @@ class MySQLDatabase(CommonDatabase):
         VALUES (%s, UNHEX(%s), %s);
     """
 
+    # Multi-row version of INSERT_FINGERPRINT, with a FINGERPRINT_VALUES per row.
+    INSERT_FINGERPRINTS = f"""
+        INSERT IGNORE INTO `{FINGERPRINTS_TABLENAME}` (
+                `{FIELD_SONG_ID}`
+            ,   `{FIELD_HASH}`
+            ,   `{FIELD_OFFSET}`)
+        VALUES %s;
+    """
+
+    FINGERPRINT_VALUES = "(%s, UNHEX(%s), %s)"
+
     INSERT_SONG = f"""
         INSERT INTO `{SONGS_TABLENAME}` (`{FIELD_SONGNAME}`,`{FIELD_FILE_SHA1}`,`{FIELD_TOTAL_HASHES}`)
         VALUES (%s, UNHEX(%s), %s);
     """
 
+    INSERT_METADATA = f"""
+        INSERT INTO `{METADATA_TABLENAME}` (`{FIELD_METADATA_NAME}`, `{FIELD_METADATA_VALUE}`)
+        VALUES (%s, %s)
+        ON DUPLICATE KEY UPDATE `{FIELD_METADATA_VALUE}` = VALUES(`{FIELD_METADATA_VALUE}`);
+    """
+
+    INSERT_STOP_HASH = f"""
+        INSERT INTO `{STOP_HASHES_TABLENAME}` (`{FIELD_HASH}`, `{FIELD_SONGS}`)
+        VALUES (UNHEX(%s), %s)
+        ON DUPLICATE KEY UPDATE `{FIELD_SONGS}` = VALUES(`{FIELD_SONGS}`);
+    """
+
     # SELECTS
     SELECT = f"""
         SELECT `{FIELD_SONG_ID}`, `{FIELD_OFFSET}`
@@ -72,6 +122,10 @@ class MySQLDatabase(CommonDatabase):
 
     SELECT_ALL = f"SELECT `{FIELD_SONG_ID}`, `{FIELD_OFFSET}` FROM `{FINGERPRINTS_TABLENAME}`;"
 
+    SELECT_ALL_FINGERPRINTS = f"""
+        SELECT HEX(`{FIELD_HASH}`), `{FIELD_SONG_ID}`, `{FIELD_OFFSET}` FROM `{FINGERPRINTS_TABLENAME}`;
+    """
+
     SELECT_SONG = f"""
         SELECT `{FIELD_SONGNAME}`, HEX(`{FIELD_FILE_SHA1}`) AS `{FIELD_FILE_SHA1}`, `{FIELD_TOTAL_HASHES}`
         FROM `{SONGS_TABLENAME}`
@@ -80,6 +134,13 @@ class MySQLDatabase(CommonDatabase):
 
     SELECT_NUM_FINGERPRINTS = f"SELECT COUNT(*) AS n FROM `{FINGERPRINTS_TABLENAME}`;"
 
+    # InnoDB statistics, refreshed after enough of the table changed or on ANALYZE TABLE.
+    SELECT_FINGERPRINTS_SIZE = f"""
+        SELECT `data_length`, `index_length`
+        FROM information_schema.tables
+        WHERE `table_schema` = DATABASE() AND `table_name` = '{FINGERPRINTS_TABLENAME}';
+    """
+
     SELECT_UNIQUE_SONG_IDS = f"""
         SELECT COUNT(`{FIELD_SONG_ID}`) AS n
         FROM `{SONGS_TABLENAME}`
@@ -97,15 +158,51 @@ class MySQLDatabase(CommonDatabase):
         WHERE `{FIELD_FINGERPRINTED}` = 1;
     """
 
+    SELECT_METADATA = f"""
+        SELECT `{FIELD_METADATA_VALUE}` FROM `{METADATA_TABLENAME}` WHERE `{FIELD_METADATA_NAME}` = %s;
+    """
+
+    SELECT_SONGS_HASHES = f"""
+        SELECT HEX(`{FIELD_HASH}`)
+        FROM `{FINGERPRINTS_TABLENAME}`
+        WHERE `{FIELD_SONG_ID}` IN (%s);
+    """
+
+    SELECT_STOP_HASHES = f"SELECT HEX(`{FIELD_HASH}`), `{FIELD_SONGS}` FROM `{STOP_HASHES_TABLENAME}`;"
+
+    # DOCUMENT FREQUENCY, the number of songs each hash shows up in.
+    SELECT_COMMON_HASHES = f"""
+        SELECT HEX(`{FIELD_HASH}`), COUNT(DISTINCT `{FIELD_SONG_ID}`)
+        FROM `{FINGERPRINTS_TABLENAME}`
+        GROUP BY `{FIELD_HASH}`
+        HAVING COUNT(DISTINCT `{FIELD_SONG_ID}`) > %s;
+    """
+
+    SELECT_SONG_COMMON_HASHES = f"""
+        SELECT HEX(`{FIELD_HASH}`), COUNT(DISTINCT `{FIELD_SONG_ID}`)
+        FROM `{FINGERPRINTS_TABLENAME}`
+        WHERE `{FIELD_HASH}` IN (
+            SELECT `{FIELD_HASH}` FROM `{FINGERPRINTS_TABLENAME}` WHERE `{FIELD_SONG_ID}` = %s
+        )
+        GROUP BY `{FIELD_HASH}`
+        HAVING COUNT(DISTINCT `{FIELD_SONG_ID}`) > %s;
+    """
+
     # DROPS
     DROP_FINGERPRINTS = f"DROP TABLE IF EXISTS `{FINGERPRINTS_TABLENAME}`;"
     DROP_SONGS = f"DROP TABLE IF EXISTS `{SONGS_TABLENAME}`;"
+    DROP_METADATA = f"DROP TABLE IF EXISTS `{METADATA_TABLENAME}`;"
+    DROP_STOP_HASHES = f"DROP TABLE IF EXISTS `{STOP_HASHES_TABLENAME}`;"
 
     # UPDATE
     UPDATE_SONG_FINGERPRINTED = f"""
         UPDATE `{SONGS_TABLENAME}` SET `{FIELD_FINGERPRINTED}` = 1 WHERE `{FIELD_SONG_ID}` = %s;
     """
 
+    UPDATE_SONG_TOTAL_HASHES = f"""
+        UPDATE `{SONGS_TABLENAME}` SET `{FIELD_TOTAL_HASHES}` = %s WHERE `{FIELD_SONG_ID}` = %s;
+    """
+
     # DELETES
     DELETE_UNFINGERPRINTED = f"""
         DELETE FROM `{SONGS_TABLENAME}` WHERE `{FIELD_FINGERPRINTED}` = 0;
@@ -115,6 +212,10 @@ class MySQLDatabase(CommonDatabase):
         DELETE FROM `{SONGS_TABLENAME}` WHERE `{FIELD_SONG_ID}` IN (%s);
     """
 
+    DELETE_HASHES = f"""
+        DELETE FROM `{FINGERPRINTS_TABLENAME}` WHERE `{FIELD_HASH}` IN (%s);
+    """
+
     # IN
     IN_MATCH = f"UNHEX(%s)"
 
@@ -123,24 +224,83 @@ class MySQLDatabase(CommonDatabase):
         self.cursor = cursor_factory(**options)
         self._options = options
 
+    def before_fork(self) -> None:
+        # Drop the cached connections, otherwise the new processes would
+        # share their sockets with this one.
+        self.cursor = cursor_factory(**self._options)
+
     def after_fork(self) -> None:
         # Clear the cursor cache, we don't want any stale connections from
         # the previous process.
-        Cursor.clear_cache()
+        self.cursor = cursor_factory(**self._options)
 
-    def insert_song(self, song_name: str, file_hash: str, total_hashes: int) -> int:
+    def execute_insert_song(self, cur, song_name: str, file_hash: str, total_hashes: int) -> int:
         """
-        Inserts a song name into the database, returns the new
-        identifier of the song.
+        Runs the song insert on the given cursor, so it can be part of a larger transaction.
 
+        :param cur: open cursor.
         :param song_name: The name of the song.
         :param file_hash: Hash from the fingerprinted file.
         :param total_hashes: amount of hashes to be inserted on fingerprint table.
         :return: the inserted id.
         """
-        with self.cursor() as cur:
-            cur.execute(self.INSERT_SONG, (song_name, file_hash, total_hashes))
-            return cur.lastrowid
+        cur.execute(self.INSERT_SONG, (song_name, file_hash, total_hashes))
+        return cur.lastrowid
+
+    def insert_song_hash_arrays(self, song_name: str, file_hash: str, hash_array: np.ndarray,
+                                offsets: np.ndarray) -> int:
+        """
+        Inserts a song and its packed fingerprints with multi-row INSERTs, in a single transaction.
+        mysql.connector only turns the executemany of plain "VALUES (%s, ...)" inserts into multi-row
+        ones, INSERT_FINGERPRINT goes through UNHEX so it would be sent one row at a time.
+
+        :param song_name: The name of the song.
+        :param file_hash: Hash from the fingerprinted file.
+        :param hash_array: (n, HASH_BYTES) uint8 array of hashes, as given by pack_hashes.
+        :param offsets: offsets of the hashes.
+        :return: the inserted song id.
+        """
+        hashes = unpack_hashes(hash_array, offsets)
+        with metrics.timing(INSERT), self.cursor() as cur:
+            song_id = self.execute_insert_song(cur, song_name, file_hash, len(offsets))
+            self._insert_rows(cur, [(song_id, hsh, offset) for hsh, offset in hashes])
+            cur.execute(self.UPDATE_SONG_FINGERPRINTED, (song_id,))
+
+        self._count_hashes([hsh for hsh, _ in hashes])
+        return song_id
+
+    def insert_fingerprint_rows(self, rows: Iterable[Tuple[int, str, int]], batch_size: int = 1000) -> None:
+        """
+        Inserts fingerprints of any number of songs at once with multi-row INSERTs, in a single
+        transaction. Rows already stored are ignored, as in the regular inserts.
+
+        :param rows: A sequence of tuples in the format (song_id, hash, offset)
+            - song_id: Song identifier the fingerprint belongs to
+            - hash: Part of a sha1 hash, in hexadecimal format
+            - offset: Offset this hash was created from/at.
+        :param batch_size: number of rows of each INSERT.
+        """
+        rows = list(rows)
+        with metrics.timing(INSERT), self.cursor() as cur:
+            self._insert_rows(cur, rows, batch_size)
+
+        self._count_hashes([hsh for _, hsh, _ in rows])
+
+    def _insert_rows(self, cur, rows: List[Tuple[int, str, int]], batch_size: int = 1000) -> None:
+        """
+        Runs INSERT_FINGERPRINTS on the given cursor, batch_size rows per statement.
+
+        :param cur: open cursor.
+        :param rows: A sequence of tuples in the format (song_id, hash, offset).
+        :param batch_size: number of rows of each INSERT.
+        """
+        for index in range(0, len(rows), batch_size):
+            batch = rows[index: index + batch_size]
+            cur.execute(self.INSERT_FINGERPRINTS % ", ".join([self.FINGERPRINT_VALUES] * len(batch)),
+                        [value for row in batch for value in row])
+
+    def _is_missing_table(self, error: Exception) -> bool:
+        return isinstance(error, mysql.connector.Error) and error.errno == errorcode.ER_NO_SUCH_TABLE
 
     def __getstate__(self):
         return self._options,
@@ -151,9 +311,13 @@ class MySQLDatabase(CommonDatabase):
 
 
 def cursor_factory(**factory_options):
+    # Connections opened with the options of this factory, kept open so following cursors can
+    # reuse them. Every database instance has its own factory, so they never get another's.
+    cache = queue.Queue(maxsize=5)
+
     def cursor(**options):
         options.update(factory_options)
-        return Cursor(**options)
+        return Cursor(cache, **options)
     return cursor
 
 
@@ -161,15 +325,16 @@ class Cursor(object):
     """
     Establishes a connection to the database and returns an open cursor.
     # Use as context manager
-    with Cursor() as cur:
+    with Cursor(cache) as cur:
         cur.execute(query)
         ...
     """
-    def __init__(self, dictionary=False, **options):
+    def __init__(self, cache, dictionary=False, server_side=False, buffered=False, **options):
         super().__init__()
 
-        self._cache = queue.Queue(maxsize=5)
-
+        self._cache = cache
+        # mysql.connector cursors are unbuffered by default, rows are already
+        # fetched from the server as they are read so server_side changes nothing.
         try:
             conn = self._cache.get_nowait()
             # Ping the connection before using it from the cache.
@@ -179,22 +344,20 @@ class Cursor(object):
 
         self.conn = conn
         self.dictionary = dictionary
-
-    @classmethod
-    def clear_cache(cls):
-        cls._cache = queue.Queue(maxsize=5)
+        # buffered cursors fetch all the rows at once, only for the queries bringing a few of them.
+        self.buffered = buffered
 
     def __enter__(self):
-        self.cursor = self.conn.cursor(dictionary=self.dictionary)
+        self.cursor = self.conn.cursor(dictionary=self.dictionary, buffered=self.buffered)
         return self.cursor
 
     def __exit__(self, extype, exvalue, traceback):
-        # if we had a MySQL related error we try to rollback the cursor.
-        if extype is DatabaseError:
-            self.cursor.rollback()
-
+        # if anything went wrong nothing done through the cursor is kept.
         self.cursor.close()
-        self.conn.commit()
+        if extype is None:
+            self.conn.commit()
+        else:
+            self.conn.rollback()
 
         # Put it back on the queue
         try:
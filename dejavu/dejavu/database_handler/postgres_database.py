@@ -1,13 +1,22 @@
+import io
 import queue
+from typing import Iterable, Tuple
 
+import numpy as np
 import psycopg2
+from psycopg2 import errorcodes
 from psycopg2.extras import DictCursor
 
 from dejavu.base_classes.common_database import CommonDatabase
 from dejavu.config.settings import (FIELD_FILE_SHA1, FIELD_FINGERPRINTED,
-                                    FIELD_HASH, FIELD_OFFSET, FIELD_SONG_ID,
-                                    FIELD_SONGNAME, FIELD_TOTAL_HASHES,
-                                    FINGERPRINTS_TABLENAME, SONGS_TABLENAME)
+                                    FIELD_HASH, FIELD_METADATA_NAME,
+                                    FIELD_METADATA_VALUE, FIELD_OFFSET,
+                                    FIELD_SONG_ID, FIELD_SONGNAME, FIELD_SONGS,
+                                    FIELD_TOTAL_HASHES, FINGERPRINTS_TABLENAME,
+                                    METADATA_TABLENAME, SONGS_TABLENAME,
+                                    STOP_HASHES_TABLENAME)
+from dejavu.logic.hash_arrays import unpack_hashes
+from dejavu.logic.metrics import INSERT, metrics
 
 
 class PostgreSQLDatabase(CommonDatabase):
@@ -49,6 +58,26 @@ class PostgreSQLDatabase(CommonDatabase):
         USING hash ("{FIELD_HASH}");
     """
 
+    CREATE_METADATA_TABLE = f"""
+        CREATE TABLE IF NOT EXISTS "{METADATA_TABLENAME}" (
+            "{FIELD_METADATA_NAME}" VARCHAR(64) NOT NULL
+        ,   "{FIELD_METADATA_VALUE}" VARCHAR(1024) NOT NULL
+        ,   "date_created" TIMESTAMP NOT NULL DEFAULT now()
+        ,   "date_modified" TIMESTAMP NOT NULL DEFAULT now()
+        ,   CONSTRAINT "pk_{METADATA_TABLENAME}_{FIELD_METADATA_NAME}" PRIMARY KEY ("{FIELD_METADATA_NAME}")
+        );
+    """
+
+    CREATE_STOP_HASHES_TABLE = f"""
+        CREATE TABLE IF NOT EXISTS "{STOP_HASHES_TABLENAME}" (
+            "{FIELD_HASH}" BYTEA NOT NULL
+        ,   "{FIELD_SONGS}" INT NOT NULL
+        ,   "date_created" TIMESTAMP NOT NULL DEFAULT now()
+        ,   "date_modified" TIMESTAMP NOT NULL DEFAULT now()
+        ,   CONSTRAINT "pk_{STOP_HASHES_TABLENAME}_{FIELD_HASH}" PRIMARY KEY ("{FIELD_HASH}")
+        );
+    """
+
     # INSERTS (IGNORES DUPLICATES)
     INSERT_FINGERPRINT = f"""
         INSERT INTO "{FINGERPRINTS_TABLENAME}" (
@@ -64,6 +93,27 @@ class PostgreSQLDatabase(CommonDatabase):
         RETURNING "{FIELD_SONG_ID}";
     """
 
+    INSERT_METADATA = f"""
+        INSERT INTO "{METADATA_TABLENAME}" ("{FIELD_METADATA_NAME}", "{FIELD_METADATA_VALUE}")
+        VALUES (%s, %s)
+        ON CONFLICT ("{FIELD_METADATA_NAME}") DO UPDATE SET
+            "{FIELD_METADATA_VALUE}" = EXCLUDED."{FIELD_METADATA_VALUE}"
+        ,   "date_modified" = now();
+    """
+
+    INSERT_STOP_HASH = f"""
+        INSERT INTO "{STOP_HASHES_TABLENAME}" ("{FIELD_HASH}", "{FIELD_SONGS}")
+        VALUES (decode(%s, 'hex'), %s)
+        ON CONFLICT ("{FIELD_HASH}") DO UPDATE SET
+            "{FIELD_SONGS}" = EXCLUDED."{FIELD_SONGS}"
+        ,   "date_modified" = now();
+    """
+
+    # BULK LOAD, rows are tab separated and hashes written as hexadecimal bytea values.
+    COPY_FINGERPRINTS = f"""
+        COPY "{FINGERPRINTS_TABLENAME}" ("{FIELD_SONG_ID}", "{FIELD_HASH}", "{FIELD_OFFSET}") FROM STDIN;
+    """
+
     # SELECTS
     SELECT = f"""
         SELECT "{FIELD_SONG_ID}", "{FIELD_OFFSET}"
@@ -79,6 +129,11 @@ class PostgreSQLDatabase(CommonDatabase):
 
     SELECT_ALL = f'SELECT "{FIELD_SONG_ID}", "{FIELD_OFFSET}" FROM "{FINGERPRINTS_TABLENAME}";'
 
+    SELECT_ALL_FINGERPRINTS = f"""
+        SELECT upper(encode("{FIELD_HASH}", 'hex')), "{FIELD_SONG_ID}", "{FIELD_OFFSET}"
+        FROM "{FINGERPRINTS_TABLENAME}";
+    """
+
     SELECT_SONG = f"""
         SELECT
             "{FIELD_SONGNAME}"
@@ -90,6 +145,10 @@ class PostgreSQLDatabase(CommonDatabase):
 
     SELECT_NUM_FINGERPRINTS = f'SELECT COUNT(*) AS n FROM "{FINGERPRINTS_TABLENAME}";'
 
+    SELECT_FINGERPRINTS_SIZE = f"""
+        SELECT pg_table_size('"{FINGERPRINTS_TABLENAME}"'), pg_indexes_size('"{FINGERPRINTS_TABLENAME}"');
+    """
+
     SELECT_UNIQUE_SONG_IDS = f"""
         SELECT COUNT("{FIELD_SONG_ID}") AS n
         FROM "{SONGS_TABLENAME}"
@@ -107,9 +166,43 @@ class PostgreSQLDatabase(CommonDatabase):
         WHERE "{FIELD_FINGERPRINTED}" = 1;
     """
 
+    SELECT_METADATA = f"""
+        SELECT "{FIELD_METADATA_VALUE}" FROM "{METADATA_TABLENAME}" WHERE "{FIELD_METADATA_NAME}" = %s;
+    """
+
+    SELECT_SONGS_HASHES = f"""
+        SELECT upper(encode("{FIELD_HASH}", 'hex'))
+        FROM "{FINGERPRINTS_TABLENAME}"
+        WHERE "{FIELD_SONG_ID}" IN (%s);
+    """
+
+    SELECT_STOP_HASHES = f"""
+        SELECT upper(encode("{FIELD_HASH}", 'hex')), "{FIELD_SONGS}" FROM "{STOP_HASHES_TABLENAME}";
+    """
+
+    # DOCUMENT FREQUENCY, the number of songs each hash shows up in.
+    SELECT_COMMON_HASHES = f"""
+        SELECT upper(encode("{FIELD_HASH}", 'hex')), COUNT(DISTINCT "{FIELD_SONG_ID}")
+        FROM "{FINGERPRINTS_TABLENAME}"
+        GROUP BY "{FIELD_HASH}"
+        HAVING COUNT(DISTINCT "{FIELD_SONG_ID}") > %s;
+    """
+
+    SELECT_SONG_COMMON_HASHES = f"""
+        SELECT upper(encode("{FIELD_HASH}", 'hex')), COUNT(DISTINCT "{FIELD_SONG_ID}")
+        FROM "{FINGERPRINTS_TABLENAME}"
+        WHERE "{FIELD_HASH}" IN (
+            SELECT "{FIELD_HASH}" FROM "{FINGERPRINTS_TABLENAME}" WHERE "{FIELD_SONG_ID}" = %s
+        )
+        GROUP BY "{FIELD_HASH}"
+        HAVING COUNT(DISTINCT "{FIELD_SONG_ID}") > %s;
+    """
+
     # DROPS
     DROP_FINGERPRINTS = F'DROP TABLE IF EXISTS "{FINGERPRINTS_TABLENAME}";'
     DROP_SONGS = F'DROP TABLE IF EXISTS "{SONGS_TABLENAME}";'
+    DROP_METADATA = F'DROP TABLE IF EXISTS "{METADATA_TABLENAME}";'
+    DROP_STOP_HASHES = F'DROP TABLE IF EXISTS "{STOP_HASHES_TABLENAME}";'
 
     # UPDATE
     UPDATE_SONG_FINGERPRINTED = f"""
@@ -119,6 +212,13 @@ class PostgreSQLDatabase(CommonDatabase):
         WHERE "{FIELD_SONG_ID}" = %s;
     """
 
+    UPDATE_SONG_TOTAL_HASHES = f"""
+        UPDATE "{SONGS_TABLENAME}" SET
+            "{FIELD_TOTAL_HASHES}" = %s
+        ,   "date_modified" = now()
+        WHERE "{FIELD_SONG_ID}" = %s;
+    """
+
     # DELETES
     DELETE_UNFINGERPRINTED = f"""
         DELETE FROM "{SONGS_TABLENAME}" WHERE "{FIELD_FINGERPRINTED}" = 0;
@@ -128,6 +228,10 @@ class PostgreSQLDatabase(CommonDatabase):
         DELETE FROM "{SONGS_TABLENAME}" WHERE "{FIELD_SONG_ID}" IN (%s);
     """
 
+    DELETE_HASHES = f"""
+        DELETE FROM "{FINGERPRINTS_TABLENAME}" WHERE "{FIELD_HASH}" IN (%s);
+    """
+
     # IN
     IN_MATCH = f"decode(%s, 'hex')"
 
@@ -136,24 +240,70 @@ class PostgreSQLDatabase(CommonDatabase):
         self.cursor = cursor_factory(**options)
         self._options = options
 
+    def before_fork(self) -> None:
+        # Drop the cached connections, otherwise the new processes would
+        # share their sockets with this one.
+        self.cursor = cursor_factory(**self._options)
+
     def after_fork(self) -> None:
         # Clear the cursor cache, we don't want any stale connections from
         # the previous process.
-        Cursor.clear_cache()
+        self.cursor = cursor_factory(**self._options)
 
-    def insert_song(self, song_name: str, file_hash: str, total_hashes: int) -> int:
+    def execute_insert_song(self, cur, song_name: str, file_hash: str, total_hashes: int) -> int:
         """
-        Inserts a song name into the database, returns the new
-        identifier of the song.
+        Runs the song insert on the given cursor, so it can be part of a larger transaction.
 
+        :param cur: open cursor.
         :param song_name: The name of the song.
         :param file_hash: Hash from the fingerprinted file.
         :param total_hashes: amount of hashes to be inserted on fingerprint table.
         :return: the inserted id.
         """
-        with self.cursor() as cur:
-            cur.execute(self.INSERT_SONG, (song_name, file_hash, total_hashes))
-            return cur.fetchone()[0]
+        cur.execute(self.INSERT_SONG, (song_name, file_hash, total_hashes))
+        return cur.fetchone()[0]
+
+    def insert_song_hash_arrays(self, song_name: str, file_hash: str, hash_array: np.ndarray,
+                                offsets: np.ndarray) -> int:
+        """
+        Inserts a song and its packed fingerprints with COPY, in a single transaction.
+        The fingerprints of a new song can't collide with the stored ones, so nothing is lost
+        by skipping the conflict checks of the regular inserts.
+
+        :param song_name: The name of the song.
+        :param file_hash: Hash from the fingerprinted file.
+        :param hash_array: (n, HASH_BYTES) uint8 array of hashes, as given by pack_hashes.
+        :param offsets: offsets of the hashes.
+        :return: the inserted song id.
+        """
+        hashes = unpack_hashes(hash_array, offsets)
+        with metrics.timing(INSERT), self.cursor() as cur:
+            song_id = self.execute_insert_song(cur, song_name, file_hash, len(offsets))
+            cur.copy_expert(self.COPY_FINGERPRINTS, copy_rows((song_id, hsh, offset) for hsh, offset in hashes))
+            cur.execute(self.UPDATE_SONG_FINGERPRINTED, (song_id,))
+
+        self._count_hashes([hsh for hsh, _ in hashes])
+        return song_id
+
+    def insert_fingerprint_rows(self, rows: Iterable[Tuple[int, str, int]], batch_size: int = 1000) -> None:
+        """
+        Inserts fingerprints of any number of songs at once with COPY, in a single transaction.
+        Unlike the regular inserts, rows already stored make the whole load fail.
+
+        :param rows: A sequence of tuples in the format (song_id, hash, offset)
+            - song_id: Song identifier the fingerprint belongs to
+            - hash: Part of a sha1 hash, in hexadecimal format
+            - offset: Offset this hash was created from/at.
+        :param batch_size: unused, rows are sent in a single stream.
+        """
+        rows = list(rows)
+        with metrics.timing(INSERT), self.cursor() as cur:
+            cur.copy_expert(self.COPY_FINGERPRINTS, copy_rows(rows))
+
+        self._count_hashes([hsh for _, hsh, _ in rows])
+
+    def _is_missing_table(self, error: Exception) -> bool:
+        return isinstance(error, psycopg2.Error) and error.pgcode == errorcodes.UNDEFINED_TABLE
 
     def __getstate__(self):
         return self._options,
@@ -163,10 +313,25 @@ class PostgreSQLDatabase(CommonDatabase):
         self.cursor = cursor_factory(**self._options)
 
 
+def copy_rows(rows: Iterable[Tuple[int, str, int]]) -> io.StringIO:
+    """
+    Writes fingerprint rows in the text format read by COPY_FINGERPRINTS.
+
+    :param rows: A sequence of tuples in the format (song_id, hash, offset).
+    :return: a file like object with the rows.
+    """
+    # the backslash of the bytea hexadecimal format has to be escaped in COPY text.
+    return io.StringIO("".join(f"{song_id}\t\\\\x{hsh}\t{offset}\n" for song_id, hsh, offset in rows))
+
+
 def cursor_factory(**factory_options):
+    # Connections opened with the options of this factory, kept open so following cursors can
+    # reuse them. Every database instance has its own factory, so they never get another's.
+    cache = queue.Queue(maxsize=5)
+
     def cursor(**options):
         options.update(factory_options)
-        return Cursor(**options)
+        return Cursor(cache, **options)
     return cursor
 
 
@@ -174,43 +339,43 @@ class Cursor(object):
     """
     Establishes a connection to the database and returns an open cursor.
     # Use as context manager
-    with Cursor() as cur:
+    with Cursor(cache) as cur:
         cur.execute(query)
         ...
     """
-    def __init__(self, dictionary=False, **options):
+    def __init__(self, cache, dictionary=False, server_side=False, buffered=False, **options):
         super().__init__()
 
-        self._cache = queue.Queue(maxsize=5)
-
+        self._cache = cache
         try:
             conn = self._cache.get_nowait()
-            # Ping the connection before using it from the cache.
-            conn.ping(True)
+            # psycopg2 connections can't be pinged, discard the cached one if it was closed.
+            if conn.closed:
+                conn = psycopg2.connect(**options)
         except queue.Empty:
             conn = psycopg2.connect(**options)
 
         self.conn = conn
         self.dictionary = dictionary
-
-    @classmethod
-    def clear_cache(cls):
-        cls._cache = queue.Queue(maxsize=5)
+        # named cursors keep the results on the server and fetch them as they are read, the
+        # others fetch all the rows at once so buffered changes nothing.
+        self.server_side = server_side
 
     def __enter__(self):
+        name = f"dejavu_{id(self)}" if self.server_side else None
         if self.dictionary:
-            self.cursor = self.conn.cursor(cursor_factory=DictCursor)
+            self.cursor = self.conn.cursor(name=name, cursor_factory=DictCursor)
         else:
-            self.cursor = self.conn.cursor()
+            self.cursor = self.conn.cursor(name=name)
         return self.cursor
 
     def __exit__(self, extype, exvalue, traceback):
-        # if we had a PostgreSQL related error we try to rollback the cursor.
-        if extype is psycopg2.DatabaseError:
-            self.cursor.rollback()
-
+        # if anything went wrong nothing done through the cursor is kept.
         self.cursor.close()
-        self.conn.commit()
+        if extype is None:
+            self.conn.commit()
+        else:
+            self.conn.rollback()
 
         # Put it back on the queue
         try:
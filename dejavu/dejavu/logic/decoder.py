@@ -1,14 +1,20 @@
-import fnmatch
 import os
+import subprocess
+import wave
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from hashlib import sha1
-from typing import List, Tuple
+from math import gcd
+from typing import Dict, Iterable, Iterator, List, Tuple
 
 import numpy as np
-from pydub import AudioSegment
-from pydub.utils import audioop
 
+from dejavu.config.settings import DISCOVERY_WORKERS
+from dejavu.logic.metrics import DECODE, metrics
+from dejavu.logic.tracing import tracer
 from dejavu.third_party import wavio
 
+# pydub and scipy.signal are imported by the functions using them, most processes never need them.
+
 
 def unique_hash(file_path: str, block_size: int = 2**20) -> str:
     """ Small function to generate a hash to uniquely generate
@@ -31,27 +37,70 @@ def unique_hash(file_path: str, block_size: int = 2**20) -> str:
     return s.hexdigest().upper()
 
 
-def find_files(path: str, extensions: List[str]) -> List[Tuple[str, str]]:
+def find_files(path: str, extensions: List[str], workers: int = DISCOVERY_WORKERS) -> Iterator[Tuple[str, str]]:
     """
-    Get all files that meet the specified extensions.
+    Get all files that meet the specified extensions. Directories are listed concurrently and
+    files are yielded as soon as their directory is listed, so they can be processed while the
+    rest of the tree is still being walked.
 
     :param path: path to a directory with audio files.
     :param extensions: file extensions to look for.
-    :return: a list of tuples with file name and its extension.
+    :param workers: number of directories listed at the same time.
+    :return: an iterator of tuples with file name and its extension.
     """
     # Allow both with ".mp3" and without "mp3" to be used for extensions
-    extensions = [e.replace(".", "") for e in extensions]
+    extensions = {os.path.normcase(e.replace(".", "")): e.replace(".", "") for e in extensions}
+
+    executor = ThreadPoolExecutor(workers)
+    pending = {executor.submit(_scan_directory, path, extensions)}
+    try:
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, directories = future.result()
+                pending.update(executor.submit(_scan_directory, d, extensions) for d in directories)
+                yield from files
+    finally:
+        # the caller may stop before the whole tree is walked.
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+
+def _scan_directory(path: str, extensions: Dict[str, str]) -> Tuple[List[Tuple[str, str]], List[str]]:
+    """
+    Lists a single directory, matching every extension in one pass.
+
+    :param path: path to the directory.
+    :param extensions: extensions to look for, keyed by their normalized case.
+    :return: the matching files with their extension, and the subdirectories to walk.
+    """
+    files, directories = [], []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+
+                if is_dir:
+                    # like os.walk, links to directories are not followed.
+                    if not entry.is_symlink():
+                        directories.append(entry.path)
+                    continue
 
-    results = []
-    for dirpath, dirnames, files in os.walk(path):
-        for extension in extensions:
-            for f in fnmatch.filter(files, f"*.{extension}"):
-                p = os.path.join(dirpath, f)
-                results.append((p, extension))
-    return results
+                extension = extensions.get(os.path.normcase(entry.name).rpartition(".")[2])
+                if extension is not None and "." in entry.name:
+                    files.append((entry.path, extension))
+    except OSError:
+        # unreadable directories are skipped, as os.walk does.
+        pass
+    return files, directories
 
 
-def read(file_name: str, limit: int = None) -> Tuple[List[List[int]], int, str]:
+@metrics.timed(DECODE)
+def read(file_name: str, limit: int = None, file_hash: str = None) -> Tuple[List[List[int]], int, str]:
     """
     Reads any file supported by pydub (ffmpeg) and returns the data contained
     within. If file reading fails due to input being a 24-bit wav file,
@@ -63,36 +112,220 @@ def read(file_name: str, limit: int = None) -> Tuple[List[List[int]], int, str]:
 
     :param file_name: file to be read.
     :param limit: number of seconds to limit.
+    :param file_hash: hash of the file when it is already known, so it isn't computed again.
     :return: tuple list of (channels, sample_rate, content_file_hash).
     """
-    # pydub does not support 24-bit wav files, use wavio when this occurs
+    from pydub import AudioSegment
+    from pydub.utils import audioop
+
+    with tracer.span("decode", file=file_name) as span:
+        # pydub does not support 24-bit wav files, use wavio when this occurs
+        try:
+            audiofile = AudioSegment.from_file(file_name)
+
+            if limit:
+                audiofile = audiofile[:limit * 1000]
+
+            data = np.frombuffer(audiofile.raw_data, np.int16)
+
+            channels = []
+            for chn in range(audiofile.channels):
+                channels.append(data[chn::audiofile.channels])
+
+            audiofile.frame_rate
+        except audioop.error:
+            _, _, audiofile = wavio.readwav(file_name)
+
+            if limit:
+                audiofile = audiofile[:limit * 1000]
+
+            audiofile = audiofile.T
+            audiofile = audiofile.astype(np.int16)
+
+            channels = []
+            for chn in audiofile:
+                channels.append(chn)
+
+        span.set(channels=len(channels), samples=len(channels[0]) if channels else 0, fs=audiofile.frame_rate)
+
+    return channels, audiofile.frame_rate, file_hash or unique_hash(file_name)
+
+
+def read_blocks(file_name: str, limit: int = None, block_size: int = 2**16) -> Tuple[int, int, Iterator[np.array]]:
+    """
+    Reads a file in blocks of samples, so long recordings never have to fit in memory. 16-bit wav
+    files are read directly, anything else is decoded by ffmpeg into 16-bit samples, as read() does.
+
+    :param file_name: file to be read.
+    :param limit: number of seconds to limit.
+    :param block_size: number of samples per channel in each block.
+    :return: tuple of (number_of_channels, sample_rate, blocks), blocks is an iterator of
+    arrays shaped (channels, samples).
+    """
     try:
-        audiofile = AudioSegment.from_file(file_name)
+        with wave.open(file_name, "rb") as wav:
+            channels, sample_rate, sample_width = wav.getnchannels(), wav.getframerate(), wav.getsampwidth()
+    except (wave.Error, EOFError):
+        sample_width = None
+
+    from pydub import AudioSegment
+    from pydub.exceptions import CouldntDecodeError
+    from pydub.utils import mediainfo_json
+
+    if sample_width != 2:
+        info = mediainfo_json(file_name)
+        stream = next((stream for stream in info.get("streams", []) if stream.get("codec_type") == "audio"), None)
+        if stream is None:
+            raise CouldntDecodeError(f"No audio stream found in {file_name}")
+        channels, sample_rate = int(stream["channels"]), int(stream["sample_rate"])
+
+    max_samples = int(limit * sample_rate) if limit else None
+
+    def blocks() -> Iterator[np.array]:
+        if sample_width == 2:
+            with wave.open(file_name, "rb") as wav:
+                yield from _pcm_blocks(wav.readframes, channels, block_size, max_samples)
+            return
+
+        command = [AudioSegment.converter, "-v", "quiet", "-i", file_name, "-vn",
+                   "-f", "s16le", "-acodec", "pcm_s16le", "-"]
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        try:
+            yield from _pcm_blocks(lambda n: process.stdout.read(n * channels * 2), channels, block_size,
+                                   max_samples)
+        finally:
+            process.kill()
+            process.stdout.close()
+            process.wait()
 
-        if limit:
-            audiofile = audiofile[:limit * 1000]
+    return channels, sample_rate, blocks()
 
-        data = np.fromstring(audiofile.raw_data, np.int16)
 
-        channels = []
-        for chn in range(audiofile.channels):
-            channels.append(data[chn::audiofile.channels])
+def _pcm_blocks(read_frames, channels: int, block_size: int, max_samples: int = None) -> Iterator[np.array]:
+    read_samples = 0
+    while max_samples is None or read_samples < max_samples:
+        size = block_size if max_samples is None else min(block_size, max_samples - read_samples)
+        data = np.frombuffer(read_frames(size), np.int16)
+        if len(data) == 0:
+            break
+        # a truncated file may end in the middle of a frame.
+        data = data[:len(data) - len(data) % channels]
+        read_samples += len(data) // channels
+        yield data.reshape(-1, channels).T
+
+
+def downmix(channels: List[List[int]]) -> List[np.array]:
+    """
+    Averages all the channels into a single one.
+
+    :param channels: channels of the audio, all of the same length.
+    :return: a list with the mono channel.
+    """
+    if len(channels) < 2:
+        return list(channels)
+    return [np.mean(np.vstack(channels), axis=0)]
+
+
+def resample(samples: List[int], fs: int, target_fs: int) -> np.array:
+    """
+    Changes the sampling rate of a channel, filtering out the frequencies above the new Nyquist limit.
+
+    :param samples: channel samples.
+    :param fs: sampling rate of the samples.
+    :param target_fs: sampling rate wanted.
+    :return: the resampled channel.
+    """
+    if fs == target_fs:
+        return samples
+    from scipy.signal import resample_poly
+
+    factor = gcd(fs, target_fs)
+    return resample_poly(samples, target_fs // factor, fs // factor)
+
+
+def prepare_channels(channels: List[List[int]], fs: int, profile: Dict[str, any]) -> Tuple[List[List[int]], int]:
+    """
+    Downmixes and resamples the audio as stated by a fingerprinting profile.
+
+    :param channels: channels of the audio.
+    :param fs: sampling rate of the audio.
+    :param profile: fingerprinting profile, see FINGERPRINT_PROFILES in the settings.
+    :return: tuple of (channels, sample_rate) to be fingerprinted.
+    """
+    if profile.get("mono"):
+        channels = downmix(channels)
+
+    sample_rate = profile.get("sample_rate")
+    if sample_rate and sample_rate != fs:
+        channels = [resample(channel, fs, sample_rate) for channel in channels]
+        fs = sample_rate
+
+    return channels, fs
+
+
+def prepare_blocks(blocks: Iterable[np.array], fs: int, profile: Dict[str, any]) -> Tuple[Iterator[np.array], int]:
+    """
+    Streaming version of prepare_channels, for blocks shaped (channels, samples) as given by read_blocks.
+    Joining the prepared blocks gives exactly the channels prepare_channels returns for the whole audio.
+
+    :param blocks: consecutive blocks of the audio.
+    :param fs: sampling rate of the audio.
+    :param profile: fingerprinting profile, see FINGERPRINT_PROFILES in the settings.
+    :return: tuple of (blocks, sample_rate) to be fingerprinted.
+    """
+    if profile.get("mono"):
+        blocks = (np.mean(block, axis=0, keepdims=True) if len(block) > 1 else block for block in blocks)
+
+    sample_rate = profile.get("sample_rate")
+    if sample_rate and sample_rate != fs:
+        return resample_blocks(blocks, fs, sample_rate), sample_rate
+
+    return iter(blocks), fs
+
+
+def resample_blocks(blocks: Iterable[np.array], fs: int, target_fs: int) -> Iterator[np.array]:
+    """
+    Resamples blocks shaped (channels, samples) giving exactly the same samples as resample() over
+    the whole audio. Each block is resampled together with enough samples around it for the filter,
+    cut at multiples of the decimation factor so the output samples line up with the whole audio ones.
+
+    :param blocks: consecutive blocks of the audio.
+    :param fs: sampling rate of the blocks.
+    :param target_fs: sampling rate wanted.
+    :return: an iterator of the resampled blocks.
+    """
+    from scipy.signal import resample_poly
+
+    factor = gcd(fs, target_fs)
+    up, down = target_fs // factor, fs // factor
+    # resample_poly filter reaches 10 * max(up, down) samples of the upsampled signal on each side.
+    context = 10 * max(up, down) // up + 1
+    context += -context % down
 
-        audiofile.frame_rate
-    except audioop.error:
-        _, _, audiofile = wavio.readwav(file_name)
+    buffer = None
+    buffer_start = 0  # audio sample the buffer begins with.
+    done = 0  # audio sample up to which the output has been given, always a multiple of down.
+    for block in blocks:
+        buffer = block if buffer is None else np.concatenate((buffer, block), axis=1)
 
-        if limit:
-            audiofile = audiofile[:limit * 1000]
+        ready = buffer_start + buffer.shape[1] - context
+        ready -= ready % down
+        if ready <= done:
+            continue
 
-        audiofile = audiofile.T
-        audiofile = audiofile.astype(np.int16)
+        start = max(done - context, 0)
+        resampled = resample_poly(buffer[:, start - buffer_start: ready + context - buffer_start], up, down, axis=1)
+        yield resampled[:, (done - start) * up // down: (ready - start) * up // down]
 
-        channels = []
-        for chn in audiofile:
-            channels.append(chn)
+        done = ready
+        keep = max(done - context, 0)
+        buffer = buffer[:, keep - buffer_start:]
+        buffer_start = keep
 
-    return channels, audiofile.frame_rate, unique_hash(file_name)
+    if buffer is not None and buffer_start + buffer.shape[1] > done:
+        start = max(done - context, 0)
+        resampled = resample_poly(buffer[:, start - buffer_start:], up, down, axis=1)
+        yield resampled[:, (done - start) * up // down:]
 
 
 def get_audio_name_from_path(file_path: str) -> str:
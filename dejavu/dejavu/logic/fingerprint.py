@@ -1,23 +1,26 @@
 import hashlib
+from concurrent.futures import Executor
 from operator import itemgetter
-from typing import List, Tuple
+from typing import Iterable, Iterator, List, Set, Tuple
 
-import matplotlib.mlab as mlab
-import matplotlib.pyplot as plt
 import numpy as np
-from scipy.ndimage.filters import maximum_filter
-from scipy.ndimage.morphology import (binary_erosion,
-                                      generate_binary_structure,
-                                      iterate_structure)
 
 from dejavu.config.settings import (CONNECTIVITY_MASK, DEFAULT_AMP_MIN,
                                     DEFAULT_FAN_VALUE, DEFAULT_FS,
                                     DEFAULT_OVERLAP_RATIO, DEFAULT_WINDOW_SIZE,
-                                    FINGERPRINT_REDUCTION, MAX_HASH_TIME_DELTA,
-                                    MIN_HASH_TIME_DELTA,
+                                    FINGERPRINT_CHUNK_FRAMES,
+                                    FINGERPRINT_REDUCTION,
+                                    FINGERPRINT_SEGMENT_FRAMES,
+                                    MAX_HASH_TIME_DELTA, MIN_HASH_TIME_DELTA,
                                     PEAK_NEIGHBORHOOD_SIZE, PEAK_SORT)
+from dejavu.logic.metrics import (FINGERPRINT, HASHES, HASHES_GENERATED, PEAKS,
+                                  PEAKS_FOUND, SPECTROGRAM, metrics)
+from dejavu.logic.tracing import tracer
 
+# matplotlib and scipy.ndimage are imported by the functions using them, most processes never need them.
 
+
+@metrics.timed(FINGERPRINT)
 def fingerprint(channel_samples: List[int],
                 Fs: int = DEFAULT_FS,
                 wsize: int = DEFAULT_WINDOW_SIZE,
@@ -35,6 +38,31 @@ def fingerprint(channel_samples: List[int],
     :param amp_min: minimum amplitude in spectrogram in order to be considered a peak.
     :return: a list of hashes with their corresponding offsets.
     """
+    arr2D = get_spectrogram(channel_samples, Fs=Fs, wsize=wsize, wratio=wratio)
+
+    local_maxima = get_2D_peaks(arr2D, plot=False, amp_min=amp_min)
+    tracer.current().add("peaks", len(local_maxima))
+
+    # return hashes
+    return generate_hashes(local_maxima, fan_value=fan_value)
+
+
+@metrics.timed(SPECTROGRAM)
+def get_spectrogram(channel_samples: List[int],
+                    Fs: int = DEFAULT_FS,
+                    wsize: int = DEFAULT_WINDOW_SIZE,
+                    wratio: float = DEFAULT_OVERLAP_RATIO) -> np.array:
+    """
+    FFT the channel and log transform the output.
+
+    :param channel_samples: channel samples to transform.
+    :param Fs: audio sampling rate.
+    :param wsize: FFT windows size.
+    :param wratio: ratio by which each sequential window overlaps the last and the next window.
+    :return: the spectrogram matrix, frequencies by frames.
+    """
+    import matplotlib.mlab as mlab
+
     # FFT the signal and extract frequency components
     arr2D = mlab.specgram(
         channel_samples,
@@ -44,14 +72,163 @@ def fingerprint(channel_samples: List[int],
         noverlap=int(wsize * wratio))[0]
 
     # Apply log transform since specgram function returns linear array. 0s are excluded to avoid np warning.
-    arr2D = 10 * np.log10(arr2D, out=np.zeros_like(arr2D), where=(arr2D != 0))
+    return 10 * np.log10(arr2D, out=np.zeros_like(arr2D), where=(arr2D != 0))
 
-    local_maxima = get_2D_peaks(arr2D, plot=False, amp_min=amp_min)
 
-    # return hashes
-    return generate_hashes(local_maxima, fan_value=fan_value)
+def fingerprint_channels(channels: List[List[int]],
+                         Fs: int = DEFAULT_FS,
+                         executor: Executor = None,
+                         segment_frames: int = FINGERPRINT_SEGMENT_FRAMES,
+                         wsize: int = DEFAULT_WINDOW_SIZE,
+                         wratio: float = DEFAULT_OVERLAP_RATIO,
+                         fan_value: int = DEFAULT_FAN_VALUE,
+                         amp_min: int = DEFAULT_AMP_MIN) -> Set[Tuple[str, int]]:
+    """
+    Fingerprints all the channels of an audio, splitting each one of them in segments of
+    segment_frames frames that are fingerprinted in parallel on the executor. The result is
+    exactly the union of fingerprint() over every channel.
+
+    :param channels: samples of each channel.
+    :param Fs: audio sampling rate.
+    :param executor: pool running the segments, if None channels are fingerprinted one after another.
+    :param segment_frames: number of spectrogram frames whose hashes are computed by each task.
+    :param wsize: FFT windows size.
+    :param wratio: ratio by which each sequential window overlaps the last and the next window.
+    :param fan_value: degree to which a fingerprint can be paired with its neighbors.
+    :param amp_min: minimum amplitude in spectrogram in order to be considered a peak.
+    :return: a set of hashes with their corresponding offsets.
+    """
+    hashes = set()
+
+    # without sorting the pairs depend on the peaks of the whole channel, segments can't reproduce them.
+    if executor is None or not PEAK_SORT:
+        for channel in channels:
+            hashes |= set(fingerprint(channel, Fs=Fs, wsize=wsize, wratio=wratio, fan_value=fan_value,
+                                      amp_min=amp_min))
+        return hashes
+
+    noverlap = int(wsize * wratio)
+    hop = wsize - noverlap
+
+    futures = []
+    for channel in channels:
+        n_frames = max((len(channel) - noverlap) // hop, 1)
+        for first in range(0, n_frames, segment_frames):
+            last = min(first + segment_frames, n_frames)
+            # frames needed around the segment: peak neighborhoods on both sides, and on the
+            # right every peak a hash anchored in the segment could be paired with.
+            start = max(first - PEAK_NEIGHBORHOOD_SIZE, 0)
+            stop = last + MAX_HASH_TIME_DELTA + PEAK_NEIGHBORHOOD_SIZE
+            samples = channel[start * hop: (stop - 1) * hop + wsize]
+            futures.append(executor.submit(metrics.collected(fingerprint_segment), samples, start, first, last,
+                                           Fs, wsize, wratio, fan_value, amp_min))
+
+    for future in futures:
+        hashes |= set(metrics.merge_result(future.result()))
+
+    return hashes
 
 
+def fingerprint_stream(blocks: Iterable[np.array],
+                       Fs: int = DEFAULT_FS,
+                       chunk_frames: int = FINGERPRINT_CHUNK_FRAMES,
+                       wsize: int = DEFAULT_WINDOW_SIZE,
+                       wratio: float = DEFAULT_OVERLAP_RATIO,
+                       fan_value: int = DEFAULT_FAN_VALUE,
+                       amp_min: int = DEFAULT_AMP_MIN) -> Iterator[List[Tuple[str, int]]]:
+    """
+    Fingerprints an audio given as consecutive blocks of samples, chunk_frames spectrogram frames at
+    a time. Only the samples of the current chunk and the frames its peaks and hashes need around it
+    are kept, so memory doesn't grow with the length of the audio. Together the chunks give exactly
+    the hashes of fingerprint() over every channel, as long as PEAK_SORT is enabled; otherwise
+    peaks are only paired within each chunk.
+
+    :param blocks: consecutive blocks of the audio shaped (channels, samples), of any length.
+    :param Fs: audio sampling rate.
+    :param chunk_frames: number of spectrogram frames whose hashes are computed at a time.
+    :param wsize: FFT windows size.
+    :param wratio: ratio by which each sequential window overlaps the last and the next window.
+    :param fan_value: degree to which a fingerprint can be paired with its neighbors.
+    :param amp_min: minimum amplitude in spectrogram in order to be considered a peak.
+    :return: an iterator of the hashes of each chunk, of all the channels, with their offsets.
+    """
+    noverlap = int(wsize * wratio)
+    hop = wsize - noverlap
+
+    def fingerprint_chunk(samples, start, first, last):
+        hashes = []
+        for channel in samples:
+            hashes.extend(fingerprint_segment(channel, start, first, last, Fs, wsize, wratio, fan_value, amp_min))
+        return hashes
+
+    buffer = None
+    start = 0  # frame the buffer begins with.
+    first = 0  # first frame of the next chunk.
+    for block in blocks:
+        buffer = block if buffer is None else np.concatenate((buffer, block), axis=1)
+
+        while True:
+            last = first + chunk_frames
+            # same frames fingerprint_channels gives to a segment, see there.
+            stop = last + MAX_HASH_TIME_DELTA + PEAK_NEIGHBORHOOD_SIZE
+            end = (stop - 1 - start) * hop + wsize
+            if buffer.shape[1] < end:
+                break
+
+            yield fingerprint_chunk(buffer[:, :end], start, first, last)
+
+            first = last
+            keep = max(first - PEAK_NEIGHBORHOOD_SIZE, 0)
+            buffer = buffer[:, (keep - start) * hop:]
+            start = keep
+
+    if buffer is None:
+        return
+
+    n_frames = max((start * hop + buffer.shape[1] - noverlap) // hop, 1)
+    if first < n_frames:
+        yield fingerprint_chunk(buffer, start, first, n_frames)
+
+
+def fingerprint_segment(samples: List[int],
+                        start: int,
+                        first: int,
+                        last: int,
+                        Fs: int = DEFAULT_FS,
+                        wsize: int = DEFAULT_WINDOW_SIZE,
+                        wratio: float = DEFAULT_OVERLAP_RATIO,
+                        fan_value: int = DEFAULT_FAN_VALUE,
+                        amp_min: int = DEFAULT_AMP_MIN) -> List[Tuple[str, int]]:
+    """
+    Returns the hashes of a channel anchored on the frames [first, last), the same ones fingerprint()
+    would produce for them over the whole channel.
+
+    :param samples: channel samples starting at frame start, they must cover PEAK_NEIGHBORHOOD_SIZE frames
+    before first (unless start is 0) and PEAK_NEIGHBORHOOD_SIZE + MAX_HASH_TIME_DELTA frames after last
+    (unless the channel ends earlier).
+    :param start: channel frame the samples begin with.
+    :param first: first channel frame of the segment.
+    :param last: channel frame where the segment ends, not included.
+    :param Fs: audio sampling rate.
+    :param wsize: FFT windows size.
+    :param wratio: ratio by which each sequential window overlaps the last and the next window.
+    :param fan_value: degree to which a fingerprint can be paired with its neighbors.
+    :param amp_min: minimum amplitude in spectrogram in order to be considered a peak.
+    :return: a list of hashes with their corresponding channel offsets.
+    """
+    arr2D = get_spectrogram(samples, Fs=Fs, wsize=wsize, wratio=wratio)
+
+    # peaks too close to the borders of the samples don't have their whole neighborhood, keep only
+    # the ones within the segment and those the segment's hashes may be paired with.
+    local_maxima = [
+        (freq, start + time) for freq, time in get_2D_peaks(arr2D, plot=False, amp_min=amp_min)
+        if first <= start + time < last + MAX_HASH_TIME_DELTA
+    ]
+
+    return [(hsh, offset) for hsh, offset in generate_hashes(local_maxima, fan_value=fan_value) if offset < last]
+
+
+@metrics.timed(PEAKS, PEAKS_FOUND)
 def get_2D_peaks(arr2D: np.array, plot: bool = False, amp_min: int = DEFAULT_AMP_MIN)\
         -> List[Tuple[List[int], List[int]]]:
     """
@@ -62,6 +239,9 @@ def get_2D_peaks(arr2D: np.array, plot: bool = False, amp_min: int = DEFAULT_AMP
     :param amp_min: minimum amplitude in spectrogram in order to be considered a peak.
     :return: a list composed by a list of frequencies and times.
     """
+    from scipy.ndimage import (binary_erosion, generate_binary_structure,
+                               iterate_structure, maximum_filter)
+
     # Original code from the repo is using a morphology mask that does not consider diagonal elements
     # as neighbors (basically a diamond figure) and then applies a dilation over it, so what I'm proposing
     # is to change from the current diamond figure to a just a normal square one:
@@ -106,6 +286,8 @@ def get_2D_peaks(arr2D: np.array, plot: bool = False, amp_min: int = DEFAULT_AMP
     times_filter = times[filter_idxs]
 
     if plot:
+        import matplotlib.pyplot as plt
+
         # scatter of the peaks
         fig, ax = plt.subplots()
         ax.imshow(arr2D)
@@ -119,6 +301,7 @@ def get_2D_peaks(arr2D: np.array, plot: bool = False, amp_min: int = DEFAULT_AMP
     return list(zip(freqs_filter, times_filter))
 
 
+@metrics.timed(HASHES, HASHES_GENERATED)
 def generate_hashes(peaks: List[Tuple[int, int]], fan_value: int = DEFAULT_FAN_VALUE) -> List[Tuple[str, int]]:
     """
     Hash list structure:
@@ -0,0 +1,155 @@
+import json
+import os
+from hashlib import sha1
+from typing import Dict, Tuple
+
+import numpy as np
+
+from dejavu.config import settings
+from dejavu.config.settings import FINGERPRINT_CACHE_SIZE
+from dejavu.logic.metrics import CACHE_HITS, CACHE_MISSES, metrics
+
+# Settings changing the fingerprints of a file, cached fingerprints are only used
+# if they were computed with the same values.
+FINGERPRINT_SETTINGS = [
+    "CONNECTIVITY_MASK",
+    "DEFAULT_AMP_MIN",
+    "DEFAULT_FAN_VALUE",
+    "FINGERPRINT_REDUCTION",
+    "MAX_HASH_TIME_DELTA",
+    "MIN_HASH_TIME_DELTA",
+    "PEAK_NEIGHBORHOOD_SIZE",
+    "PEAK_SORT"
+]
+
+# Bumped whenever the way entries are stored changes, so old entries are never read.
+CACHE_FORMAT = 1
+
+
+def settings_digest(**extra) -> str:
+    """
+    Digest of the fingerprinting settings, fingerprints are comparable only when computed
+    with the same one.
+
+    :param extra: other values to take into account.
+    :return: a hash in an hexadecimal string form.
+    """
+    values = {name: getattr(settings, name) for name in FINGERPRINT_SETTINGS}
+    return sha1(json.dumps(dict(values, **extra), sort_keys=True).encode()).hexdigest()
+
+
+class FingerprintCache:
+    """
+    On disk cache of the fingerprints of audio files, so files already fingerprinted once are
+    not decoded and fingerprinted again when a database is rebuilt or the same clips are
+    recognized again.
+
+    Entries are the packed hash and offset arrays of a file, keyed by the hash of its content
+    together with everything that changes its fingerprints: the profile, the limit and the
+    fingerprinting settings. Once the entries take more than max_size bytes, the ones least
+    recently used are removed. Several processes can share the same cache directory.
+    """
+    def __init__(self, path: str, max_size: int = FINGERPRINT_CACHE_SIZE):
+        """
+        :param path: directory holding the cache, created if it doesn't exist.
+        :param max_size: maximum number of bytes taken by the cached fingerprints.
+        """
+        self.path = path
+        self.max_size = max_size
+        os.makedirs(path, exist_ok=True)
+
+        self.settings_digest = settings_digest(format=CACHE_FORMAT)
+
+        # bytes taken by the entries, as seen by this process since the last eviction.
+        self._size = None
+
+    def get(self, file_hash: str, profile: Dict[str, any], limit: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Brings the cached fingerprints of a file.
+
+        :param file_hash: hash of the file content.
+        :param profile: fingerprinting profile the fingerprints are wanted for.
+        :param limit: number of seconds fingerprinted, None for the whole file.
+        :return: the packed hash and offset arrays, as given by pack_hashes, or None if not cached.
+        """
+        entry = self._entry_path(file_hash, profile, limit)
+        try:
+            with np.load(entry) as arrays:
+                hash_array, offsets = arrays["hash_array"], arrays["offsets"]
+            # refreshed so it is the last one to be evicted.
+            os.utime(entry)
+        except (OSError, KeyError, ValueError):
+            metrics.inc(CACHE_MISSES)
+            return None
+        metrics.inc(CACHE_HITS)
+        return hash_array, offsets
+
+    def put(self, file_hash: str, profile: Dict[str, any], limit: int,
+            hash_array: np.ndarray, offsets: np.ndarray) -> None:
+        """
+        Caches the fingerprints of a file.
+
+        :param file_hash: hash of the file content.
+        :param profile: fingerprinting profile the fingerprints were computed with.
+        :param limit: number of seconds fingerprinted, None for the whole file.
+        :param hash_array: packed hashes, as given by pack_hashes.
+        :param offsets: offsets of the hashes.
+        """
+        entry = self._entry_path(file_hash, profile, limit)
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+
+        # written aside and then renamed, so other processes never read half an entry.
+        partial = f"{entry}.{os.getpid()}.tmp"
+        with open(partial, "wb") as f:
+            np.savez(f, hash_array=hash_array, offsets=offsets)
+        os.replace(partial, entry)
+
+        if self._size is None:
+            self._size = sum(size for _, size, _ in self._entries())
+        else:
+            self._size += os.path.getsize(entry)
+
+        if self._size > self.max_size:
+            self.evict()
+
+    def evict(self) -> None:
+        """
+        Removes the least recently used entries until the cache fits in 90% of max_size,
+        leaving some room so it doesn't have to evict on every new entry.
+        """
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        size = sum(entry_size for _, entry_size, _ in entries)
+        for entry, entry_size, _ in entries:
+            if size <= self.max_size * 0.9:
+                break
+            try:
+                os.remove(entry)
+            except FileNotFoundError:
+                # removed by another process sharing the cache.
+                pass
+            size -= entry_size
+        self._size = size
+
+    def _entry_path(self, file_hash: str, profile: Dict[str, any], limit: int) -> str:
+        # the name of the profile doesn't change the fingerprints, its settings do.
+        key = json.dumps({
+            "file": file_hash.upper(),
+            "profile": {name: value for name, value in profile.items() if name != "name"},
+            "limit": limit,
+            "settings": self.settings_digest
+        }, sort_keys=True)
+        key = sha1(key.encode()).hexdigest()
+        return os.path.join(self.path, key[:2], f"{key}.npz")
+
+    def _entries(self):
+        # (path, size, last use) of every entry.
+        for directory in os.scandir(self.path):
+            if not directory.is_dir():
+                continue
+            for entry in os.scandir(directory.path):
+                if entry.name.endswith(".npz"):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    yield entry.path, stat.st_size, stat.st_mtime
@@ -0,0 +1,190 @@
+import os
+from collections import namedtuple
+from typing import Iterable, Iterator, List, Tuple
+
+import numpy as np
+
+from dejavu.config.settings import FINGERPRINT_REDUCTION
+
+try:
+    from multiprocessing import resource_tracker, shared_memory
+except ImportError:  # python < 3.8
+    resource_tracker = shared_memory = None
+
+# Bytes taken by each hash once packed, hashes are FINGERPRINT_REDUCTION hexadecimal characters.
+HASH_BYTES = (FINGERPRINT_REDUCTION + 1) // 2
+
+# Where POSIX shared memory lives on Linux, checked to avoid filling it up.
+SHARED_MEMORY_PATH = "/dev/shm"
+
+# What crosses the process boundary: the name of the shared memory block holding count hashes,
+# or the packed arrays themselves when shared memory is not available.
+SharedHashes = namedtuple("SharedHashes", ["name", "count", "hash_array", "offsets"])
+
+
+def pack_hashes(hashes: Iterable[Tuple[str, int]]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Turns hashes into two compact arrays, 10 bytes per hash plus 4 per offset instead of
+    a Python tuple of a string and an int each.
+
+    :param hashes: A sequence of tuples in the format (hash, offset)
+        - hash: Part of a sha1 hash, in hexadecimal format
+        - offset: Offset this hash was created from/at.
+    :return: a (n, HASH_BYTES) uint8 array of hashes and an array of their uint32 offsets.
+    """
+    hashes = list(hashes)
+    if not hashes:
+        return np.zeros((0, HASH_BYTES), dtype=np.uint8), np.zeros(0, dtype=np.uint32)
+
+    hex_hashes = [hsh for hsh, _ in hashes]
+    if FINGERPRINT_REDUCTION % 2:
+        hex_hashes = [hsh.rjust(HASH_BYTES * 2, "0") for hsh in hex_hashes]
+
+    hash_array = np.frombuffer(bytes.fromhex("".join(hex_hashes)), dtype=np.uint8).reshape(-1, HASH_BYTES)
+    offsets = np.fromiter((offset for _, offset in hashes), dtype=np.uint32, count=len(hashes))
+    return hash_array, offsets
+
+
+def unpack_hashes(hash_array: np.ndarray, offsets: np.ndarray) -> List[Tuple[str, int]]:
+    """
+    Turns the arrays built by pack_hashes back into hashes.
+
+    :param hash_array: (n, HASH_BYTES) uint8 array of hashes.
+    :param offsets: array of offsets.
+    :return: a list of tuples for hashes, in lower case hexadecimal format, and their offsets.
+    """
+    hex_hashes = hash_array.tobytes().hex()
+    width = HASH_BYTES * 2
+    skip = width - FINGERPRINT_REDUCTION
+    return list(zip(
+        [hex_hashes[index + skip: index + width] for index in range(0, len(hex_hashes), width)],
+        offsets.tolist()
+    ))
+
+
+def iter_unpacked_hashes(hash_array: np.ndarray, offsets: np.ndarray,
+                         batch_size: int = 100000) -> Iterator[List[Tuple[str, int]]]:
+    """
+    Same as unpack_hashes, a batch at a time so the hashes are never all unpacked at once.
+
+    :param hash_array: (n, HASH_BYTES) uint8 array of hashes.
+    :param offsets: array of offsets.
+    :param batch_size: number of hashes in each batch.
+    :return: an iterator of lists of tuples for hashes and their offsets.
+    """
+    for index in range(0, len(offsets), batch_size):
+        yield unpack_hashes(hash_array[index: index + batch_size], offsets[index: index + batch_size])
+
+
+def skip_hash_arrays(hash_array: np.ndarray, offsets: np.ndarray,
+                     hashes: Iterable[str]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Leaves the fingerprints of some hashes out of packed fingerprints, without unpacking them.
+
+    :param hash_array: (n, HASH_BYTES) uint8 array of hashes.
+    :param offsets: offsets of the hashes.
+    :param hashes: hashes to leave out, in hexadecimal format.
+    :return: the packed hashes and offsets of the other hashes.
+    """
+    skipped, _ = pack_hashes((hsh, 0) for hsh in hashes)
+    if not len(skipped) or not len(offsets):
+        return hash_array, offsets
+
+    # each packed hash compared as a whole.
+    row = np.dtype((np.void, HASH_BYTES))
+    kept = ~np.isin(np.ascontiguousarray(hash_array).view(row).ravel(), skipped.view(row).ravel())
+    return hash_array[kept], offsets[kept]
+
+
+def share_hashes(hashes: Iterable[Tuple[str, int]]) -> SharedHashes:
+    """
+    Packs hashes into a shared memory block so another process can read them without pickling.
+    The block is left for the receiver to free, only the small descriptor returned has to be
+    sent to it. Without shared memory available the packed arrays are sent in the descriptor.
+
+    :param hashes: A sequence of tuples in the format (hash, offset).
+    :return: a descriptor to give to receive_hashes.
+    """
+    return share_hash_arrays(*pack_hashes(hashes))
+
+
+def share_hash_arrays(hash_array: np.ndarray, offsets: np.ndarray) -> SharedHashes:
+    """
+    Same as share_hashes, for hashes already packed.
+
+    :param hash_array: (n, HASH_BYTES) uint8 array of hashes.
+    :param offsets: array of offsets.
+    :return: a descriptor to give to receive_hashes.
+    """
+    offsets = offsets.astype(np.uint32, copy=False)
+    count = len(offsets)
+    size = count * (HASH_BYTES + offsets.itemsize)
+
+    if shared_memory is None or count == 0 or not _fits_shared_memory(size):
+        return SharedHashes(None, count, hash_array, offsets)
+
+    block = shared_memory.SharedMemory(create=True, size=size)
+    try:
+        _hash_view(block, count)[:] = hash_array
+        _offset_view(block, count)[:] = offsets
+    except BaseException:
+        block.close()
+        block.unlink()
+        raise
+
+    # The receiver frees the block, otherwise the resource tracker of this process (pool
+    # workers may have their own) would destroy it as soon as the process exits.
+    if os.name == "posix":
+        resource_tracker.unregister(block._name, "shared_memory")
+
+    name = block.name
+    block.close()
+    return SharedHashes(name, count, None, None)
+
+
+def receive_hashes(descriptor: SharedHashes) -> List[Tuple[str, int]]:
+    """
+    Reads the hashes sent by share_hashes and frees the shared memory they were in.
+
+    :param descriptor: descriptor returned by share_hashes.
+    :return: a list of tuples for hashes and their offsets.
+    """
+    return unpack_hashes(*receive_hash_arrays(descriptor))
+
+
+def receive_hash_arrays(descriptor: SharedHashes) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Same as receive_hashes, but the hashes are kept packed.
+
+    :param descriptor: descriptor returned by share_hashes.
+    :return: the (n, HASH_BYTES) uint8 array of hashes and the array of their offsets.
+    """
+    if descriptor.name is None:
+        return descriptor.hash_array, descriptor.offsets
+
+    block = shared_memory.SharedMemory(name=descriptor.name)
+    try:
+        # copied out, the views would be left dangling once the block is freed.
+        return _hash_view(block, descriptor.count).copy(), _offset_view(block, descriptor.count).copy()
+    finally:
+        block.close()
+        block.unlink()
+
+
+def _hash_view(block, count: int) -> np.ndarray:
+    return np.ndarray((count, HASH_BYTES), dtype=np.uint8, buffer=block.buf)
+
+
+def _offset_view(block, count: int) -> np.ndarray:
+    # offsets go after the hashes, HASH_BYTES * count is not 4 bytes aligned but numpy copes with it.
+    return np.ndarray((count,), dtype=np.uint32, buffer=block.buf, offset=count * HASH_BYTES)
+
+
+def _fits_shared_memory(size: int) -> bool:
+    # Writing past the free space of /dev/shm kills the process with SIGBUS instead of raising,
+    # containers often have just 64MB of it. Leave room for other blocks in flight.
+    try:
+        stats = os.statvfs(SHARED_MEMORY_PATH)
+    except (OSError, AttributeError):
+        return True
+    return size * 4 < stats.f_bavail * stats.f_frsize
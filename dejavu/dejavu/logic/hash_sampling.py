@@ -0,0 +1,50 @@
+from typing import Iterable, Tuple
+
+import numpy as np
+
+# Hashes are sampled on their last 8 hexadecimal characters, the last 4 bytes once packed,
+# so strings and packed arrays agree and no hash has to be converted whole.
+SAMPLED_HEX_DIGITS = 8
+
+
+def keep_hash(hsh: str, ratio: int) -> bool:
+    """
+    Tells whether a hash is in the sample of one hash out of ratio: the hashes whose value
+    modulo ratio is 0. Hashes are random, so this keeps about one fingerprint out of ratio, and
+    always the same ones whoever samples them.
+
+    :param hsh: hash in hexadecimal format.
+    :param ratio: one hash out of ratio is kept.
+    :return: True if the hash is kept.
+    """
+    return int(hsh[-SAMPLED_HEX_DIGITS:], 16) % ratio == 0
+
+
+def sample_hashes(hashes: Iterable[Tuple[str, int]], ratio: int) -> Iterable[Tuple[str, int]]:
+    """
+    Keeps the fingerprints whose hash is in the sample, see keep_hash.
+
+    :param hashes: A sequence of tuples in the format (hash, offset).
+    :param ratio: one hash out of ratio is kept, 1 keeps them all.
+    :return: the hashes as given if ratio is 1, otherwise an iterator of the tuples kept.
+    """
+    if ratio == 1:
+        return hashes
+    return ((hsh, offset) for hsh, offset in hashes if keep_hash(hsh, ratio))
+
+
+def sample_hash_arrays(hash_array: np.ndarray, offsets: np.ndarray, ratio: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Same as sample_hashes, for fingerprints packed with pack_hashes.
+
+    :param hash_array: (n, HASH_BYTES) uint8 array of hashes.
+    :param offsets: offsets of the hashes.
+    :param ratio: one hash out of ratio is kept, 1 keeps them all.
+    :return: the packed hashes and offsets kept.
+    """
+    if ratio == 1:
+        return hash_array, offsets
+    values = np.ascontiguousarray(hash_array[:, -SAMPLED_HEX_DIGITS // 2:]).view(">u4").ravel()
+    kept = values % ratio == 0
+    return hash_array[kept], offsets[kept]
+
@@ -0,0 +1,66 @@
+from typing import List
+
+import numpy as np
+
+from dejavu.config.settings import HASH_SKETCH_DEPTH, HASH_SKETCH_WIDTH
+
+
+class HashSketch:
+    """
+    Count-min sketch of the number of fingerprints stored for each hash, small enough to keep in
+    memory whatever the size of the database.
+
+    Every hash is counted in one cell of each of the depth rows and its estimate is the smallest
+    of them, so counts are never underestimated and only overestimated by the hashes sharing all
+    their cells. Hashes are random already, the cells come from multiplying the first 64 bits by
+    a fixed odd number per row, so every process builds the same sketch.
+    """
+    def __init__(self, width: int = HASH_SKETCH_WIDTH, depth: int = HASH_SKETCH_DEPTH):
+        """
+        :param width: number of cells in each row, a power of two.
+        :param depth: number of rows.
+        """
+        if width <= 1 or width & (width - 1):
+            raise ValueError(f"The sketch width has to be a power of two, got {width}.")
+
+        self.width = width
+        self.depth = depth
+        self.table = np.zeros((depth, width), dtype=np.int32)
+
+        self._shift = np.uint64(64 - (width.bit_length() - 1))
+        self._multipliers = np.random.RandomState(0).randint(1, 2 ** 63, size=depth, dtype=np.uint64) | np.uint64(1)
+        self._rows = np.arange(depth)[:, None]
+
+    def add(self, hashes: List[str]) -> None:
+        """
+        Counts one more fingerprint for every hash given, repeated hashes are counted every time.
+
+        :param hashes: hashes in hexadecimal format.
+        """
+        if hashes:
+            np.add.at(self.table, (self._rows, self._cells(hashes)), 1)
+
+    def remove(self, hashes: List[str]) -> None:
+        """
+        Counts one fingerprint less for every hash given, they must have been added before.
+
+        :param hashes: hashes in hexadecimal format.
+        """
+        if hashes:
+            np.subtract.at(self.table, (self._rows, self._cells(hashes)), 1)
+
+    def estimate(self, hashes: List[str]) -> np.ndarray:
+        """
+        Estimates the number of fingerprints of each hash.
+
+        :param hashes: hashes in hexadecimal format.
+        :return: the estimates, in the same order as the hashes.
+        """
+        if not hashes:
+            return np.zeros(0, dtype=np.int32)
+        return self.table[self._rows, self._cells(hashes)].min(axis=0)
+
+    def _cells(self, hashes: List[str]) -> np.ndarray:
+        # (depth, len(hashes)) cell of every hash in each row, the products wrap around on purpose.
+        keys = np.fromiter((int(hsh[:16], 16) for hsh in hashes), dtype=np.uint64, count=len(hashes))
+        return (keys[None, :] * self._multipliers[:, None]) >> self._shift
@@ -0,0 +1,100 @@
+import os
+import sqlite3
+import threading
+
+from dejavu.config.settings import FIELD_FILE_SHA1, FIELD_SONG_ID
+
+
+class IngestManifest:
+    """
+    Remembers the content hash of every file seen while fingerprinting, together with what
+    os.stat said about it at the time. As long as the size, modification time and inode of a
+    file stay the same its hash is taken from here, so re-scanning a library only reads the
+    files that are new or changed.
+
+    Entries live in a SQLite file, next to the library or wherever the configuration says.
+    """
+    CREATE_FILES_TABLE = f"""
+        CREATE TABLE IF NOT EXISTS files (
+            path TEXT PRIMARY KEY
+        ,   size INTEGER NOT NULL
+        ,   mtime_ns INTEGER NOT NULL
+        ,   inode INTEGER NOT NULL
+        ,   {FIELD_FILE_SHA1} TEXT NOT NULL
+        ,   {FIELD_SONG_ID} INTEGER
+        );
+    """
+
+    CREATE_SHA1_INDEX = f"CREATE INDEX IF NOT EXISTS ix_files_{FIELD_FILE_SHA1} ON files ({FIELD_FILE_SHA1});"
+
+    SELECT_FILE = f"SELECT size, mtime_ns, inode, {FIELD_FILE_SHA1} FROM files WHERE path = ?;"
+
+    # a file touched without changing its content keeps its song.
+    INSERT_FILE = f"""
+        INSERT INTO files (path, size, mtime_ns, inode, {FIELD_FILE_SHA1})
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (path) DO UPDATE SET
+            size = excluded.size
+        ,   mtime_ns = excluded.mtime_ns
+        ,   inode = excluded.inode
+        ,   {FIELD_SONG_ID} = CASE WHEN {FIELD_FILE_SHA1} = excluded.{FIELD_FILE_SHA1} THEN {FIELD_SONG_ID} END
+        ,   {FIELD_FILE_SHA1} = excluded.{FIELD_FILE_SHA1};
+    """
+
+    UPDATE_SONG_ID = f"UPDATE files SET {FIELD_SONG_ID} = ? WHERE {FIELD_FILE_SHA1} = ?;"
+
+    def __init__(self, path: str):
+        """
+        :param path: SQLite file holding the manifest, created if it doesn't exist.
+        """
+        self.path = path
+        # files are looked up while the main thread is storing songs, so the connection is shared.
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self.conn.execute(self.CREATE_FILES_TABLE)
+        self.conn.execute(self.CREATE_SHA1_INDEX)
+        self.conn.commit()
+
+    def lookup(self, file_path: str, stat: os.stat_result) -> str:
+        """
+        Brings the hash of a file, if it was hashed before and didn't change since then.
+
+        :param file_path: path to the file.
+        :param stat: current os.stat of the file.
+        :return: the hash of the file, or None if it has to be hashed again.
+        """
+        with self._lock:
+            row = self.conn.execute(self.SELECT_FILE, (os.path.abspath(file_path),)).fetchone()
+        if row is None or row[:3] != (stat.st_size, stat.st_mtime_ns, stat.st_ino):
+            return None
+        return row[3]
+
+    def record(self, file_path: str, stat: os.stat_result, file_hash: str) -> None:
+        """
+        Stores the hash of a file. The stat has to be taken before hashing the file, so a file
+        modified in the meantime is hashed again on the next scan.
+
+        :param file_path: path to the file.
+        :param stat: os.stat of the file.
+        :param file_hash: hash of the file content.
+        """
+        with self._lock:
+            self.conn.execute(self.INSERT_FILE, (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns,
+                                                 stat.st_ino, file_hash))
+
+    def set_song_id(self, file_hash: str, song_id: int) -> None:
+        """
+        Links every file with the given content to the song it was stored as.
+
+        :param file_hash: hash of the file content.
+        :param song_id: song identifier.
+        """
+        with self._lock:
+            self.conn.execute(self.UPDATE_SONG_ID, (song_id, file_hash))
+
+    def commit(self) -> None:
+        """
+        Saves the entries recorded so far.
+        """
+        with self._lock:
+            self.conn.commit()
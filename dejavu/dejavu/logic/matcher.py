@@ -0,0 +1,48 @@
+from typing import Dict, Iterable, List, Tuple
+
+from dejavu.logic.metrics import MATCH, metrics
+
+
+def build_hash_mapper(hashes: Iterable[Tuple[str, int]]) -> Dict[str, List[int]]:
+    """
+    Groups the sampled offsets by hash, so every hash is looked up only once against the database.
+
+    :param hashes: A sequence of tuples in the format (hash, offset)
+        - hash: Part of a sha1 hash, in hexadecimal format
+        - offset: Offset this hash was created from/at.
+    :return: a dictionary of upper cased hash => list of sampled offsets.
+    """
+    mapper = {}
+    for hsh, offset in hashes:
+        mapper.setdefault(hsh.upper(), []).append(offset)
+    return mapper
+
+
+@metrics.timed(MATCH)
+def match_postings(mapper: Dict[str, List[int]], rows: Iterable[Tuple[str, int, int]]) \
+        -> Tuple[List[Tuple[int, int]], Dict[int, int]]:
+    """
+    Turns the database rows found for the hashes of a query into offset differences.
+
+    :param mapper: dictionary of hash => sampled offsets, as built by build_hash_mapper.
+    :param rows: (hash, song_id, offset) rows found in the database. Rows for hashes
+    not present in the mapper are ignored.
+    :return: a list of (sid, offset_difference) tuples and a
+    dictionary with the amount of hashes matched (not considering
+    duplicated hashes) in each song.
+    """
+    # in order to count each hash only once per db offset we use the dic below
+    dedup_hashes = {}
+
+    results = []
+    for hsh, sid, offset in rows:
+        sampled_offsets = mapper.get(hsh)
+        if sampled_offsets is None:
+            continue
+
+        dedup_hashes[sid] = dedup_hashes.get(sid, 0) + 1
+        #  we now evaluate all offset for each  hash matched
+        for song_sampled_offset in sampled_offsets:
+            results.append((sid, offset - song_sampled_offset))
+
+    return results, dedup_hashes
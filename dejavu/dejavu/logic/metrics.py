@@ -0,0 +1,285 @@
+import os
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from time import perf_counter
+from typing import Callable, Dict, Tuple
+
+from dejavu.config.settings import METRICS_BUCKETS
+
+# Latency histogram of every stage, labelled with the stage name.
+STAGE_SECONDS = "dejavu_stage_seconds"
+
+# Stages timed, see where they are used.
+DECODE = "decode"
+SPECTROGRAM = "spectrogram"
+PEAKS = "peaks"
+HASHES = "hashes"
+FINGERPRINT = "fingerprint"
+LOOKUP = "lookup"
+MATCH = "match"
+ALIGN = "align"
+INSERT = "insert"
+
+# Counters and their description.
+PEAKS_FOUND = "dejavu_peaks_total"
+HASHES_GENERATED = "dejavu_hashes_total"
+ROWS_FETCHED = "dejavu_rows_fetched_total"
+ROWS_INSERTED = "dejavu_rows_inserted_total"
+ROWS_DELETED = "dejavu_rows_deleted_total"
+CACHE_HITS = "dejavu_fingerprint_cache_hits_total"
+CACHE_MISSES = "dejavu_fingerprint_cache_misses_total"
+
+COUNTERS = {
+    PEAKS_FOUND: "Spectrogram peaks found.",
+    HASHES_GENERATED: "Hashes generated from the peaks.",
+    ROWS_FETCHED: "Fingerprint rows brought from the database by lookups.",
+    ROWS_INSERTED: "Fingerprint rows inserted in the database.",
+    ROWS_DELETED: "Fingerprint rows deleted from the database.",
+    CACHE_HITS: "Files whose fingerprints were found in the fingerprint cache.",
+    CACHE_MISSES: "Files looked for in the fingerprint cache and not found."
+}
+
+
+class Metrics:
+    """
+    Latency histograms of the fingerprinting and matching stages and counters of what goes
+    through them, exported in the Prometheus text format.
+
+    Nothing is recorded until enabled, instrumented functions then only pay for checking a
+    flag. Every process has its own metrics: tasks sent to a pool through collected() send
+    theirs back with their result, to be added with merge_result().
+    """
+    def __init__(self, buckets: Tuple[float, ...] = METRICS_BUCKETS):
+        """
+        :param buckets: upper bounds of the histogram buckets, in seconds.
+        """
+        self.enabled = False
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._server = None
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.counters = {}
+            # stage => [count of each bucket..., count above the last one, sum of the values]
+            self.histograms = {}
+
+    def enable(self, enabled: bool = True) -> None:
+        self.enabled = enabled
+
+    def inc(self, name: str, value: int = 1) -> None:
+        """
+        Increments a counter, see COUNTERS.
+
+        :param name: name of the counter.
+        :param value: amount added.
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, stage: str, seconds: float) -> None:
+        """
+        Records the time a stage took.
+
+        :param stage: name of the stage.
+        :param seconds: time it took.
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = [0] * (len(self.buckets) + 1) + [0.0]
+            histogram[bisect_left(self.buckets, seconds)] += 1
+            histogram[-1] += seconds
+
+    def timed(self, stage: str, counter: str = None) -> Callable:
+        """
+        Decorator timing every call of a function as a stage.
+
+        :param stage: name of the stage.
+        :param counter: counter incremented by the length of what the function returns, if any.
+        :return: the decorator.
+        """
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                t = perf_counter()
+                result = func(*args, **kwargs)
+                self.observe(stage, perf_counter() - t)
+                if counter is not None:
+                    self.inc(counter, len(result))
+                return result
+            return wrapper
+        return decorator
+
+    @contextmanager
+    def timing(self, stage: str):
+        """
+        Times a block as a stage, for when only part of a function is the stage.
+
+        :param stage: name of the stage.
+        """
+        t = perf_counter()
+        yield
+        self.observe(stage, perf_counter() - t)
+
+    def drain(self) -> Dict[str, Dict]:
+        """
+        Takes what was recorded so far, starting over from zero.
+
+        :return: the counters and histograms, as given to merge.
+        """
+        with self._lock:
+            state = {"counters": self.counters, "histograms": self.histograms}
+            self.counters = {}
+            self.histograms = {}
+        return state
+
+    def merge(self, state: Dict[str, Dict]) -> None:
+        """
+        Adds what another process recorded.
+
+        :param state: counters and histograms, as given by drain.
+        """
+        with self._lock:
+            for name, value in state["counters"].items():
+                self.counters[name] = self.counters.get(name, 0) + value
+            for stage, values in state["histograms"].items():
+                histogram = self.histograms.setdefault(stage, [0] * (len(self.buckets) + 1) + [0.0])
+                for index, value in enumerate(values):
+                    histogram[index] += value
+
+    def collected(self, func: Callable) -> Callable:
+        """
+        Wraps a function run by a pool so that, if metrics are enabled, it returns what it
+        recorded along with its result. Give what the pool returns to merge_result.
+
+        :param func: function sent to the pool, it must be picklable.
+        :return: the function to send to the pool instead.
+        """
+        return CollectedTask(func) if self.enabled else func
+
+    def merge_result(self, item):
+        """
+        Adds the metrics a task wrapped by collected recorded, and gives back its result.
+
+        :param item: what the pool returned for the task.
+        :return: the result of the function.
+        """
+        if not isinstance(item, CollectedResult):
+            return item
+        self.merge(item.state)
+        return item.result
+
+    def render(self) -> str:
+        """
+        :return: the metrics in the Prometheus text exposition format.
+        """
+        with self._lock:
+            counters = dict(self.counters)
+            histograms = {stage: list(values) for stage, values in self.histograms.items()}
+
+        lines = [f"# HELP {STAGE_SECONDS} Time spent in each fingerprinting and matching stage.",
+                 f"# TYPE {STAGE_SECONDS} histogram"]
+        for stage in sorted(histograms):
+            values = histograms[stage]
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), values):
+                cumulative += count
+                lines.append(f'{STAGE_SECONDS}_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            lines.append(f'{STAGE_SECONDS}_sum{{stage="{stage}"}} {values[-1]}')
+            lines.append(f'{STAGE_SECONDS}_count{{stage="{stage}"}} {cumulative}')
+
+        for name, description in COUNTERS.items():
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name} {counters.get(name, 0)}")
+
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str) -> None:
+        """
+        Writes the metrics to a file, replaced at once so readers such as the textfile
+        collector of the node exporter never see it half written.
+
+        :param path: file to write.
+        """
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with open(temporary, "w") as f:
+            f.write(self.render())
+        os.replace(temporary, path)
+
+    def serve(self, address: str) -> None:
+        """
+        Serves the metrics over HTTP on a background thread, at any path. Only the first call
+        of a process starts a server.
+
+        :param address: "host:port" to listen on.
+        """
+        if self._server is not None:
+            return
+
+        host, port = address.rsplit(":", 1)
+        self._server = _MetricsHTTPServer((host, int(port)), _MetricsHandler)
+        self._server.metrics = self
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def _claim_process(self) -> None:
+        # forked processes start with a copy of what their parent recorded, which is not theirs.
+        if os.getpid() != self._pid:
+            self._pid = os.getpid()
+            self.reset()
+
+
+class CollectedResult:
+    def __init__(self, result, state: Dict[str, Dict]):
+        self.result = result
+        self.state = state
+
+
+class CollectedTask:
+    """
+    Picklable wrapper of a function run by a pool, see Metrics.collected.
+    """
+    def __init__(self, func: Callable):
+        self.func = func
+
+    def __call__(self, *args, **kwargs) -> CollectedResult:
+        metrics._claim_process()
+        # processes that were spawned instead of forked don't know metrics are enabled.
+        metrics.enable()
+        result = self.func(*args, **kwargs)
+        return CollectedResult(result, metrics.drain())
+
+
+class _MetricsHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        content = self.server.metrics.render().encode("utf8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        # scrapes are not worth a line on the console.
+        pass
+
+
+# Metrics of the process, shared by everything instrumented.
+metrics = Metrics()
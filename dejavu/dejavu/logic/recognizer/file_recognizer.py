@@ -1,10 +1,13 @@
+import asyncio
 from time import time
 from typing import Dict
 
 import dejavu.logic.decoder as decoder
 from dejavu.base_classes.base_recognizer import BaseRecognizer
-from dejavu.config.settings import (ALIGN_TIME, FINGERPRINT_TIME, QUERY_TIME,
-                                    RESULTS, TOTAL_TIME)
+from dejavu.config.settings import (ALIGN_TIME, FINGERPRINT_TIME,
+                                    HASHES_SKIPPED, QUERY_TIME, RESULTS,
+                                    ROWS_SKIPPED, TOTAL_TIME)
+from dejavu.logic.tracing import tracer
 
 
 class FileRecognizer(BaseRecognizer):
@@ -12,17 +15,26 @@ class FileRecognizer(BaseRecognizer):
         super().__init__(dejavu)
 
     def recognize_file(self, filename: str) -> Dict[str, any]:
-        channels, self.Fs, _ = decoder.read(filename, self.dejavu.limit)
+        file_hash, hashes = self._cached_fingerprints(filename)
+        if hashes is not None:
+            t = time()
+            matches, query_time, align_time = self._match(hashes)
+            fingerprint_time = 0
+            t = time() - t
+        else:
+            channels, self.Fs, _ = decoder.read(filename, self.dejavu.limit, file_hash=file_hash)
 
-        t = time()
-        matches, fingerprint_time, query_time, align_time = self._recognize(*channels)
-        t = time() - t
+            t = time()
+            matches, fingerprint_time, query_time, align_time = self._recognize(*channels, file_hash=file_hash)
+            t = time() - t
 
         results = {
             TOTAL_TIME: t,
             FINGERPRINT_TIME: fingerprint_time,
             QUERY_TIME: query_time,
             ALIGN_TIME: align_time,
+            HASHES_SKIPPED: self.hashes_skipped,
+            ROWS_SKIPPED: self.rows_skipped,
             RESULTS: matches
         }
 
@@ -30,3 +42,37 @@ class FileRecognizer(BaseRecognizer):
 
     def recognize(self, filename: str) -> Dict[str, any]:
         return self.recognize_file(filename)
+
+    async def recognize_file_async(self, filename: str) -> Dict[str, any]:
+        loop = asyncio.get_event_loop()
+        file_hash, hashes = await loop.run_in_executor(self.executor, self._cached_fingerprints, filename)
+        if hashes is not None:
+            t = time()
+            matches, query_time, align_time = await self._match_async(hashes)
+            fingerprint_time = 0
+            t = time() - t
+        else:
+            # what runs on the executor is not traced, the span covers the wait.
+            with tracer.span("decode", file=filename):
+                channels, self.Fs, _ = await loop.run_in_executor(
+                    self.executor, decoder.read, filename, self.dejavu.limit, file_hash)
+
+            t = time()
+            matches, fingerprint_time, query_time, align_time = await self._recognize_async(
+                *channels, file_hash=file_hash)
+            t = time() - t
+
+        results = {
+            TOTAL_TIME: t,
+            FINGERPRINT_TIME: fingerprint_time,
+            QUERY_TIME: query_time,
+            ALIGN_TIME: align_time,
+            HASHES_SKIPPED: self.hashes_skipped,
+            ROWS_SKIPPED: self.rows_skipped,
+            RESULTS: matches
+        }
+
+        return results
+
+    async def recognize_async(self, filename: str) -> Dict[str, any]:
+        return await self.recognize_file_async(filename)
@@ -0,0 +1,363 @@
+import asyncio
+import json
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from time import time
+from typing import Dict, List, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+from dejavu import Dejavu
+from dejavu.config.settings import (ALIGN_TIME, FINGERPRINT_TIME,
+                                    HASHES_SKIPPED, QUERY_TIME, RESULTS,
+                                    ROWS_SKIPPED, SERVER_BATCH_WINDOW,
+                                    SERVER_DB_CONCURRENCY, SERVER_MAX_BATCH,
+                                    SERVER_MAX_BODY, SERVER_MAX_QUEUE,
+                                    TOTAL_TIME)
+from dejavu.logic.hash_arrays import (SharedHashes, receive_hashes,
+                                      share_hashes)
+from dejavu.logic.matcher import build_hash_mapper, match_postings
+from dejavu.logic.metrics import LOOKUP, ROWS_FETCHED, metrics
+from dejavu.logic.tracing import tracer
+
+HTTP_REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    403: "Forbidden",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    413: "Payload Too Large",
+    500: "Internal Server Error",
+    503: "Service Unavailable"
+}
+
+
+class RecognitionServer:
+    """
+    Long running recognition service speaking a minimal HTTP/1.0 over TCP or a Unix socket.
+
+    A single Dejavu instance (and so its database connections and song cache) is kept warm for
+    the whole life of the server. Audio is fingerprinted on a process pool and the hashes of
+    concurrent requests are merged into shared database lookups.
+
+    Endpoints:
+        POST /recognize?path=/path/to/file  recognizes a file of the server, under its audio root.
+        POST /recognize?format=mp3          recognizes the audio sent as request body.
+        GET /status                         queue and batching counters.
+        GET /metrics                        stage timings and counters in the Prometheus text format,
+                                            recorded if the metrics options of dejavu are set.
+    """
+    def __init__(self, dejavu: Dejavu, workers: int = None, max_queue: int = SERVER_MAX_QUEUE,
+                 batch_window: float = SERVER_BATCH_WINDOW, max_batch: int = SERVER_MAX_BATCH,
+                 db_concurrency: int = SERVER_DB_CONCURRENCY, max_body: int = SERVER_MAX_BODY,
+                 audio_root: str = None):
+        """
+        :param dejavu: dejavu instance used to query the database.
+        :param workers: number of fingerprinting processes, defaults to the number of cpus.
+        :param max_queue: maximum number of requests in flight, further requests get a 503 response.
+        :param batch_window: seconds a lookup waits for other requests to share the same query.
+        :param max_batch: maximum number of requests sharing a lookup.
+        :param db_concurrency: number of lookups running against the database at the same time.
+        :param max_body: largest request body in bytes, larger ones get a 413 response.
+        :param audio_root: directory whose files can be recognized by path. None means clients
+         can only send the audio itself, requests with a path get a 403 response.
+        """
+        self.dejavu = dejavu
+        self.max_body = max_body
+        self.audio_root = os.path.realpath(audio_root) if audio_root else None
+        self.workers = workers
+        self.max_queue = max_queue
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.db_concurrency = db_concurrency
+
+        self.pool = None
+        self.lookups = None
+        self.db_slots = None
+
+        self.pending = 0
+        self.served = 0
+        self.rejected = 0
+        self.batches = 0
+
+    def serve(self, address: str) -> None:
+        """
+        Runs the server until it gets interrupted.
+
+        :param address: "host:port" to listen on TCP or "unix:/path/to/socket" for a Unix socket.
+        """
+        try:
+            asyncio.run(self.run(address))
+        except KeyboardInterrupt:
+            pass
+
+    async def run(self, address: str) -> None:
+        self.pool = ProcessPoolExecutor(self.workers)
+        self.lookups = asyncio.Queue()
+        self.db_slots = asyncio.Semaphore(self.db_concurrency)
+
+        loop = asyncio.get_event_loop()
+        # Spin up the fingerprinting processes now, not on the first request.
+        await loop.run_in_executor(self.pool, os.getpid)
+        # and count the fingerprints of every hash, it takes a scan of the whole database.
+        if self.dejavu.db.max_hash_rows is not None:
+            await loop.run_in_executor(None, self.dejavu.db.build_hash_sketch)
+
+        if address.startswith("unix:"):
+            server = await asyncio.start_unix_server(self._handle_connection, address[len("unix:"):])
+        else:
+            host, port = address.rsplit(":", 1)
+            server = await asyncio.start_server(self._handle_connection, host, int(port))
+
+        print(f"Dejavu recognition server listening on {address}")
+        batcher = loop.create_task(self._batch_lookups())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+            self.pool.shutdown()
+
+    async def recognize(self, audio, audio_format: str = "") -> Dict[str, any]:
+        """
+        Recognizes a file or raw audio content.
+
+        :param audio: path to a file readable by the server or the file content as bytes.
+        :param audio_format: file extension of the content, used only for bytes.
+        :return: same results as the FileRecognizer.
+        """
+        t = time()
+        loop = asyncio.get_event_loop()
+        with tracer.trace("recognize", audio=audio if isinstance(audio, str) else f"{len(audio)} bytes") as span:
+            # decoding and fingerprinting run on the pool, the span covers the wait.
+            with tracer.span("fingerprint") as fingerprint_span:
+                shared_hashes, fingerprint_time = metrics.merge_result(await loop.run_in_executor(
+                    self.pool, metrics.collected(_fingerprint_worker),
+                    (audio, audio_format, self.dejavu.limit, self.dejavu.profile, self.dejavu.fingerprint_cache)))
+                hashes = self.dejavu.sample_query_hashes(receive_hashes(shared_hashes))
+                fingerprint_span.set(hashes=len(hashes))
+
+            # hashes with too many fingerprints are left out before joining a batch.
+            mapper = build_hash_mapper(hashes)
+            skipped = await self.dejavu.db.hashes_to_skip_async(mapper)
+            for hsh in skipped:
+                del mapper[hsh]
+
+            # the batch is looked up and matched on a thread, the span covers the wait in the queue too.
+            with tracer.span("batch", hashes=len(mapper), hashes_skipped=len(skipped)) as batch_span:
+                result = loop.create_future()
+                await self.lookups.put((mapper, len(hashes), result))
+                matches, query_time, align_time = await result
+                batch_span.set(query_time=round(query_time, 6), align_time=round(align_time, 6))
+            span.set(results=len(matches))
+
+        return {
+            TOTAL_TIME: time() - t,
+            FINGERPRINT_TIME: fingerprint_time,
+            QUERY_TIME: query_time,
+            ALIGN_TIME: align_time,
+            HASHES_SKIPPED: len(skipped),
+            ROWS_SKIPPED: sum(skipped.values()),
+            RESULTS: matches
+        }
+
+    async def _batch_lookups(self) -> None:
+        """
+        Groups the lookups queued within the batch window so they are sent as a single query.
+        """
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = [await self.lookups.get()]
+            deadline = loop.time() + self.batch_window
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.lookups.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            await self.db_slots.acquire()
+            loop.create_task(self._run_batch(batch))
+
+    async def _run_batch(self, batch: List[Tuple[Dict[str, List[int]], int, asyncio.Future]]) -> None:
+        loop = asyncio.get_event_loop()
+        try:
+            self.batches += 1
+            results = await loop.run_in_executor(None, self._match_batch, batch)
+        except Exception as err:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(err)
+        else:
+            for (_, _, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+        finally:
+            self.db_slots.release()
+
+    def _match_batch(self, batch: List[Tuple[Dict[str, List[int]], int, asyncio.Future]]) \
+            -> List[Tuple[List[Dict[str, any]], float, float]]:
+        """
+        Looks up the union of the hashes of every request in the batch at once, then
+        matches and aligns each request on its own. Runs on a thread.
+        """
+        t = time()
+        values = set()
+        for mapper, _, _ in batch:
+            values.update(mapper.keys())
+
+        postings = {}
+        rows = 0
+        for hsh, sid, offset in self.dejavu.db.lookup_hashes(list(values)):
+            postings.setdefault(hsh, []).append((sid, offset))
+            rows += 1
+        query_time = time() - t
+        metrics.observe(LOOKUP, query_time)
+        metrics.inc(ROWS_FETCHED, rows)
+
+        results = []
+        for mapper, queried_hashes, _ in batch:
+            t = time()
+            rows = ((hsh, sid, offset) for hsh in mapper for sid, offset in postings.get(hsh, ()))
+            matches, dedup_hashes = match_postings(mapper, rows)
+            songs = self.dejavu.align_matches(matches, dedup_hashes, queried_hashes)
+            results.append((songs, query_time, time() - t))
+
+        return results
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            request_line = await reader.readline()
+            method, target, _ = request_line.decode("latin-1").split(" ", 2)
+
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+
+            length = int(headers.get("content-length", 0))
+            if length < 0:
+                raise ValueError(f"negative content length {length}")
+        except ValueError:
+            status, payload = 400, {"error": "malformed request"}
+        else:
+            queued = method == "POST" and urlsplit(target).path == "/recognize"
+            if length > self.max_body:
+                # refused before being read, so it never takes any memory.
+                status, payload = 413, {"error": f"the request body is larger than {self.max_body} bytes"}
+            elif queued and self.pending >= self.max_queue:
+                # Admission control, fail fast instead of letting the queue grow unbounded. Checked once
+                # the headers are read, so the body of a refused request isn't read either.
+                self.rejected += 1
+                status, payload = 503, {"error": "too many pending requests"}
+            else:
+                if queued:
+                    # the request holds its place in the queue while its body is read too.
+                    self.pending += 1
+                try:
+                    body = await reader.readexactly(length)
+                except asyncio.IncompleteReadError:
+                    status, payload = 400, {"error": "malformed request"}
+                else:
+                    status, payload = await self._dispatch(method, target, body)
+                finally:
+                    if queued:
+                        self.pending -= 1
+
+        if isinstance(payload, str):
+            content, content_type = payload.encode("utf8"), "text/plain; version=0.0.4"
+        else:
+            content, content_type = json.dumps(payload, default=_json_default).encode("utf8"), "application/json"
+        writer.write(
+            f"HTTP/1.0 {status} {HTTP_REASONS[status]}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(content)}\r\n"
+            f"Connection: close\r\n\r\n".encode("latin-1") + content)
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def _dispatch(self, method: str, target: str, body: bytes) -> Tuple[int, Dict[str, any]]:
+        url = urlsplit(target)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+
+        if url.path == "/status":
+            return 200, {
+                "pending": self.pending,
+                "max_queue": self.max_queue,
+                "served": self.served,
+                "rejected": self.rejected,
+                "batches": self.batches
+            }
+
+        if url.path == "/metrics":
+            return 200, metrics.render()
+
+        if url.path != "/recognize":
+            return 404, {"error": f"unknown path {url.path}"}
+
+        if method != "POST":
+            return 405, {"error": "use POST to recognize audio"}
+
+        if "path" not in params and not body:
+            return 400, {"error": "send the audio as request body or a server side path"}
+
+        if "path" in params and not self._readable_path(params["path"]):
+            return 403, {"error": "the path is not under the audio root of the server"}
+
+        # admitted already, by _handle_connection.
+        try:
+            if "path" in params:
+                result = await self.recognize(params["path"])
+            else:
+                result = await self.recognize(body, params.get("format", ""))
+        except Exception as err:
+            return 500, {"error": str(err)}
+
+        self.served += 1
+        return 200, result
+
+    def _readable_path(self, path: str) -> bool:
+        """
+        Whether clients may have a file of the server recognized, only the ones under the audio
+        root are. Links are resolved first, so they can't lead out of it.
+
+        :param path: path sent by the client.
+        :return: True if the file is under the audio root.
+        """
+        if self.audio_root is None:
+            return False
+        path = os.path.realpath(path)
+        return os.path.commonpath([path, self.audio_root]) == self.audio_root
+
+
+def _fingerprint_worker(arguments) -> Tuple[SharedHashes, float]:
+    # ProcessPoolExecutor sends arguments as tuples so we have to unpack them ourself.
+    audio, audio_format, limit, profile, cache = arguments
+
+    t = time()
+    if isinstance(audio, bytes):
+        suffix = f".{audio_format.lstrip('.')}" if audio_format else ""
+        with tempfile.NamedTemporaryFile(suffix=suffix) as f:
+            f.write(audio)
+            f.flush()
+            hashes, _ = Dejavu.get_file_fingerprints(f.name, limit, profile=profile, cache=cache)
+    else:
+        hashes, _ = Dejavu.get_file_fingerprints(audio, limit, profile=profile, cache=cache)
+
+    return share_hashes(hashes), time() - t
+
+
+def _json_default(value):
+    # song names and hashes come back as bytes, numpy scalars from the offsets.
+    if isinstance(value, bytes):
+        return value.decode("utf8")
+    if hasattr(value, "item"):
+        return value.item()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
@@ -0,0 +1,168 @@
+import json
+import multiprocessing
+import os
+import socket
+import sys
+import traceback
+from typing import Dict, Iterator, List, Tuple
+
+import numpy as np
+
+import dejavu.logic.decoder as decoder
+from dejavu.config.settings import (DEFAULT_FINGERPRINT_PROFILE,
+                                    FINGERPRINT_PROFILES, SHARD_SONGS)
+from dejavu.logic.fingerprint_cache import FingerprintCache, settings_digest
+from dejavu.logic.hash_arrays import (HASH_BYTES, SharedHashes,
+                                      receive_hash_arrays, share_hashes)
+
+# Bumped whenever the layout of the shard files changes.
+SHARD_FORMAT = 1
+
+
+def export_shards(path: str, extensions: List[str], output_dir: str, profile_name: str = DEFAULT_FINGERPRINT_PROFILE,
+                  limit: int = None, nprocesses: int = None, songs_per_shard: int = SHARD_SONGS,
+                  cache: FingerprintCache = None, prefix: str = None) -> List[str]:
+    """
+    Fingerprints all the files in a directory into shard files, without any database. The shards
+    are loaded later on with Dejavu.load_shards, so fingerprinting can be spread over several
+    machines and a new database can be filled without fingerprinting again.
+
+    :param path: path to the directory.
+    :param extensions: list of file extensions to consider.
+    :param output_dir: directory the shards are written to.
+    :param profile_name: fingerprinting profile, it has to be the one of the database loading them.
+    :param limit: number of seconds fingerprinted from each file, None for the whole file.
+    :param nprocesses: amount of processes fingerprinting the files, defaults to the number of cpus.
+    :param songs_per_shard: number of songs in each shard file.
+    :param cache: fingerprint cache to look into first, and to store the fingerprints in.
+    :param prefix: name of the shard files, defaults to the host name and process id so shards
+        written at the same time by several machines don't collide.
+    :return: the paths of the shards written.
+    """
+    if profile_name not in FINGERPRINT_PROFILES:
+        raise ValueError(f"Unknown fingerprint profile '{profile_name}', "
+                         f"choose one of: {', '.join(FINGERPRINT_PROFILES)}.")
+    profile = dict(FINGERPRINT_PROFILES[profile_name], name=profile_name)
+    info = {
+        "format": SHARD_FORMAT,
+        "profile": profile,
+        "limit": limit,
+        "settings": settings_digest()
+    }
+
+    os.makedirs(output_dir, exist_ok=True)
+    prefix = prefix or f"{socket.gethostname()}-{os.getpid()}"
+
+    worker_input = ((filename, limit, profile, cache) for filename, _ in decoder.find_files(path, extensions))
+
+    shard_paths = []
+    songs = []
+    seen = set()
+    with multiprocessing.Pool(nprocesses) as pool:
+        iterator = pool.imap_unordered(_shard_worker, worker_input)
+        while True:
+            try:
+                song_name, file_hash, shared_hashes = next(iterator)
+                hash_array, offsets = receive_hash_arrays(shared_hashes)
+            except StopIteration:
+                break
+            except Exception:
+                print("Failed fingerprinting")
+                # Print traceback because we can't reraise it here
+                traceback.print_exc(file=sys.stdout)
+                continue
+
+            # files with the same content are stored once, as fingerprint_directory does.
+            if file_hash in seen:
+                print(f"{song_name} is a copy of a file already exported, continuing...")
+                continue
+            seen.add(file_hash)
+
+            songs.append((song_name, file_hash, hash_array, offsets))
+            print(f"Exported {song_name} with {len(offsets)} fingerprints")
+
+            if len(songs) == songs_per_shard:
+                shard_paths.append(write_shard(os.path.join(output_dir, f"{prefix}-{len(shard_paths):05d}.npz"),
+                                               info, songs))
+                songs = []
+
+    if songs:
+        shard_paths.append(write_shard(os.path.join(output_dir, f"{prefix}-{len(shard_paths):05d}.npz"), info, songs))
+
+    return shard_paths
+
+
+def write_shard(shard_path: str, info: Dict[str, any], songs: List[Tuple[str, str, np.ndarray, np.ndarray]]) -> str:
+    """
+    Writes the fingerprints of some songs in a shard file, a numpy .npz archive.
+
+    :param shard_path: path of the shard file.
+    :param info: how the fingerprints were computed: format, profile, limit and settings digest.
+    :param songs: tuples of song name, file hash, packed hashes and offsets.
+    :return: the path of the shard file.
+    """
+    # written aside and then renamed, so a loader never picks up half a shard.
+    partial = f"{shard_path}.tmp"
+    with open(partial, "wb") as f:
+        np.savez(
+            f,
+            info=np.array(json.dumps(info)),
+            song_names=np.array([song_name for song_name, _, _, _ in songs]),
+            file_hashes=np.array([file_hash for _, file_hash, _, _ in songs]),
+            counts=np.array([len(offsets) for _, _, _, offsets in songs], dtype=np.uint32),
+            hash_array=np.concatenate([hash_array for _, _, hash_array, _ in songs]).reshape(-1, HASH_BYTES),
+            offsets=np.concatenate([offsets for _, _, _, offsets in songs]).astype(np.uint32)
+        )
+    os.replace(partial, shard_path)
+    return shard_path
+
+
+def read_shard(shard_path: str) -> Tuple[Dict[str, any], Iterator[Tuple[str, str, np.ndarray, np.ndarray]]]:
+    """
+    Reads a shard file written by write_shard.
+
+    :param shard_path: path of the shard file.
+    :return: the shard info and an iterator of tuples of song name, file hash, packed hashes and offsets.
+    """
+    with np.load(shard_path) as shard:
+        info = json.loads(shard["info"].item())
+        if info["format"] != SHARD_FORMAT:
+            raise ValueError(f"{shard_path} has format {info['format']}, only format {SHARD_FORMAT} can be read.")
+
+        song_names, file_hashes = shard["song_names"].tolist(), shard["file_hashes"].tolist()
+        counts, hash_array, offsets = shard["counts"], shard["hash_array"], shard["offsets"]
+
+    ends = np.cumsum(counts).tolist()
+    starts = [0] + ends[:-1]
+    songs = (
+        (song_name, file_hash, hash_array[start:end], offsets[start:end])
+        for song_name, file_hash, start, end in zip(song_names, file_hashes, starts, ends)
+    )
+    return info, songs
+
+
+def find_shards(paths: List[str]) -> List[str]:
+    """
+    Expands directories into the shard files they hold.
+
+    :param paths: shard files or directories of shard files.
+    :return: the paths of the shard files, sorted.
+    """
+    shard_paths = []
+    for path in paths:
+        if os.path.isdir(path):
+            shard_paths.extend(shard_path for shard_path, _ in decoder.find_files(path, ["npz"]))
+        else:
+            shard_paths.append(path)
+    return sorted(shard_paths)
+
+
+def _shard_worker(arguments) -> Tuple[str, str, SharedHashes]:
+    # Imported here, dejavu imports this module.
+    from dejavu import Dejavu
+
+    file_name, limit, profile, cache = arguments
+    song_name = decoder.get_audio_name_from_path(file_name)
+    hashes, file_hash = Dejavu.get_file_fingerprints(file_name, limit, print_output=True, profile=profile,
+                                                     cache=cache)
+    return song_name, file_hash, share_hashes(hashes)
@@ -0,0 +1,155 @@
+import json
+import zipfile
+from typing import Dict, Set
+
+import numpy as np
+
+from dejavu.base_classes.base_database import BaseDatabase
+from dejavu.config.settings import (FIELD_FILE_SHA1, FIELD_SONG_ID,
+                                    FIELD_SONGNAME, FIELD_TOTAL_HASHES,
+                                    SNAPSHOT_BATCH_SIZE)
+from dejavu.logic.hash_arrays import pack_hashes, unpack_hashes
+from dejavu.logic.hash_sampling import keep_hash
+
+# Bumped whenever the layout of the snapshot files changes.
+SNAPSHOT_FORMAT = 1
+
+
+def export_snapshot(db: BaseDatabase, path: str, info: Dict[str, any],
+                    batch_size: int = SNAPSHOT_BATCH_SIZE) -> Dict[str, any]:
+    """
+    Writes the fingerprinted songs and all their fingerprints to a snapshot file. Fingerprints are
+    streamed from the database a batch at a time, so memory doesn't grow with the database.
+
+    A snapshot is a zip archive of numpy arrays, one per column: songs/<column>.npy for the songs,
+    stop_hashes/<column>.npy for the stop hashes and fingerprints/<batch>/<column>.npy for each
+    batch of fingerprints, hashes packed in bytes. Hashes are random and stored as they are, the
+    other columns are compressed.
+
+    :param db: database to take the snapshot of.
+    :param path: snapshot file to write.
+    :param info: values describing the database, such as its fingerprinting profile.
+    :param batch_size: number of fingerprints read and written at a time.
+    :return: the info stored in the snapshot, with the number of songs, stop hashes and fingerprints.
+    """
+    songs = db.get_songs()
+    stop_hashes = db.get_stop_hashes()
+    info = dict(info, format=SNAPSHOT_FORMAT, songs=len(songs), stop_hashes=len(stop_hashes), fingerprints=0,
+                batches=0)
+
+    with zipfile.ZipFile(path, "w", allowZip64=True) as snapshot:
+        _write_array(snapshot, "songs/song_id.npy", np.array([song[FIELD_SONG_ID] for song in songs], dtype=np.int64))
+        _write_array(snapshot, "songs/song_name.npy", np.array([song[FIELD_SONGNAME] for song in songs], dtype=str))
+        _write_array(snapshot, "songs/file_sha1.npy", np.array([song[FIELD_FILE_SHA1] for song in songs], dtype=str))
+        _write_array(snapshot, "songs/total_hashes.npy",
+                     np.array([song[FIELD_TOTAL_HASHES] for song in songs], dtype=np.int64))
+
+        stop_array, stop_songs = pack_hashes(stop_hashes.items())
+        _write_array(snapshot, "stop_hashes/hash.npy", stop_array, compress=False)
+        _write_array(snapshot, "stop_hashes/songs.npy", stop_songs)
+
+        for rows in db.iter_fingerprints(batch_size):
+            hash_array, offsets = pack_hashes((hsh, offset) for hsh, _, offset in rows)
+            song_ids = np.fromiter((sid for _, sid, _ in rows), dtype=np.int64, count=len(rows))
+
+            batch = f"fingerprints/{info['batches']:06d}"
+            _write_array(snapshot, f"{batch}/hash.npy", hash_array, compress=False)
+            _write_array(snapshot, f"{batch}/song_id.npy", song_ids)
+            _write_array(snapshot, f"{batch}/offset.npy", offsets)
+
+            info["batches"] += 1
+            info["fingerprints"] += len(rows)
+
+        snapshot.writestr("info.json", json.dumps(info))
+
+    return info
+
+
+def import_snapshot(db: BaseDatabase, path: str, skip_hashes: Set[str] = frozenset(),
+                    sample_ratio: int = 1, stop_hashes: Set[str] = frozenset()) -> Dict[str, any]:
+    """
+    Stores the songs, stop hashes and fingerprints of a snapshot file in a database. Songs get new
+    identifiers, and are set as fingerprinted only once all the fingerprints are in. The stop hashes
+    of the snapshot are pruned from the database, and no fingerprint of a stop hash is restored.
+
+    :param db: database to restore the snapshot into.
+    :param path: snapshot file to read.
+    :param skip_hashes: file hashes of the songs to leave out, such as the ones already in the database.
+    :param sample_ratio: only the fingerprints of one hash out of sample_ratio are restored, see keep_hash.
+    :param stop_hashes: stop hashes of the database, in lower case hexadecimal.
+    :return: the info stored in the snapshot, with the number of songs restored and their new identifiers.
+    """
+    info = read_snapshot_info(path)
+    with zipfile.ZipFile(path) as snapshot:
+        # snapshots taken before stop hashes were kept don't have any.
+        if info.get("stop_hashes"):
+            snapshot_stop_hashes = dict(unpack_hashes(_read_array(snapshot, "stop_hashes/hash.npy"),
+                                                      _read_array(snapshot, "stop_hashes/songs.npy")))
+            db.prune_hashes({hsh.upper(): songs for hsh, songs in snapshot_stop_hashes.items()})
+            stop_hashes = set(stop_hashes) | set(snapshot_stop_hashes)
+
+        songs = zip(
+            _read_array(snapshot, "songs/song_id.npy").tolist(),
+            _read_array(snapshot, "songs/song_name.npy").tolist(),
+            _read_array(snapshot, "songs/file_sha1.npy").tolist(),
+            _read_array(snapshot, "songs/total_hashes.npy").tolist()
+        )
+
+        # snapshot song id => new song id.
+        new_ids = {
+            old_id: db.insert_song(song_name, file_hash, total_hashes)
+            for old_id, song_name, file_hash, total_hashes in songs if file_hash not in skip_hashes
+        }
+
+        # new song id => number of fingerprints restored, when some are left out.
+        restored_hashes = {}
+        counted = sample_ratio != 1 or bool(stop_hashes)
+        for index in range(info["batches"]):
+            batch = f"fingerprints/{index:06d}"
+            song_ids = _read_array(snapshot, f"{batch}/song_id.npy").tolist()
+            hashes = unpack_hashes(_read_array(snapshot, f"{batch}/hash.npy"),
+                                   _read_array(snapshot, f"{batch}/offset.npy"))
+
+            # fingerprints of songs left out, or not fingerprinted when the snapshot was taken, are skipped.
+            rows = [(new_ids[song_id], hsh, offset) for song_id, (hsh, offset) in zip(song_ids, hashes)
+                    if song_id in new_ids and (sample_ratio == 1 or keep_hash(hsh, sample_ratio))
+                    and hsh not in stop_hashes]
+            db.insert_fingerprint_rows(rows)
+
+            if counted:
+                for song_id, _, _ in rows:
+                    restored_hashes[song_id] = restored_hashes.get(song_id, 0) + 1
+
+    for song_id in new_ids.values():
+        # songs sampled or stripped of stop hashes on the way in have fewer fingerprints than in the snapshot.
+        if counted:
+            db.set_song_total_hashes(song_id, restored_hashes.get(song_id, 0))
+        db.set_song_fingerprinted(song_id)
+
+    return dict(info, restored=len(new_ids), song_ids=list(new_ids.values()))
+
+
+def read_snapshot_info(path: str) -> Dict[str, any]:
+    """
+    Reads the description of a snapshot.
+
+    :param path: snapshot file.
+    :return: the info stored by export_snapshot.
+    """
+    with zipfile.ZipFile(path) as snapshot:
+        info = json.loads(snapshot.read("info.json"))
+    if info["format"] != SNAPSHOT_FORMAT:
+        raise ValueError(f"{path} has format {info['format']}, only format {SNAPSHOT_FORMAT} can be read.")
+    return info
+
+
+def _write_array(snapshot: zipfile.ZipFile, name: str, array: np.ndarray, compress: bool = True) -> None:
+    member = zipfile.ZipInfo(name)
+    member.compress_type = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+    with snapshot.open(member, "w", force_zip64=True) as f:
+        np.lib.format.write_array(f, np.ascontiguousarray(array), allow_pickle=False)
+
+
+def _read_array(snapshot: zipfile.ZipFile, name: str) -> np.ndarray:
+    with snapshot.open(name) as f:
+        return np.lib.format.read_array(f, allow_pickle=False)
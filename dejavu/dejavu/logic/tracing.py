@@ -0,0 +1,184 @@
+import json
+import random
+import threading
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from time import perf_counter
+from typing import Dict
+
+from dejavu.config.settings import TRACE_SAMPLE_RATE, TRACE_THRESHOLD
+
+# Span the code running now belongs to, if its request is traced. Asyncio tasks inherit it
+# from the code creating them, threads and processes start without one.
+_current_span = ContextVar("dejavu_current_span", default=None)
+
+
+class Span:
+    """
+    Timed step of a traced request, with the attributes describing what it went through
+    and the steps it was made of.
+    """
+    def __init__(self, name: str, attributes: Dict[str, any], parent: "Span" = None):
+        self.name = name
+        self.attributes = attributes
+        self.children = []
+        self.parent = parent
+        self.start = perf_counter()
+        self.duration = None
+        self._token = None
+        if parent is not None:
+            parent.children.append(self)
+
+    def set(self, **attributes) -> None:
+        """
+        Sets attributes of the span, replacing previous values.
+        """
+        self.attributes.update(attributes)
+
+    def add(self, name: str, value: int = 1) -> None:
+        """
+        Adds to a numerical attribute of the span, for what is counted across several calls.
+
+        :param name: name of the attribute.
+        :param value: amount added.
+        """
+        self.attributes[name] = self.attributes.get(name, 0) + value
+
+    def __enter__(self) -> "Span":
+        self._token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.duration = perf_counter() - self.start
+        _current_span.reset(self._token)
+        if exc_type is not None:
+            self.attributes["error"] = exc_type.__name__
+        if self.parent is None:
+            tracer.finish(self)
+
+    def to_dict(self, root_start: float = None) -> Dict[str, any]:
+        """
+        :param root_start: start of the request, offsets of the spans are relative to it.
+        :return: the span and its children as a JSON serializable dictionary.
+        """
+        root_start = self.start if root_start is None else root_start
+        span = {"name": self.name, "start": round(self.start - root_start, 6), "duration": round(self.duration, 6)}
+        if self.attributes:
+            span["attributes"] = self.attributes
+        if self.children:
+            span["spans"] = [child.to_dict(root_start) for child in self.children if child.duration is not None]
+        return span
+
+
+class _NoSpan:
+    """
+    Stands for a span when the request is not traced, recording nothing.
+    """
+    def set(self, **attributes) -> None:
+        pass
+
+    def add(self, name: str, value: int = 1) -> None:
+        pass
+
+    def __bool__(self) -> bool:
+        return False
+
+    def __enter__(self) -> "_NoSpan":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        pass
+
+
+NO_SPAN = _NoSpan()
+
+
+class Tracer:
+    """
+    Span trees of recognitions and fingerprinted files, the requests slower than a threshold
+    written to a JSON lines slow log, one request per line.
+
+    Nothing is recorded until enabled, and then only for the sampled requests: the others, and
+    every span of a request not sampled, cost a context variable lookup. Spans are kept for the
+    code running in the thread or asyncio task of the request, what runs on executors and pools
+    is only seen through the span waiting for it.
+    """
+    def __init__(self):
+        self.path = None
+        self.threshold = TRACE_THRESHOLD
+        self.sample_rate = TRACE_SAMPLE_RATE
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.path is not None
+
+    def enable(self, path: str, threshold: float = TRACE_THRESHOLD, sample_rate: float = TRACE_SAMPLE_RATE) -> None:
+        """
+        :param path: JSON lines file the slow requests are appended to.
+        :param threshold: requests taking at least this many seconds are written.
+        :param sample_rate: fraction of the requests traced, between 0 and 1.
+        """
+        self.path = path
+        self.threshold = threshold
+        self.sample_rate = sample_rate
+
+    def disable(self) -> None:
+        self.path = None
+
+    def trace(self, name: str, **attributes):
+        """
+        Starts tracing a request, to be used as a context manager. Inside a request already
+        traced it is a span of it.
+
+        :param name: name of the request.
+        :param attributes: attributes of the request.
+        :return: the span of the request, false when it is not traced.
+        """
+        parent = _current_span.get()
+        if parent is not None:
+            return Span(name, attributes, parent)
+        if self.path is None or (self.sample_rate < 1 and random.random() >= self.sample_rate):
+            return NO_SPAN
+        return Span(name, attributes)
+
+    @staticmethod
+    def span(name: str, **attributes):
+        """
+        Starts a span of the request being traced, to be used as a context manager.
+
+        :param name: name of the span.
+        :param attributes: attributes of the span.
+        :return: the span, false when the request is not traced.
+        """
+        parent = _current_span.get()
+        if parent is None:
+            return NO_SPAN
+        return Span(name, attributes, parent)
+
+    @staticmethod
+    def current():
+        """
+        :return: the innermost span of the request being traced, false when it is not traced.
+        """
+        span = _current_span.get()
+        return NO_SPAN if span is None else span
+
+    def finish(self, root: Span) -> None:
+        """
+        Writes a finished request to the slow log, if it took long enough.
+
+        :param root: span of the request.
+        """
+        path = self.path
+        if path is None or root.duration < self.threshold:
+            return
+
+        record = dict(time=datetime.now(timezone.utc).isoformat(), **root.to_dict())
+        line = json.dumps(record, default=str) + "\n"
+        with self._lock, open(path, "a") as f:
+            f.write(line)
+
+
+# Tracer of the process, shared by everything instrumented.
+tracer = Tracer()
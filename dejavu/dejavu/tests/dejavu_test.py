@@ -1,6 +1,6 @@
 import fnmatch
-import json
 import logging
+import multiprocessing
 import random
 import re
 import subprocess
@@ -12,19 +12,37 @@ import matplotlib.pyplot as plt
 import numpy as np
 from pydub import AudioSegment
 
-from dejavu.config.settings import (DEFAULT_FS, DEFAULT_OVERLAP_RATIO,
-                                    DEFAULT_WINDOW_SIZE, HASHES_MATCHED,
-                                    OFFSET, RESULTS, SONG_NAME, TOTAL_TIME)
+from dejavu import Dejavu
+from dejavu.config.settings import (HASHES_MATCHED, OFFSET_SECS, RESULTS,
+                                    SONG_NAME, TOTAL_TIME)
 from dejavu.logic.decoder import get_audio_name_from_path
+from dejavu.logic.recognizer.file_recognizer import FileRecognizer
+
+# Dejavu instance of each pool process, see _init_worker.
+_worker_djv = None
 
 
 class DejavuTest:
-    def __init__(self, folder, seconds):
+    def __init__(self, folder, seconds, config, workers=1):
+        """
+        Recognizes every test file of a folder and gathers the results in matrices of a line
+        per song and a column per clip length.
+
+        :param folder: folder of the test files, named as generate_test_files does.
+        :param seconds: clip lengths tested, as "1sec", "2sec"...
+        :param config: configuration of the Dejavu instances recognizing the files, as for dejavu.py.
+        :param workers: processes recognizing the files, each one keeping its own Dejavu instance
+         for all of them. With one the files are recognized in this process.
+        """
         super().__init__()
 
         self.test_folder = folder
         self.test_seconds = seconds
         self.test_songs = []
+        self.config = config
+        self.workers = workers
+        # result of every test file, as given by evaluate.
+        self.results = []
 
         print("test_seconds", self.test_seconds)
 
@@ -106,78 +124,141 @@ class DejavuTest:
             fig_name = join(results_folder, f"{name}_{self.test_seconds[sec]}.png")
             fig.savefig(fig_name)
 
+    def recognize_files(self):
+        """
+        Recognizes the test files with read only Dejavu instances, the database is not written.
+
+        :return: an iterator of (file name, recognition results) tuples, in the order of the test files.
+        """
+        config = dict(self.config, read_only=True)
+        paths = [join(self.test_folder, f) for f in self.test_files]
+
+        if self.workers <= 1:
+            djv = Dejavu(config)
+            for f, path in zip(self.test_files, paths):
+                yield f, djv.recognize(FileRecognizer, path)
+            return
+
+        with multiprocessing.Pool(self.workers, initializer=_init_worker, initargs=(config,)) as pool:
+            # results come back in the order of the files, while the pool works on the next ones.
+            yield from zip(self.test_files, pool.imap(_recognize_worker, paths))
+
+    def evaluate(self, f, result):
+        """
+        Checks the recognition of a test file against the song and offset it was cut from.
+
+        :param f: name of the test file.
+        :param result: what Dejavu.recognize returned for it.
+        :return: a dictionary with the file, its song, clip length, line and column in the
+         matrices, match ('yes', 'no' or 'invalid'), song recognized, query duration, confidence
+         and matching time, the difference in seconds between the offset found and the real one.
+        """
+        # get column
+        secs = [x for x in re.findall("[0-9]sec", f) if x in self.test_seconds][0]
+        col = self.get_column_id(secs)
+
+        # format: XXXX_offset_length.mp3, we also take into account underscores within XXXX
+        splits = get_audio_name_from_path(f).split("_")
+        song = "_".join(splits[0:len(splits) - 2])
+        line = self.get_line_id(song)
+
+        evaluation = {
+            "file": f,
+            "song": song,
+            "seconds": secs,
+            "line": line,
+            "column": col,
+            "match": "no",
+            "song_result": None,
+            "query_duration": 0,
+            "confidence": 0,
+            "matching_time": 0
+        }
+
+        if not result[RESULTS]:
+            return evaluation
+
+        # which song did we predict? We consider only the first match.
+        match = result[RESULTS][0]
+        song_result = match[SONG_NAME]
+        if isinstance(song_result, bytes):
+            song_result = song_result.decode("utf8")
+        evaluation["song_result"] = song_result
+
+        if song_result != song:
+            evaluation["match"] = "invalid"
+            return evaluation
+
+        # using replace in f for getting rid of underscores in name
+        song_start_time = re.findall("_[^_]+", f.replace(song, ""))
+        song_start_time = song_start_time[0].lstrip("_ ")
+        result_start_time = round(match[OFFSET_SECS], 0)
+
+        matching_time = int(result_start_time) - int(song_start_time)
+        if abs(matching_time) == 1:
+            matching_time = 0
+
+        evaluation.update({
+            "match": "yes",
+            "query_duration": round(result[TOTAL_TIME], 3),
+            "confidence": match[HASHES_MATCHED],
+            "song_start_time": int(song_start_time),
+            "result_start_time": int(result_start_time),
+            "matching_time": matching_time
+        })
+        return evaluation
+
     def begin(self):
-        for f in self.test_files:
+        """
+        Recognizes the test files and fills the result matrices.
+
+        :return: the result of every test file, as given by evaluate.
+        """
+        for f, result in self.recognize_files():
+            evaluation = self.evaluate(f, result)
+            self.results.append(evaluation)
+
+            line, col = evaluation["line"], evaluation["column"]
+            self.result_match[line][col] = evaluation["match"]
+            self.result_matching_times[line][col] = evaluation["matching_time"]
+            self.result_query_duration[line][col] = evaluation["query_duration"]
+            self.result_match_confidence[line][col] = evaluation["confidence"]
+
             log_msg('--------------------------------------------------')
             log_msg(f'file: {f}')
-
-            # get column
-            col = self.get_column_id([x for x in re.findall("[0-9]sec", f) if x in self.test_seconds][0])
-
-            # format: XXXX_offset_length.mp3, we also take into account underscores within XXXX
-            splits = get_audio_name_from_path(f).split("_")
-            song = "_".join(splits[0:len(get_audio_name_from_path(f).split("_")) - 2])
-            line = self.get_line_id(song)
-            result = subprocess.check_output([
-                "python",
-                "dejavu.py",
-                '-r',
-                'file',
-                join(self.test_folder, f)])
-
-            if result.strip() == "None":
+            if evaluation["match"] == "no":
                 log_msg('No match')
-                self.result_match[line][col] = 'no'
-                self.result_matching_times[line][col] = 0
-                self.result_query_duration[line][col] = 0
-                self.result_match_confidence[line][col] = 0
-
             else:
-                result = result.strip()
-                # we parse the output song back to a json
-                result = json.loads(result.decode('utf-8').replace("'", '"').replace(': b"', ':"'))
-
-                # which song did we predict? We consider only the first match.
-                match = result[RESULTS][0]
-                song_result = match[SONG_NAME]
-                log_msg(f'song: {song}')
-                log_msg(f'song_result: {song_result}')
-
-                if song_result != song:
-                    log_msg('invalid match')
-                    self.result_match[line][col] = 'invalid'
-                    self.result_matching_times[line][col] = 0
-                    self.result_query_duration[line][col] = 0
-                    self.result_match_confidence[line][col] = 0
+                log_msg(f'song: {evaluation["song"]}')
+                log_msg(f'song_result: {evaluation["song_result"]}')
+
+            if evaluation["match"] == "invalid":
+                log_msg('invalid match')
+            elif evaluation["match"] == "yes":
+                log_msg('correct match')
+                log_msg(f'query duration: {evaluation["query_duration"]}')
+                log_msg(f'confidence: {evaluation["confidence"]}')
+                log_msg(f'song start_time: {evaluation["song_start_time"]}')
+                log_msg(f'result start time: {evaluation["result_start_time"]}')
+
+                if evaluation["matching_time"] == 0:
+                    log_msg('accurate match')
                 else:
-                    log_msg('correct match')
-                    print(self.result_match)
-                    self.result_match[line][col] = 'yes'
-                    self.result_query_duration[line][col] = round(result[TOTAL_TIME], 3)
-                    self.result_match_confidence[line][col] = match[HASHES_MATCHED]
-
-                    # using replace in f for getting rid of underscores in name
-                    song_start_time = re.findall("_[^_]+", f.replace(song, ""))
-                    song_start_time = song_start_time[0].lstrip("_ ")
-
-                    result_start_time = round((match[OFFSET] * DEFAULT_WINDOW_SIZE *
-                                               DEFAULT_OVERLAP_RATIO) / DEFAULT_FS, 0)
-
-                    self.result_matching_times[line][col] = int(result_start_time) - int(song_start_time)
-                    if abs(self.result_matching_times[line][col]) == 1:
-                        self.result_matching_times[line][col] = 0
-
-                    log_msg(f'query duration: {round(result[TOTAL_TIME], 3)}')
-                    log_msg(f'confidence: {match[HASHES_MATCHED]}')
-                    log_msg(f'song start_time: {song_start_time}')
-                    log_msg(f'result start time: {result_start_time}')
-
-                    if self.result_matching_times[line][col] == 0:
-                        log_msg('accurate match')
-                    else:
-                        log_msg('inaccurate match')
+                    log_msg('inaccurate match')
             log_msg('--------------------------------------------------\n')
 
+        return self.results
+
+
+def _init_worker(config):
+    # Runs once in every pool process: its own Dejavu instance, kept for all its files.
+    global _worker_djv
+    _worker_djv = Dejavu(config)
+
+
+def _recognize_worker(path):
+    return _worker_djv.recognize(FileRecognizer, path)
+
 
 def set_seed(seed=None):
     """
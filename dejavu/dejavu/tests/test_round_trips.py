@@ -0,0 +1,128 @@
+"""
+Checks that the faster paths give the same fingerprints as the plain ones: parallel segments
+against serial fingerprinting, shared memory and the fingerprint cache against the hashes they
+were given, and snapshots against the database they were exported from.
+
+They use synthetic audio and the in-memory database, run them with pytest.
+"""
+import wave
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+
+from dejavu import Dejavu
+from dejavu.config.settings import (DEFAULT_FS, FIELD_SONG_ID, FIELD_SONGNAME,
+                                    FIELD_TOTAL_HASHES)
+from dejavu.logic.fingerprint import fingerprint, fingerprint_channels
+from dejavu.logic.fingerprint_cache import FingerprintCache
+from dejavu.logic.hash_arrays import (pack_hashes, receive_hashes,
+                                      share_hashes, unpack_hashes)
+from dejavu.logic.hash_sampling import sample_hashes
+
+SECONDS = 6
+
+
+def make_channels(seed: int, channels: int = 2):
+    """Tones over noise, different but reproducible for each seed."""
+    rng = np.random.RandomState(seed)
+    t = np.arange(SECONDS * DEFAULT_FS) / DEFAULT_FS
+    samples = []
+    for _ in range(channels):
+        signal = sum(np.sin(2 * np.pi * freq * t) for freq in rng.uniform(200, 4000, 8))
+        signal = signal * (1 + np.sin(2 * np.pi * rng.uniform(0.5, 2) * t)) + rng.normal(0, 0.5, len(t))
+        samples.append((signal / np.abs(signal).max() * 20000).astype(np.int16))
+    return samples
+
+
+def write_wav(path, channels):
+    with wave.open(str(path), "wb") as f:
+        f.setnchannels(len(channels))
+        f.setsampwidth(2)
+        f.setframerate(DEFAULT_FS)
+        f.writeframes(np.stack(channels, axis=1).tobytes())
+    return str(path)
+
+
+def stored_fingerprints(djv: Dejavu):
+    """Fingerprints of each song of the database, by song name."""
+    names = {song[FIELD_SONG_ID]: song[FIELD_SONGNAME] for song in djv.db.get_songs()}
+    stored = {name: set() for name in names.values()}
+    for rows in djv.db.iter_fingerprints():
+        for hsh, song_id, offset in rows:
+            stored[names[song_id]].add((hsh.lower(), offset))
+    return stored
+
+
+@pytest.fixture(scope="module")
+def songs(tmp_path_factory):
+    folder = tmp_path_factory.mktemp("songs")
+    return [write_wav(folder / f"song_{seed}.wav", make_channels(seed)) for seed in (1, 2)]
+
+
+@pytest.fixture(scope="module")
+def database(songs):
+    djv = Dejavu({"database_type": "memory"})
+    for song in songs:
+        djv.fingerprint_file(song)
+    return djv
+
+
+def test_parallel_segments_match_serial():
+    channels = make_channels(0)
+    serial = set()
+    for channel in channels:
+        serial |= set(fingerprint(channel, Fs=DEFAULT_FS))
+
+    with ThreadPoolExecutor(4) as executor:
+        parallel = fingerprint_channels(channels, Fs=DEFAULT_FS, executor=executor, segment_frames=16)
+
+    assert serial
+    assert parallel == serial
+
+
+def test_shared_hashes_round_trip():
+    hashes = sorted(set(fingerprint(make_channels(0, channels=1)[0], Fs=DEFAULT_FS)))
+
+    assert receive_hashes(share_hashes(hashes)) == hashes
+    assert unpack_hashes(*pack_hashes(hashes)) == hashes
+    assert receive_hashes(share_hashes([])) == []
+
+
+def test_fingerprint_cache_round_trip(songs, tmp_path):
+    cache = FingerprintCache(str(tmp_path / "cache"))
+    computed, file_hash = Dejavu.get_file_fingerprints(songs[0], None)
+
+    assert Dejavu.get_file_fingerprints(songs[0], None, cache=cache) == (computed, file_hash)
+    assert cache.get(file_hash, Dejavu({"database_type": "memory"}).profile, None) is not None
+    # the second time they come from the cache.
+    assert Dejavu.get_file_fingerprints(songs[0], None, cache=cache) == (computed, file_hash)
+    assert Dejavu.get_file_fingerprints(songs[0], 3, cache=cache)[0] != computed
+
+
+def test_snapshot_round_trip(database, tmp_path):
+    path = str(tmp_path / "snapshot.zip")
+    database.export_snapshot(path)
+
+    restored = Dejavu({"database_type": "memory"})
+    info = restored.import_snapshot(path)
+
+    assert info["restored"] == len(database.db.get_songs())
+    assert stored_fingerprints(restored) == stored_fingerprints(database)
+    # importing it again skips the songs already there.
+    assert restored.import_snapshot(path)["restored"] == 0
+    assert stored_fingerprints(restored) == stored_fingerprints(database)
+
+
+def test_sampled_snapshot_import(database, tmp_path):
+    path = str(tmp_path / "snapshot.zip")
+    database.export_snapshot(path)
+
+    sampled = Dejavu({"database_type": "memory", "hash_sample_ratio": 4})
+    sampled.import_snapshot(path)
+
+    expected = {name: set(sample_hashes(hashes, 4)) for name, hashes in stored_fingerprints(database).items()}
+    assert stored_fingerprints(sampled) == expected
+    assert 0 < sum(map(len, expected.values())) < sum(map(len, stored_fingerprints(database).values()))
+    totals = {song[FIELD_SONGNAME]: song[FIELD_TOTAL_HASHES] for song in sampled.db.get_songs()}
+    assert totals == {name: len(hashes) for name, hashes in expected.items()}
@@ -4,6 +4,12 @@ Step 1: Fingerprint original songs (load into database)
 Step 2: Recognize remix files + clips against the database
 Step 3: Save results to JSON
 
+Originals are fingerprinted and files recognized on a pool of WORKERS processes, each one
+keeping its own read only Dejavu instance (and so its database connections and song cache)
+for the whole run. Fingerprints go through the fingerprint cache, so files already seen in a
+previous run are not decoded again. The latency of every recognition is recorded and the
+summary reports its p50/p95/p99 and the throughput next to the accuracy.
+
 Run INSIDE Docker container:
   python run_commands/test_my_songs.py
 """
@@ -12,7 +18,11 @@ import os
 import sys
 import glob
 import json
+import multiprocessing
 from datetime import datetime
+from time import time
+
+import numpy as np
 
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
 
@@ -27,11 +37,17 @@ config = {
         "password": "password",
         "database": "dejavu"
     },
-    "database_type": "postgres"
+    "database_type": "postgres",
+    # the pool fingerprints the originals into the cache, and files already seen are not decoded again.
+    "fingerprint_cache": "dataset_fingerprint_cache"
 }
 
 DATASET_DIR = "dataset"
 RESULTS_FILE = "dataset/results.json"
+WORKERS = multiprocessing.cpu_count()
+
+# Dejavu instance of each pool process, see init_worker.
+worker_djv = None
 
 
 def discover_songs():
@@ -48,7 +64,9 @@ def discover_songs():
 
         original = os.path.join(song_dir, "original.mp3")
         remixes = sorted(glob.glob(os.path.join(song_dir, "remix", "remix_*.mp3")))
-        clips = sorted(glob.glob(os.path.join(song_dir, "remix", "clips_*", "clip_*.mp3")))
+        # clips are MP3, or WAV when generated with generate_clips.py --wav.
+        clips = sorted(path for extension in ("mp3", "wav")
+                       for path in glob.glob(os.path.join(song_dir, "remix", "clips_*", f"clip_*.{extension}")))
 
         songs[song_name] = {
             "original": original if os.path.isfile(original) else None,
@@ -122,6 +140,63 @@ def recognize_file(djv, filepath, expected_song):
         }
 
 
+def init_worker():
+    """Runs once in every pool process: its own read only Dejavu, kept warm for all its files."""
+    global worker_djv
+    worker_djv = Dejavu(dict(config, read_only=True))
+
+
+def fingerprint_worker(filepath):
+    """Fingerprints an original into the fingerprint cache, the main process then stores it from there."""
+    Dejavu.get_file_fingerprints(filepath, worker_djv.limit, profile=worker_djv.profile,
+                                 cache=worker_djv.fingerprint_cache)
+    return filepath
+
+
+def recognize_worker(job):
+    """Recognizes a file on a pool process, recording how long it took from start to end."""
+    filepath, expected_song, test_type = job
+    t = time()
+    r = recognize_file(worker_djv, filepath, expected_song)
+    r["latency"] = round(time() - t, 4)
+    r["song"] = expected_song
+    r["type"] = test_type
+    return r
+
+
+def latency_summary(tests, wall_time):
+    """p50/p95/p99 of the recognition latencies, and how many files were recognized per second."""
+    latencies = [r["latency"] for r in tests]
+    if not latencies:
+        return None
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    return {
+        "files": len(latencies),
+        "p50": round(p50, 3),
+        "p95": round(p95, 3),
+        "p99": round(p99, 3),
+        "mean": round(float(np.mean(latencies)), 3),
+        "wall_time": round(wall_time, 2),
+        "files_per_second": round(len(latencies) / wall_time, 2) if wall_time else None,
+    }
+
+
+def print_test(r, basename):
+    """Prints the outcome of a recognition."""
+    top2_info = ""
+    if r["top2"]:
+        top2_info = f" | #2: {r['top2']['song_name']} ({r['top2']['confidence']:.4f})"
+
+    if r["status"] == "PASS":
+        print(f"    {basename} -> {r['matched']} [PASS] (conf: {r['confidence']:.4f}, hashes: {r['hashes_matched']}, time: {r['latency']:.2f}s){top2_info}")
+    elif r["status"] == "NO_MATCH":
+        print(f"    {basename} -> NO MATCH [FAIL] (no hashes matched any song)")
+    elif r["status"] == "ERROR":
+        print(f"    {basename} -> ERROR: {r.get('error', 'unknown')}")
+    else:
+        print(f"    {basename} -> {r['matched']} [FAIL] expected: {r['expected']} (conf: {r['confidence']:.4f}){top2_info}")
+
+
 if __name__ == '__main__':
     djv = Dejavu(config)
     songs = discover_songs()
@@ -143,6 +218,7 @@ if __name__ == '__main__':
     print("STEP 1: FINGERPRINTING (loading originals into database)")
     print("=" * 60)
 
+    to_fingerprint = {}
     for song_name, data in songs.items():
         if not data["original"]:
             print(f"  [SKIP] {song_name}: no original.mp3 found")
@@ -155,12 +231,23 @@ if __name__ == '__main__':
             all_results["fingerprinted"].append(song_name)
             continue
 
-        print(f"\n  [{song_name}] Fingerprinting original...")
-        print(f"    -> {data['original']}")
-        djv.fingerprint_file(data["original"], song_name=song_name)
+        to_fingerprint[data["original"]] = song_name
+
+    # the pool processes open their own connections, the ones of this process are not shared with them.
+    djv.db.before_fork()
+    pool = multiprocessing.Pool(WORKERS, initializer=init_worker)
+
+    # originals are fingerprinted in parallel into the cache, then stored one after another from it.
+    t = time()
+    for original in pool.imap_unordered(fingerprint_worker, to_fingerprint):
+        song_name = to_fingerprint[original]
+        print(f"\n  [{song_name}] Storing original...")
+        print(f"    -> {original}")
+        djv.fingerprint_file(original, song_name=song_name)
         all_results["fingerprinted"].append(song_name)
+    fingerprint_time = time() - t
 
-    print("\nFingerprinting complete!")
+    print(f"\nFingerprinting complete! ({len(to_fingerprint)} originals in {fingerprint_time:.1f}s)")
 
     # ========== VERIFY: Check DB for all fingerprinted songs ==========
     print("\n  Verifying database...")
@@ -196,65 +283,39 @@ if __name__ == '__main__':
     print("STEP 2: RECOGNIZING REMIXES (whole cover files)")
     print("=" * 60)
 
-    for song_name, data in songs.items():
-        if not data["remixes"]:
-            continue
+    # expected = folder name (e.g. "Jai_Ho") — same as what we stored in DB
+    jobs = [(remix, song_name, "remix") for song_name, data in songs.items() for remix in data["remixes"]]
 
-        # expected = folder name (e.g. "Jai_Ho") — same as what we stored in DB
-        expected_song = song_name
-
-        print(f"\n  [{song_name}] Testing {len(data['remixes'])} remix(es)...")
-        for remix in data["remixes"]:
-            r = recognize_file(djv, remix, expected_song)
-            r["song"] = song_name
-            r["type"] = "remix"
-            all_results["remix_tests"].append(r)
-
-            remix_basename = os.path.basename(remix)
-            top2_info = ""
-            if r["top2"]:
-                top2_info = f" | #2: {r['top2']['song_name']} ({r['top2']['confidence']:.4f})"
-
-            if r["status"] == "PASS":
-                print(f"    {remix_basename} -> {r['matched']} [PASS] (conf: {r['confidence']:.4f}, hashes: {r['hashes_matched']}, time: {r['time']:.2f}s){top2_info}")
-            elif r["status"] == "NO_MATCH":
-                print(f"    {remix_basename} -> NO MATCH [FAIL] (no hashes matched any song)")
-            elif r["status"] == "ERROR":
-                print(f"    {remix_basename} -> ERROR: {r.get('error', 'unknown')}")
-            else:
-                print(f"    {remix_basename} -> {r['matched']} [FAIL] expected: {expected_song} (conf: {r['confidence']:.4f}){top2_info}")
+    # results come back in the order of the jobs, while the pool works on the next ones.
+    t = time()
+    current_song = None
+    for r in pool.imap(recognize_worker, jobs):
+        if r["song"] != current_song:
+            current_song = r["song"]
+            print(f"\n  [{current_song}] Testing {len(songs[current_song]['remixes'])} remix(es)...")
+        all_results["remix_tests"].append(r)
+        print_test(r, os.path.basename(r["file"]))
+    remix_time = time() - t
 
     # ========== STEP 3: RECOGNIZE clips ==========
     print("\n" + "=" * 60)
     print("STEP 3: RECOGNIZING CLIPS (short segments from remixes)")
     print("=" * 60)
 
-    for song_name, data in songs.items():
-        if not data["clips"]:
-            continue
+    jobs = [(clip, song_name, "clip") for song_name, data in songs.items() for clip in data["clips"]]
+
+    t = time()
+    current_song = None
+    for r in pool.imap(recognize_worker, jobs):
+        if r["song"] != current_song:
+            current_song = r["song"]
+            print(f"\n  [{current_song}] Testing {len(songs[current_song]['clips'])} clips...")
+        all_results["clip_tests"].append(r)
+        print_test(r, os.path.basename(r["file"]))
+    clip_time = time() - t
 
-        expected_song = song_name
-
-        print(f"\n  [{song_name}] Testing {len(data['clips'])} clips...")
-        for clip in data["clips"]:
-            r = recognize_file(djv, clip, expected_song)
-            r["song"] = song_name
-            r["type"] = "clip"
-            all_results["clip_tests"].append(r)
-
-            clip_basename = os.path.basename(clip)
-            top2_info = ""
-            if r["top2"]:
-                top2_info = f" | #2: {r['top2']['song_name']} ({r['top2']['confidence']:.4f})"
-
-            if r["status"] == "PASS":
-                print(f"    {clip_basename} -> {r['matched']} [PASS] (conf: {r['confidence']:.4f}, hashes: {r['hashes_matched']}, time: {r['time']:.2f}s){top2_info}")
-            elif r["status"] == "NO_MATCH":
-                print(f"    {clip_basename} -> NO MATCH [FAIL] (no hashes matched any song)")
-            elif r["status"] == "ERROR":
-                print(f"    {clip_basename} -> ERROR: {r.get('error', 'unknown')}")
-            else:
-                print(f"    {clip_basename} -> {r['matched']} [FAIL] expected: {expected_song} (conf: {r['confidence']:.4f}){top2_info}")
+    pool.close()
+    pool.join()
 
     # ========== BUILD PER-SONG METRICS ==========
     per_song = {}
@@ -319,6 +380,14 @@ if __name__ == '__main__':
         "remix_accuracy": f"{remix_pass/remix_total*100:.1f}%" if remix_total > 0 else "N/A",
         "clip_accuracy": f"{clip_pass/clip_total*100:.1f}%" if clip_total > 0 else "N/A",
         "overall_accuracy": f"{total_pass/total_tests*100:.1f}%" if total_tests > 0 else "N/A",
+        "workers": WORKERS,
+        "fingerprint_time": round(fingerprint_time, 2),
+        "latency": {
+            "remix": latency_summary(all_results["remix_tests"], remix_time),
+            "clips": latency_summary(all_results["clip_tests"], clip_time),
+            "overall": latency_summary(all_results["remix_tests"] + all_results["clip_tests"],
+                                       remix_time + clip_time),
+        },
     }
 
     # ========== PRINT: Per-song breakdown ==========
@@ -351,6 +420,11 @@ if __name__ == '__main__':
     print(f"  Remixes:  {remix_pass} PASS / {remix_fail} WRONG MATCH / {remix_nomatch} NO MATCH  ({all_results['summary']['remix_accuracy']})")
     print(f"  Clips:    {clip_pass} PASS / {clip_fail} WRONG MATCH / {clip_nomatch} NO MATCH  ({all_results['summary']['clip_accuracy']})")
     print(f"  Overall:  {total_pass}/{total_tests} matched correctly  ({all_results['summary']['overall_accuracy']})")
+    print(f"\n  Latency on {WORKERS} workers:")
+    for test_type, latency in all_results["summary"]["latency"].items():
+        if latency:
+            print(f"    {test_type:<8} p50 {latency['p50']:.2f}s / p95 {latency['p95']:.2f}s / p99 {latency['p99']:.2f}s"
+                  f"  ({latency['files']} files in {latency['wall_time']:.1f}s, {latency['files_per_second']} files/s)")
 
     # Save to JSON — db_verification and summary at top, then per_song, then tests
     ordered_results = {
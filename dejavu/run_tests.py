@@ -1,5 +1,7 @@
 import argparse
+import json
 import logging
+import multiprocessing
 import time
 from os import makedirs
 from os.path import exists, join
@@ -13,7 +15,7 @@ from dejavu.tests.dejavu_test import (DejavuTest, autolabeldoubles,
 
 
 def main(seconds: int, results_folder: str, temp_folder: str, log: bool, silent: bool,
-         log_file: str, padding: int, seed: int, src: str):
+         log_file: str, padding: int, seed: int, src: str, config_file: str, workers: int):
 
     # set random seed if set by user
     set_seed(seed)
@@ -36,8 +38,11 @@ def main(seconds: int, results_folder: str, temp_folder: str, log: bool, silent:
     # scan files
     log_msg(f"Running Dejavu fingerprinter on files in {src}...", log=log, silent=silent)
 
+    with open(config_file) as f:
+        config = json.load(f)
+
     tm = time.time()
-    djv = DejavuTest(temp_folder, test_seconds)
+    djv = DejavuTest(temp_folder, test_seconds, config, workers)
     log_msg(f"finished obtaining results from dejavu in {(time.time() - tm)}", log=log, silent=silent)
 
     tests = 1  # djv
@@ -158,9 +163,13 @@ if __name__ == '__main__':
     parser.add_argument("-pad", "--padding", action="store", default=10, type=int,
                         help='Number of seconds to pad choice of place to test from.')
     parser.add_argument("-sd", "--seed", action="store", default=None, type=int, help='Random seed.')
+    parser.add_argument("-c", "--config", default="dejavu.cnf.SAMPLE",
+                        help='Configuration file of the database the songs were fingerprinted into.')
+    parser.add_argument("-w", "--workers", action="store", default=multiprocessing.cpu_count(), type=int,
+                        help='Number of processes recognizing the test files.')
     parser.add_argument("src", type=str, help='Source folder for audios to use as tests.')
 
     args = parser.parse_args()
 
     main(args.seconds, args.results_folder, args.temp_folder, args.log, args.silent, args.log_file, args.padding,
-         args.seed, args.src)
+         args.seed, args.src, args.config, args.workers)